@@ -5,16 +5,18 @@ from django.utils.translation import gettext_lazy as _, pgettext_lazy
 
 from wechange_payments.backends import get_invoice_backend, get_additional_invoice_backends
 from wechange_payments.models import Payment, TransactionLog, Subscription, \
-    Invoice, AdditionalInvoice
+    Invoice, AdditionalInvoice, PendingPostback, BillingRun, BillingRunItem, UserPaymentSummary, \
+    InvoiceBlob
 from cosinnus.conf import settings
 from datetime import timedelta
 from wechange_payments.payment import process_due_subscription_payments,\
     terminate_suspended_subscription
 from django.utils.timezone import now
-from wechange_payments.mails import send_payment_event_payment_email,\
+from wechange_payments.mails import send_payment_event_payment_email, send_payment_event_payment_emails,\
     PAYMENT_EVENT_NEW_SUBSCRIPTION_CREATED, PAYMENT_EVENT_SUCCESSFUL_PAYMENT
 from django.utils import translation
 from django.contrib.admin import DateFieldListFilter
+from django.db.models import Count, Q
 
 
 class PaymentAdmin(admin.ModelAdmin):
@@ -23,6 +25,7 @@ class PaymentAdmin(admin.ModelAdmin):
     search_fields = ('user__first_name', 'user__last_name', 'user__email', 'email', 'first_name', 'last_name', 'completed_at', 'vendor_transaction_id', 'internal_transaction_id',)
     readonly_fields = ('user', 'subscription', 'is_reference_payment', 'completed_at', 'last_action_at', 'amount', 'debit_period', 'debit_amount', 'backend', 'vendor_transaction_id', 'internal_transaction_id', 'extra_data')
     raw_id_fields = ('user',)
+    list_select_related = ('user', 'subscription',)
     actions = ['create_invoice', 'create_additional_invoices', 'resend_payment_email',]
     if settings.DEBUG:
         actions += ['debug_only_recreate_invoice',]
@@ -42,18 +45,22 @@ class PaymentAdmin(admin.ModelAdmin):
     def invoice_name(self, obj):
         return f'{obj.first_name} {obj.last_name}'
     
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(additional_invoices_count=Count('additional_invoices'))
+    
+    @admin.display(description=_('Additional invoices'), ordering='additional_invoices_count')
     def additional_invoices(self, obj):
-        return obj.additional_invoices.count()
+        return obj.additional_invoices_count
     
     def resend_payment_email(self, request, queryset):
-        for payment in queryset:
-            if payment.status == Payment.STATUS_PAID:
-                send_payment_event_payment_email(payment, PAYMENT_EVENT_SUCCESSFUL_PAYMENT)
-                message = 'Sent email.'
-                self.message_user(request, message)
-            else:
-                message = 'Payment not successful, no email sent'
-                self.message_user(request, message)
+        paid_payments = list(queryset.filter(status=Payment.STATUS_PAID))
+        if paid_payments:
+            counts = send_payment_event_payment_emails(paid_payments, PAYMENT_EVENT_SUCCESSFUL_PAYMENT)
+            message = 'Sent %(sent)d email(s), %(failed)d failed.' % counts
+            self.message_user(request, message)
+        if len(paid_payments) < queryset.count():
+            message = 'Payment not successful, no email sent'
+            self.message_user(request, message)
     resend_payment_email.short_description = "Resend payment success email"
     
     def create_invoice(self, request, queryset):
@@ -104,6 +111,7 @@ class InvoiceAdmin(admin.ModelAdmin):
     search_fields = ('user__first_name', 'user__last_name', 'user__email', 'payment__vendor_transaction_id', 'payment__internal_transaction_id', 'payment__email', 'payment__first_name', 'payment__last_name', 'created')
     readonly_fields = ('user', 'is_ready', 'state', 'backend', 'extra_data')
     raw_id_fields = ('user',)
+    list_select_related = ('user', 'payment', 'payment__subscription',)
     actions = ['create_invoice',]
     
     @admin.display(description=_('Order Id'))
@@ -165,10 +173,23 @@ admin.site.register(AdditionalInvoice, AdditionalInvoiceAdmin)
 
 
 class TransactionLogAdmin(admin.ModelAdmin):
-    list_display = ('created', 'url', 'type', 'data', )
+    list_display = ('created', 'url', 'type', 'order_id', 'user_id', 'data', )
     list_filter = ('created', 'url', 'type',)
-    search_fields = ('url', 'type', 'data',)
-    readonly_fields = ('url', 'type', 'data', 'created',)
+    # searches are run as exact lookups on the indexed columns, see `get_search_results()`
+    search_fields = ('order_id', 'transaction_id', 'user_id',)
+    readonly_fields = ('url', 'type', 'data', 'created', 'order_id', 'transaction_id', 'user_id',)
+    show_full_result_count = False
+    
+    def get_search_results(self, request, queryset, search_term):
+        """ Match the order id, vendor transaction id or user id exactly, so the indexes are used
+            instead of scanning the JSON data """
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        search_q = Q(order_id=search_term) | Q(transaction_id=search_term)
+        if search_term.isdigit():
+            search_q |= Q(user_id=int(search_term))
+        return queryset.filter(search_q), False
     
     def has_delete_permission(self, request, obj=None):
         """ Can't delete/add Transaction Logs """
@@ -181,12 +202,103 @@ class TransactionLogAdmin(admin.ModelAdmin):
 admin.site.register(TransactionLog, TransactionLogAdmin)
 
 
+class PendingPostbackAdmin(admin.ModelAdmin):
+    list_display = ('created', 'order_id', 'transaction_id', 'reason', 'attempts', 'next_attempt_at', 'processed_at', )
+    list_filter = ('created', 'processed_at', 'reason',)
+    search_fields = ('order_id', 'transaction_id',)
+    readonly_fields = ('created', 'order_id', 'transaction_id', 'data', 'reason', 'attempts', 'next_attempt_at', 'processed_at',)
+    
+    def has_delete_permission(self, request, obj=None):
+        """ Can't delete/add Pending Postbacks """
+        return False
+    
+    def has_add_permission(self, request, obj=None):
+        """ Can't delete/add Pending Postbacks """
+        return False
+
+admin.site.register(PendingPostback, PendingPostbackAdmin)
+
+
+class BillingRunAdmin(admin.ModelAdmin):
+    list_display = ('run_date', 'started_at', 'finished_at', 'attempts', )
+    readonly_fields = ('run_date', 'started_at', 'finished_at', 'attempts', 'stats',)
+    
+    def has_delete_permission(self, request, obj=None):
+        """ Can't delete/add Billing Runs """
+        return False
+    
+    def has_add_permission(self, request, obj=None):
+        """ Can't delete/add Billing Runs """
+        return False
+
+admin.site.register(BillingRun, BillingRunAdmin)
+
+
+class BillingRunItemAdmin(admin.ModelAdmin):
+    list_display = ('idempotency_key', 'subscription', 'state', 'payment', 'attempts', 'claimed_at', 'finished_at', 'billing_run', )
+    list_filter = ('state', 'billing_run__run_date',)
+    search_fields = ('idempotency_key',)
+    readonly_fields = ('billing_run', 'subscription', 'idempotency_key', 'state', 'payment', 'previous_payment_id', 'attempts', 'claimed_at', 'finished_at',)
+    list_select_related = ('billing_run', 'subscription', 'payment',)
+    
+    actions = ['release_interrupted_claims',]
+    
+    def release_interrupted_claims(self, request, queryset):
+        count = 0
+        for item in queryset.filter(state=BillingRunItem.STATE_0_CLAIMED):
+            item.finish(None)
+            count += 1
+        self.message_user(request, f'{count} claimed items were marked as failed and will be booked again on the next billing run.')
+    release_interrupted_claims.short_description = "Mark interrupted claims as failed (only after checking the provider for a payment!)"
+    
+    def has_delete_permission(self, request, obj=None):
+        """ Can't delete/add Billing Run Items """
+        return False
+    
+    def has_add_permission(self, request, obj=None):
+        """ Can't delete/add Billing Run Items """
+        return False
+
+admin.site.register(BillingRunItem, BillingRunItemAdmin)
+
+
+class UserPaymentSummaryAdmin(admin.ModelAdmin):
+    list_display = ('user', 'lifetime_paid_sum', 'year_paid_sum', 'last_paid_at', 'active_subscription', 'invoice_count', 'refreshed_at', )
+    search_fields = ('user__email', 'user__first_name', 'user__last_name', )
+    readonly_fields = ('user', 'lifetime_paid_sum', 'year_paid_sum', 'last_paid_at', 'active_subscription', 'invoice_count', 'refreshed_at',)
+    list_select_related = ('user', 'active_subscription',)
+    
+    def has_add_permission(self, request, obj=None):
+        """ Summaries are only created by refreshes """
+        return False
+
+admin.site.register(UserPaymentSummary, UserPaymentSummaryAdmin)
+
+
+class InvoiceBlobAdmin(admin.ModelAdmin):
+    list_display = ('sha256', 'ref_count', 'size', 'stored_size', 'is_compressed', 'created', 'verified_at', )
+    list_filter = ('is_compressed',)
+    search_fields = ('sha256', 'file',)
+    readonly_fields = ('sha256', 'file', 'size', 'stored_size', 'is_compressed', 'ref_count', 'created', 'compression_checked_at', 'verified_at',)
+    
+    def has_delete_permission(self, request, obj=None):
+        """ Blobs are only deleted by the `maintain_invoice_blobs` command """
+        return False
+    
+    def has_add_permission(self, request, obj=None):
+        """ Can't delete/add Invoice Blobs """
+        return False
+
+admin.site.register(InvoiceBlob, InvoiceBlobAdmin)
+
+
 class SubscriptionAdmin(admin.ModelAdmin):
     list_display = ('payl_user_id', 'user', 'state', 'debit_amount', 'amount', 'debit_period', 'next_due_date', 'payl_last_payment_internal_transaction_id', 'has_problems', 'created', 'terminated')
     list_filter = ('state', 'has_problems', )
     search_fields = ('id', 'user__first_name', 'user__last_name', 'user__email', 'reference_payment__vendor_transaction_id', 'reference_payment__internal_transaction_id', 'created')
     readonly_fields = ('user', 'state', 'has_problems', 'reference_payment', 'last_payment', 'amount', 'debit_period', 'debit_amount', 'next_due_date', 'num_attempts_recurring', 'last_pre_notification_at')
     raw_id_fields = ('user',)
+    list_select_related = ('user', 'last_payment',)
     
     actions = ['resend_both_initial_emails', 'resend_subscription_email', 'terminate_suspended',]
 
@@ -1,13 +1,16 @@
 # -*- coding: utf-8 -*-
 
+from functools import partial
 import logging
-import threading
 
 from annoying.functions import get_object_or_None
 from django.core.exceptions import ImproperlyConfigured
 
+from wechange_payments.backends.transport import HttpTransport
 from wechange_payments.conf import settings
 from wechange_payments.models import Invoice, Payment, AdditionalInvoice
+from wechange_payments.utils.utils import chunked, run_in_worker_threads
+from wechange_payments.utils.work_queue import get_invoice_work_queue
 
 logger = logging.getLogger('wechange-payments')
 
@@ -22,42 +25,54 @@ class BaseInvoiceBackend(object):
             if not auth_data.get(key, None):
                 raise ImproperlyConfigured('Invoice backend auth data property "%s" is required for backend "%s"!'
                             % (key, self.__class__.__name__))
+        # pooled HTTP session for all requests to the invoice provider
+        self.transport = HttpTransport()
+    
+    def _backend_path(self):
+        return '%s.%s' %(self.__class__.__module__, self.__class__.__name__)
     
     def create_invoice_for_payment(self, payment, threaded=False, additional_invoice=False):
         """ Tries to create a finalized invoice in Lexoffice with all required data for a given payment.
             @param: additional_invoice: if True, the invoice is being created as instance of `AdditionalInvoice`
             @return: An Invoice instance if the invoice was created in Lexoffice, raise Exception otherwise """
         if threaded:
-            thread = threading.Thread(target=self.create_invoice_for_payment, args=(payment, False, additional_invoice))
-            thread.start()
+            key = ('payment', self._backend_path(), payment.id, additional_invoice)
+            get_invoice_work_queue().submit(key, self.create_invoice_for_payment, payment, False, additional_invoice)
             return
         
         try:
             # only create invoices for successfully paid Payments!
             if payment.status != Payment.STATUS_PAID:
                 return
-            
-            if additional_invoice:
-                invoice = get_object_or_None(AdditionalInvoice, payment=payment, backend='%s.%s' %(self.__class__.__module__, self.__class__.__name__))
-                if not invoice:
-                    invoice = AdditionalInvoice.objects.create(
-                        payment=payment,
-                        user=payment.user,
-                        backend='%s.%s' %(self.__class__.__module__, self.__class__.__name__)
-                    )
-            else:
-                invoice = get_object_or_None(Invoice, payment=payment)
-                if not invoice:
-                    invoice = Invoice.objects.create(
-                        payment=payment,
-                        user=payment.user,
-                        backend='%s.%s' %(self.__class__.__module__, self.__class__.__name__)
-                    )
+            invoice = self.get_or_create_invoice_for_payment(payment, additional_invoice=additional_invoice)
             self.create_invoice(invoice, threaded=False)
         except Exception as e:
             logger.error('Payments: Critical: Error during (our) invoice creation: Could not create an `Invoice` instance for a Payment! This must be manually repeated!', extra={'exception': e, 'payment_internal_transaction_id': payment.internal_transaction_id})
             if settings.DEBUG:
                 raise
+    
+    def get_or_create_invoice_for_payment(self, payment, additional_invoice=False):
+        """ Returns our `Invoice` (or `AdditionalInvoice`) instance for a payment, creating it if it
+            doesn't exist yet. This does not call the invoice provider.
+            @param: additional_invoice: if True, the invoice is an instance of `AdditionalInvoice` """
+        backend = self._backend_path()
+        if additional_invoice:
+            invoice = get_object_or_None(AdditionalInvoice, payment=payment, backend=backend)
+            if not invoice:
+                invoice = AdditionalInvoice.objects.create(
+                    payment=payment,
+                    user=payment.user,
+                    backend=backend
+                )
+        else:
+            invoice = get_object_or_None(Invoice, payment=payment)
+            if not invoice:
+                invoice = Invoice.objects.create(
+                    payment=payment,
+                    user=payment.user,
+                    backend=backend
+                )
+        return invoice
         
     def create_invoice(self, invoice, threaded=False):
         """ Tries to create, finalize and download an invoice at the invoice provider 
@@ -66,8 +81,8 @@ class BaseInvoiceBackend(object):
             @param threaded: If True, will run in a thread.
             @return The finished instance of `Invoice` or None if *any* step failed """
         if threaded:
-            thread = threading.Thread(target=self.create_invoice, args=(invoice, False))
-            thread.start()
+            key = ('invoice', self._backend_path(), invoice.__class__.__name__, invoice.id)
+            get_invoice_work_queue().submit(key, self.create_invoice, invoice, False)
             return
             
         if invoice.is_ready or invoice.state == Invoice.STATE_3_DOWNLOADED:
@@ -95,6 +110,51 @@ class BaseInvoiceBackend(object):
         invoice.save()
         return None
     
+    def create_invoices_in_stages(self, invoices, max_workers=None):
+        """ Bulk variant of `create_invoice()` for many unfinished invoices. Runs each step (create,
+            finalize, download) for all invoices before moving on to the next step. The invoices of
+            a step are processed in chunks by up to `max_workers` worker threads.
+            Each invoice saves its state after every step, so an interrupted run continues where it stopped.
+            @param max_workers: Defaults to `PAYMENTS_INVOICE_PIPELINE_MAX_WORKERS`
+            @return: dict of counters: the number of invoices that were created, finalized, downloaded
+                (i.e. are now ready) at the provider in this run, and the number of invoices that failed """
+        if max_workers is None:
+            max_workers = settings.PAYMENTS_INVOICE_PIPELINE_MAX_WORKERS
+        invoices = [invoice for invoice in invoices if not invoice.is_ready]
+        stages = (
+            ('created', Invoice.STATE_0_NOT_CREATED, self._create_invoice_at_provider),
+            ('finalized', Invoice.STATE_1_CREATED, self._finalize_invoice_at_provider),
+            ('downloaded', Invoice.STATE_2_FINALIZED, self._download_invoice_from_provider),
+        )
+        stats = {'created': 0, 'finalized': 0, 'downloaded': 0, 'failed': 0}
+        failed_invoice_ids = set()
+        for counter, state, step in stages:
+            stage_invoices = [invoice for invoice in invoices 
+                              if invoice.state == state and invoice.id not in failed_invoice_ids]
+            chunks = list(chunked(stage_invoices, settings.PAYMENTS_INVOICE_PIPELINE_CHUNK_SIZE))
+            run_in_worker_threads(partial(self._run_invoice_step_for_chunk, step), chunks, max_workers)
+            for invoice in stage_invoices:
+                if invoice.state > state:
+                    stats[counter] += 1
+                else:
+                    failed_invoice_ids.add(invoice.id)
+        stats['failed'] = len(failed_invoice_ids)
+        return stats
+    
+    def _run_invoice_step_for_chunk(self, step, invoices):
+        """ Runs one invoice provider step for each invoice of a chunk. Errors are logged per invoice. """
+        for invoice in invoices:
+            try:
+                step(invoice)
+                if invoice.state == Invoice.STATE_3_DOWNLOADED:
+                    logger.info('Payments: Successfully created an invoice at the invoice provider!', extra={'invoice_id': invoice.id})
+            except Exception as exc:
+                if settings.DEBUG:
+                    raise
+                logger.error('Payments: Error during invoice creation with exception: Stopped at invoice state %d!' % invoice.state, extra={'state': invoice.state, 'exception': exc, 'invoice_id': invoice.id, 'payment_internal_transaction_id': invoice.payment.internal_transaction_id})
+                # save the invoice to trigger updating its `last_action_at`, so we can delay repeated API calls.
+                invoice.save()
+    
     def _get_tax_rate_percent(self):
         """ Returns the tax rate percent as datatype the backend requires. """
         return settings.PAYMENTS_INVOICE_PROVIDER_TAX_RATE_PERCENT
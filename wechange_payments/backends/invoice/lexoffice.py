@@ -1,10 +1,7 @@
 # -*- coding: utf-8 -*-
-import hashlib
 import logging
-from uuid import uuid1
 
-import requests
-from django.core.files.base import ContentFile
+from django.db import transaction
 from django.utils.encoding import force_str
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
@@ -183,7 +180,7 @@ class LexofficeInvoiceBackend(BaseInvoiceBackend):
             },
             'note': f'WECHANGE PAYL contact for subscription id: {reference_payment.subscription_id}, user id: {reference_payment.user_id}'
         }
-        req = requests.post(contact_post_url, headers=headers, json=contact_id_data)
+        req = self.transport.post(contact_post_url, headers=headers, json=contact_id_data)
         
         if not req.status_code == 200:
             extra = {'post_url': contact_post_url, 'status': req.status_code, 'content': req._content}
@@ -230,7 +227,7 @@ class LexofficeInvoiceBackend(BaseInvoiceBackend):
         }
         
         data = self._make_invoice_request_params(invoice)
-        req = requests.post(post_url, headers=headers, json=data)
+        req = self.transport.post(post_url, headers=headers, json=data)
         
         if not req.status_code in [200, 201]:
             return_json = None
@@ -307,7 +304,7 @@ class LexofficeInvoiceBackend(BaseInvoiceBackend):
             'Authorization': 'Bearer %s' % self.api_key,
             'Accept': 'application/json',
         }
-        req = requests.get(get_url, headers=headers)
+        req = self.transport.get(get_url, headers=headers)
         
         if not req.status_code == 200:
             extra = {'get_url': get_url, 'status': req.status_code, 'content': req._content}
@@ -358,7 +355,7 @@ class LexofficeInvoiceBackend(BaseInvoiceBackend):
         headers = {
             'Authorization': 'Bearer %s' % self.api_key,
         }
-        req = requests.get(get_url, headers=headers)
+        req = self.transport.get(get_url, headers=headers)
         
         if not req.status_code == 200:
             extra = {'get_url': get_url, 'status': req.status_code, 'content': req._content}
@@ -375,12 +372,11 @@ class LexofficeInvoiceBackend(BaseInvoiceBackend):
                 print(extra)
             raise Exception('Payments: Missing content in download request result (request has been logged as error).')
         
-        hash_source = str(uuid1()) + invoice.provider_id
-        filename = hashlib.sha1(hash_source.encode('utf-8')).hexdigest()
-        invoice.file.save(filename, ContentFile(content), save=False)
-        invoice.state = Invoice.STATE_3_DOWNLOADED
-        invoice.is_ready = True
-        invoice.save()
+        with transaction.atomic():
+            invoice.store_file(content)
+            invoice.state = Invoice.STATE_3_DOWNLOADED
+            invoice.is_ready = True
+            invoice.save()
         
         return invoice
     
\ No newline at end of file
@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
 
+from collections import defaultdict, namedtuple
+from contextlib import asynccontextmanager
 from datetime import timedelta
 import logging
+import uuid
 
+from asgiref.sync import sync_to_async
 from django.core.exceptions import ImproperlyConfigured
-from django.db.models import Sum
+from django.db import transaction
+from django.db.models import Sum, Count, Q
 from django.template.loader import render_to_string
 from django.utils.timezone import now
 
 from wechange_payments import signals
+from wechange_payments.backends.transport import HttpTransport, AsyncHttpTransport
 from wechange_payments.conf import settings, PAYMENT_TYPE_DIRECT_DEBIT, \
     PAYMENT_TYPE_PAYPAL, PAYMENT_TYPE_CREDIT_CARD
 from wechange_payments.models import Payment
@@ -17,6 +23,16 @@ from wechange_payments.utils.utils import resolve_class
 
 logger = logging.getLogger('wechange-payments')
 
+# the payment history of a user that the recurring payment safety checks are based on
+SafetyCheckFigures = namedtuple('SafetyCheckFigures', ['recent_paid_count', 'paid_amount_sum'])
+
+
+@asynccontextmanager
+async def _use_open_transport(transport):
+    """ Uses an already opened async transport, without closing it afterwards. """
+    yield transport
+
+
 class BaseBackend(object):
     """  """
     # define this in the implementing backend
@@ -75,6 +91,19 @@ class BaseBackend(object):
             if not getattr(settings, key, None):
                 raise ImproperlyConfigured('Setting "%s" is required for backend "%s"!' 
                             % (key, self.__class__.__name__))
+        # pooled HTTP session for all requests to the payment provider
+        self.transport = HttpTransport()
+    
+    def open_async_transport(self):
+        """ Opens a transport for the async backend API, to be shared by a batch of concurrent calls.
+            Use as `async with backend.open_async_transport() as transport:` """
+        return AsyncHttpTransport()
+    
+    def _open_async_transport(self, transport=None):
+        """ Returns a context that uses the given open transport, or opens one for a single call. """
+        if transport is not None:
+            return _use_open_transport(transport)
+        return self.open_async_transport()
     
     def check_missing_params(self, params, payment_type):
         """ Checks if any of the required parameters are missing in
@@ -86,13 +115,32 @@ class BaseBackend(object):
                 missing_params.append(param)
         return missing_params
     
-    def user_pre_recurring_payment_safety_checks(self, user):
+    def get_recurring_payment_safety_figures(self, user_ids):
+        """ Computes the figures for the recurring payment safety checks of many users in a single query:
+            the number of paid payments in the last 7 days and the sum of paid amounts in the last 360 days.
+            The nightly billing uses this for all subscriptions it has locked for booking at once.
+            @param user_ids: A list of user ids, or a values queryset of user ids
+            @return: dict of {user_id: `SafetyCheckFigures`}. Users without paid payments get zero figures """
+        seven_days = now() - timedelta(days=7)
+        one_year = now() - timedelta(days=360)
+        rows = Payment.objects.filter(user_id__in=user_ids, status=Payment.STATUS_PAID, completed_at__gt=one_year)\
+                .values('user_id').order_by('user_id')\
+                .annotate(recent_paid_count=Count('id', filter=Q(completed_at__gt=seven_days)), paid_amount_sum=Sum('amount'))\
+                .values_list('user_id', 'recent_paid_count', 'paid_amount_sum')
+        figures = defaultdict(lambda: SafetyCheckFigures(0, 0.0))
+        for user_id, recent_paid_count, paid_amount_sum in rows:
+            figures[user_id] = SafetyCheckFigures(recent_paid_count, paid_amount_sum or 0.0)
+        return figures
+    
+    def user_pre_recurring_payment_safety_checks(self, user, safety_figures=None):
         """ Executes a series of hardcoded safety checks to verify that the a payment
             may be executed for a user. Meant as a second independent check to make 
             sure that no irregularly frequent or too-high amounts will be processed
             from a user.
             This function *must* be called before making any actual payments!
             
+            @param safety_figures: The user's `SafetyCheckFigures`, if they were already computed for a whole
+                chunk by `get_recurring_payment_safety_figures()`. Otherwise they are queried here.
             @return: True if a payment may be made, False otherwise 
             """
         # --------- Pre-Payment Safety checks ----------
@@ -110,20 +158,18 @@ class BaseBackend(object):
         if getattr(settings, 'PAYMENTS_OVERRIDE_SAFETY_CHECKS', False):
             return True
         
+        if safety_figures is None:
+            safety_figures = self.get_recurring_payment_safety_figures([user.id])[user.id]
+        
         # 2. No existing successful payment in the last 7 days
-        seven_days = now() - timedelta(days=7)
-        paid_payments = Payment.objects.filter(user=user, status=Payment.STATUS_PAID, completed_at__gt=seven_days)
-        if paid_payments.count() > 0:
+        if safety_figures.recent_paid_count > 0:
             logger.critical('Payments: NEED TO INVESTIGATE! `user_pre_recurring_payment_safety_checks` was prevented because of an existing successful Payment for this user in the last 7 days!',
                 extra={'user': user})
             return False
         
         # 3. No payments for this user over the hardcapped payment amount in the last (almost) year
         # FIXME: discuss with Sascha
-        twenty_eight_days = now() - timedelta(days=360)
-        paid_payments_month = Payment.objects.filter(user=user, status=Payment.STATUS_PAID, completed_at__gt=twenty_eight_days)
-        payment_sum = paid_payments_month.aggregate(Sum('amount')).get('amount__sum', None)
-        payment_sum = 0.0 if payment_sum is None else payment_sum
+        payment_sum = safety_figures.paid_amount_sum
         if payment_sum > settings.PAYMENTS_MAXIMUM_ALLOWED_PAYMENT_AMOUNT:
             logger.critical('Payments: NEED TO INVESTIGATE! `user_pre_recurring_payment_safety_checks` was prevented because the sum of Payment amounts for this user in the last 28 days exceeds the maximum hardcap payment amount!', 
                 extra={'user': user, 'payment_sum': payment_sum})
@@ -196,19 +242,89 @@ class BaseBackend(object):
         """
         raise NotImplemented('Use a proper payment provider backend for this function!')
     
-    def make_recurring_payment(self, reference_payment):
+    def make_recurring_payment(self, reference_payment, safety_figures=None):
         """
             Executes a subsequent payment for a given reference payment. 
             Used for monthly recurring payments. Returns the newly made `Payment` instance. 
             
+            This runs the three steps `prepare_recurring_payment()`, `request_recurring_payment()` and
+            `save_recurring_payment()`. The nightly billing calls the steps itself, so that no DB transaction
+            is open during the provider call. Do not call this inside a transaction either.
+            
             @param reference_payment: The initial reference payment which can be referred to to make
                 follow-up payments on.
+            @param safety_figures: The user's precomputed `SafetyCheckFigures`, see `user_pre_recurring_payment_safety_checks()`
             @return: tuple (
                         model of wechange_payments.models.BasePayment if successful or None,
                         str error message if error or None
                     )
         """
-        raise NotImplemented('Use a proper payment provider backend for this function!')
+        prepared = self.prepare_recurring_payment(reference_payment, safety_figures=safety_figures)
+        if isinstance(prepared, str):
+            # contains error message, return
+            return None, prepared
+        order_id, params = prepared
+        payment, error = self.request_recurring_payment(reference_payment, order_id, params)
+        if error is not None:
+            return None, error
+        with transaction.atomic():
+            return self.save_recurring_payment(reference_payment, payment), None
+    
+    async def amake_recurring_payment(self, reference_payment, transport=None, safety_figures=None):
+        """
+            Async variant of `make_recurring_payment()`, used to book many recurring payments concurrently.
+            Only the provider call is awaited, the other steps are run in `sync_to_async` calls.
+            
+            @param reference_payment: The initial reference payment which can be referred to to make
+                follow-up payments on.
+            @param transport: An open `AsyncHttpTransport` shared by concurrent calls (see `open_async_transport()`).
+            @param safety_figures: The user's precomputed `SafetyCheckFigures`, see `user_pre_recurring_payment_safety_checks()`
+            @return: tuple (
+                        model of wechange_payments.models.BasePayment if successful or None,
+                        str error message if error or None
+                    )
+        """
+        prepared = await sync_to_async(self.prepare_recurring_payment)(reference_payment, safety_figures=safety_figures)
+        if isinstance(prepared, str):
+            # contains error message, return
+            return None, prepared
+        order_id, params = prepared
+        payment, error = await self.arequest_recurring_payment(reference_payment, order_id, params, transport=transport)
+        if error is not None:
+            return None, error
+        return await sync_to_async(self._asave_recurring_payment)(reference_payment, payment), None
+    
+    def _asave_recurring_payment(self, reference_payment, payment):
+        with transaction.atomic():
+            return self.save_recurring_payment(reference_payment, payment)
+    
+    def prepare_recurring_payment(self, reference_payment, safety_figures=None):
+        """ First step of a recurring payment: runs the safety checks and collects the params of the
+            new payment from the reference payment. The nightly billing calls this while holding
+            the row lock on the subscription.
+            @param safety_figures: The user's precomputed `SafetyCheckFigures`, see `user_pre_recurring_payment_safety_checks()`
+            @return: tuple (order_id, params), or a str error message if a check failed """
+        raise NotImplementedError('Use a proper payment provider backend for this function!')
+    
+    def request_recurring_payment(self, reference_payment, order_id, params):
+        """ Second step of a recurring payment: makes the API call to the provider.
+            Must be called without an open DB transaction, so that a payment accepted by the provider is
+            never rolled back together with a failing transaction.
+            @return: tuple (the new, *unsaved* `Payment` if successful or None, str error message if error or None) """
+        raise NotImplementedError('Use a proper payment provider backend for this function!')
+    
+    async def arequest_recurring_payment(self, reference_payment, order_id, params, transport=None):
+        """ Async variant of `request_recurring_payment()`. Backends with an async API client should
+            override this. By default, the synchronous call is run in the calling thread.
+            @param transport: An open `AsyncHttpTransport` shared by concurrent calls """
+        return await sync_to_async(self.request_recurring_payment)(reference_payment, order_id, params)
+    
+    def save_recurring_payment(self, reference_payment, payment):
+        """ Last step of a recurring payment: attaches the subscription to the new payment, sets its status
+            and saves it. Call this inside a transaction, together with anything that records the outcome
+            of the payment (as the billing run does), so that these are saved all together.
+            @return: The saved payment """
+        raise NotImplementedError('Use a proper payment provider backend for this function!')
     
     def handle_success_redirect(self, request, params):
         """ Endpoint the user gets redirected to, after a transaction was successful that happened
@@ -229,6 +345,13 @@ class BaseBackend(object):
             @return: True if a 200 should be returned and the data was handled properly,
                         False if a 404 should be returned so the postback will be posted again """
         raise NotImplemented('Use a proper payment provider backend for this function!')
+    
+    def reconcile_pending_postbacks(self, order_id=None):
+        """ Applies postbacks that arrived before the payment they refer to was saved.
+            Backends that defer unmatched postbacks in `handle_postback()` implement this.
+            @param order_id: If given, only reconcile the postbacks for this order id.
+            @return: The number of postbacks that were applied """
+        return 0
         
 
 class DummyBackend(BaseBackend):
@@ -246,3 +369,31 @@ class DummyBackend(BaseBackend):
             ), 
             None
         )
+    
+    def prepare_recurring_payment(self, reference_payment, safety_figures=None):
+        if not self.user_pre_recurring_payment_safety_checks(reference_payment.user, safety_figures=safety_figures):
+            return 'Error: The safety checks failed.'
+        return (str(uuid.uuid4()), {})
+    
+    def request_recurring_payment(self, reference_payment, order_id, params):
+        subscription = reference_payment.subscription
+        return (
+            Payment(
+                user=reference_payment.user,
+                vendor_transaction_id=str(uuid.uuid4()),
+                internal_transaction_id=order_id,
+                amount=subscription.amount,
+                debit_period=subscription.debit_period,
+                type=reference_payment.type,
+                status=Payment.STATUS_STARTED,
+                is_reference_payment=False,
+                backend='%s.%s' % (self.__class__.__module__, self.__class__.__name__),
+            ),
+            None
+        )
+    
+    def save_recurring_payment(self, reference_payment, payment):
+        payment.subscription = reference_payment.subscription
+        payment.status = Payment.STATUS_COMPLETED_BUT_UNCONFIRMED
+        payment.save()
+        return payment
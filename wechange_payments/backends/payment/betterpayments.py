@@ -1,26 +1,34 @@
 # -*- coding: utf-8 -*-
 from copy import copy
-import hashlib
 import logging
-import urllib
 import uuid
 
 from annoying.functions import get_object_or_None
+from asgiref.sync import sync_to_async
 from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.db.models import F
 from django.urls.base import reverse
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
-import requests
+from requests.exceptions import RequestException
 import six
 
 from cosinnus.models.group import CosinnusPortal
 from wechange_payments.backends.payment.base import BaseBackend
 from wechange_payments.conf import settings, PAYMENT_TYPE_DIRECT_DEBIT, \
     PAYMENT_TYPE_CREDIT_CARD, REDIRECTING_PAYMENT_TYPES, PAYMENT_TYPE_PAYPAL
-from wechange_payments.models import TransactionLog, Payment, Subscription
+from wechange_payments.models import TransactionLog, Payment, Subscription,\
+    PendingPostback
+from wechange_payments.utils.transaction_log import log_transaction, buffered_transaction_logs
+from wechange_payments.mails import batched_payment_emails
+from wechange_payments.utils.checksum import get_checksum_signer
+from wechange_payments.utils.dedup import get_postback_deduplicator
+from wechange_payments.utils.metrics import increment
+from wechange_payments.utils.work_queue import get_postback_work_queue
 from wechange_payments.payment import suspend_failed_subscription, handle_successful_payment,\
     handle_payment_refunded
-import time
+from datetime import timedelta
 
 logger = logging.getLogger('wechange-payments')
 
@@ -76,19 +84,12 @@ class BetterPaymentBackend(BaseBackend):
             Use `PAYMENTS_BETTERPAYMENT_OUTGOING_KEY` for requests sent out to Betterpayments from us,
             and `PAYMENTS_BETTERPAYMENT_INCOMING_KEY` to validate Postback requests made to us from them.
         """
-        hash_params = dict([(k, v or '') for k,v in params.items() if not k == 'checksum'])
-        query = urllib.parse.urlencode(hash_params) + incoming_or_outgoing_key
-        sha1 = hashlib.sha1()
-        sha1.update(query.encode('utf-8'))
-        return sha1.hexdigest()
+        return get_checksum_signer(incoming_or_outgoing_key).calculate(params)
     
     def sign_request_params_with_checksum(self, params):
         """ Adds the 'checksum' parameter to a set of params, which is required
             for many BetterPayment requests. """
-        params.update({
-            'checksum': self.calculate_request_checksum(params, settings.PAYMENTS_BETTERPAYMENT_OUTGOING_KEY)
-        })
-        return params
+        return get_checksum_signer(settings.PAYMENTS_BETTERPAYMENT_OUTGOING_KEY).sign(params)
     
     def test_status(self):
         testparams = {
@@ -114,6 +115,28 @@ class BetterPaymentBackend(BaseBackend):
             The token is the mandate token that has to be shown to the user.
             @return: tuple (transaction_id, sepa_mandate_token) or str if there was an error.
             """
+        post_url, data = self._prepare_sepa_mandate_request(order_id)
+        try:
+            req = self.transport.post(post_url, data=data)
+        except RequestException as e:
+            return self._sepa_mandate_request_failed(post_url, e)
+        return self._handle_sepa_mandate_response(req, post_url, data)
+    
+    async def acreate_sepa_mandate(self, order_id, transport=None):
+        """ Async variant of `_create_sepa_mandate()`.
+            @param transport: An open `AsyncHttpTransport` shared by concurrent calls. If None,
+                a transport is opened for this call only.
+            @return: tuple (transaction_id, sepa_mandate_token) or str if there was an error. """
+        post_url, data = self._prepare_sepa_mandate_request(order_id)
+        async with self._open_async_transport(transport) as transport:
+            try:
+                req = await transport.post(post_url, data=data)
+            except transport.request_error as e:
+                return self._sepa_mandate_request_failed(post_url, e)
+        return await sync_to_async(self._handle_sepa_mandate_response)(req, post_url, data)
+    
+    def _prepare_sepa_mandate_request(self, order_id):
+        """ @return: tuple (post_url, data) for the SEPA mandate creation API call """
         url = '/rest/create_mandate_reference'
         post_url = settings.PAYMENTS_BETTERPAYMENT_API_DOMAIN + url
         data = {
@@ -121,16 +144,23 @@ class BetterPaymentBackend(BaseBackend):
             'payment_type': PAYMENT_TYPE_DIRECT_DEBIT,
             'order_id': order_id,
         }
-        
-        req = requests.post(post_url, data=data)
+        return post_url, data
+    
+    def _sepa_mandate_request_failed(self, post_url, exception):
+        logger.error('Payments: BetterPayment SEPA Mandate creation failed, request did not complete.', extra={'post_url': post_url, 'exception': exception})
+        return 'Error: The payment provider could not be reached.'
+    
+    def _handle_sepa_mandate_response(self, req, post_url, data):
+        """ Checks and logs the response of the SEPA mandate creation API call.
+            @return: tuple (transaction_id, sepa_mandate_token) or str if there was an error. """
         if not req.status_code == 200:
-            extra = {'post_url': post_url, 'status': req.status_code, 'content': req._content}
+            extra = {'post_url': post_url, 'status': req.status_code, 'content': req.content}
             logger.error('Payments: BetterPayment SEPA Mandate creation failed, request did not return status=200.', extra=extra)
             return 'Error: The payment provider could not be reached.'
     
         result = req.json() # success!
-        TransactionLog.objects.create(
-            type=TransactionLog.TYPE_REQUEST,
+        log_transaction(
+            log_type=TransactionLog.TYPE_REQUEST,
             url=post_url,
             data=_strip_sensitive_data(result),
         )
@@ -230,21 +260,17 @@ class BetterPaymentBackend(BaseBackend):
             @return: A tuple of (`Payment`, None) if successful or (None, Str-error-message) """
         return self._make_redirected_payment(params, PAYMENT_TYPE_PAYPAL, user=user, make_postponed=make_postponed)
     
-    def make_recurring_payment(self, reference_payment):
-        """ Executes a subsequent payment for a given reference payment. 
-            Used for monthly recurring payments. Returns the newly made `Payment` instance. 
-            @param user: The user for which this payment should be made. Can potentially be null.
-            @param params: Expected params can be found in `REQUIRED_PARAMS`.
-            @return: A tuple of (`Payment`, None) if successful, returning the *new* Payment,
-                or (None, Str-error-message) """
-        if not self.user_pre_recurring_payment_safety_checks(reference_payment.user):
-            return None, _('Error: "%(error_message)s" (%(error_code)d)') % {'error_message': ERROR_MESSAGE_PAYMENT_SECURITY_CHECK_FAILED, 'error_code': -6}
+    def prepare_recurring_payment(self, reference_payment, safety_figures=None):
+        """ Runs the safety checks for a recurring payment and collects its params from the reference payment.
+            @return: tuple (order_id, params) or str error message if a check failed """
+        if not self.user_pre_recurring_payment_safety_checks(reference_payment.user, safety_figures=safety_figures):
+            return _('Error: "%(error_message)s" (%(error_code)d)') % {'error_message': ERROR_MESSAGE_PAYMENT_SECURITY_CHECK_FAILED, 'error_code': -6}
         # additional check: reference payment must be coming from an active subscription!
         if not reference_payment.subscription or not reference_payment.subscription.state == Subscription.STATE_2_ACTIVE:
-            return None, _('Error: "%(error_message)s" (%(error_code)d)') % {'error_message': ERROR_MESSAGE_PAYMENT_SECURITY_CHECK_FAILED, 'error_code': -7}
+            return _('Error: "%(error_message)s" (%(error_code)d)') % {'error_message': ERROR_MESSAGE_PAYMENT_SECURITY_CHECK_FAILED, 'error_code': -7}
         # additional check: reference payment must be coming from an active subscription that has no pending payments!
         if reference_payment.subscription.has_pending_payment():
-            return None, _('Error: "%(error_message)s" (%(error_code)d)') % {'error_message': ERROR_MESSAGE_PAYMENT_SECURITY_CHECK_FAILED, 'error_code': -8}
+            return _('Error: "%(error_message)s" (%(error_code)d)') % {'error_message': ERROR_MESSAGE_PAYMENT_SECURITY_CHECK_FAILED, 'error_code': -8}
         
         # collect params from reference payment
         order_id = str(uuid.uuid4())
@@ -261,7 +287,12 @@ class BetterPaymentBackend(BaseBackend):
             'email': reference_payment.email,    
             'organisation': reference_payment.organisation,
         }
-        payment, error = self._make_actual_payment(
+        return order_id, params
+    
+    def request_recurring_payment(self, reference_payment, order_id, params):
+        """ Makes the API call for a recurring payment on a reference payment.
+            @return: A tuple of (the unsaved `Payment`, None) if successful, or (None, Str-error-message) """
+        return self._make_actual_payment(
             reference_payment.type,
             order_id, 
             params,
@@ -269,9 +300,26 @@ class BetterPaymentBackend(BaseBackend):
             original_transaction_id=reference_payment.vendor_transaction_id,
             is_recurring=True,
         )
-        if error is not None:
-            return None, error
-        
+    
+    async def arequest_recurring_payment(self, reference_payment, order_id, params, transport=None):
+        """ Async variant of `request_recurring_payment()`.
+            @param transport: An open `AsyncHttpTransport` shared by concurrent calls. If None,
+                a transport is opened for this call only. """
+        return await self._amake_actual_payment(
+            reference_payment.type,
+            order_id, 
+            params,
+            user=reference_payment.user, 
+            original_transaction_id=reference_payment.vendor_transaction_id,
+            is_recurring=True,
+            transport=transport,
+        )
+    
+    def save_recurring_payment(self, reference_payment, payment):
+        """ Attaches the subscription to a newly made recurring payment, sets its status and saves it.
+            Call this inside a transaction. If saving fails, the error is raised, so the transaction is rolled back.
+            @return: The saved payment """
+        order_id = payment.internal_transaction_id
         # attach subscription from reference payment
         payment.subscription = reference_payment.subscription
         
@@ -286,12 +334,14 @@ class BetterPaymentBackend(BaseBackend):
         try:
             payment.save()
         except Exception as e:
+            # the payment was accepted by the provider, so it must be recorded manually
             logger.critical('Payments: Payment object could not be saved for a recurring payment!', extra={'internal_transaction_id': payment.internal_transaction_id, 'order_id': order_id, 'exception': e, 'payment_data': str(payment.__dict__)})
+            raise
         
         if reference_payment.type == PAYMENT_TYPE_DIRECT_DEBIT and settings.PAYMENTS_SEPA_IS_INSTANTLY_SUCCESSFUL:
             handle_successful_payment(payment)
 
-        return payment, None
+        return payment
     
     def _make_actual_payment(self, payment_type, order_id, params, user=None, original_transaction_id=None, is_recurring=False, make_postponed=False):
         """ Execute the actual payment-making API call to betterpayment.
@@ -312,8 +362,38 @@ class BetterPaymentBackend(BaseBackend):
         """
         if make_postponed and not settings.PAYMENTS_POSTPONED_PAYMENTS_IMPLEMENTED:
             return None, _('Making postponed payments is currently not possible!')
-        else:
-            post_url = settings.PAYMENTS_BETTERPAYMENT_API_DOMAIN + BETTERPAYMENTS_API_ENDPOINT_PAYMENT
+        post_url, data = self._prepare_payment_request(payment_type, order_id, params, user=user, 
+                original_transaction_id=original_transaction_id, is_recurring=is_recurring)
+        try:
+            req = self.transport.post(post_url, data=data)
+        except RequestException as e:
+            return self._payment_request_failed(payment_type, post_url, order_id, e)
+        return self._handle_payment_response(req, post_url, data, payment_type, order_id, params, user=user, 
+                is_recurring=is_recurring, make_postponed=make_postponed)
+    
+    async def _amake_actual_payment(self, payment_type, order_id, params, user=None, original_transaction_id=None, is_recurring=False, make_postponed=False, transport=None):
+        """ Async variant of `_make_actual_payment()`. The API call is awaited, all DB access
+            is done in `sync_to_async` calls.
+            Warning: The returned `Payment` instance is *not being saved* in this method!
+            @param transport: An open `AsyncHttpTransport` shared by concurrent calls. If None,
+                a transport is opened for this call only.
+            @return: A tuple of (Payment`, None) if successful or (None, Str-error-message) """
+        if make_postponed and not settings.PAYMENTS_POSTPONED_PAYMENTS_IMPLEMENTED:
+            return None, _('Making postponed payments is currently not possible!')
+        post_url, data = await sync_to_async(self._prepare_payment_request)(payment_type, order_id, params, user=user, 
+                original_transaction_id=original_transaction_id, is_recurring=is_recurring)
+        async with self._open_async_transport(transport) as transport:
+            try:
+                req = await transport.post(post_url, data=data)
+            except transport.request_error as e:
+                return self._payment_request_failed(payment_type, post_url, order_id, e)
+        return await sync_to_async(self._handle_payment_response)(req, post_url, data, payment_type, order_id, params, user=user, 
+                is_recurring=is_recurring, make_postponed=make_postponed)
+    
+    def _prepare_payment_request(self, payment_type, order_id, params, user=None, original_transaction_id=None, is_recurring=False):
+        """ Builds the signed request data for the payment API call.
+            @return: tuple (post_url, data) """
+        post_url = settings.PAYMENTS_BETTERPAYMENT_API_DOMAIN + BETTERPAYMENTS_API_ENDPOINT_PAYMENT
         data = {
             'api_key': settings.PAYMENTS_BETTERPAYMENT_API_KEY,
             'payment_type': payment_type,
@@ -350,11 +430,19 @@ class BetterPaymentBackend(BaseBackend):
                 'customer_id': user.id,
             })
         data = self.sign_request_params_with_checksum(data)
-        
-        # do request
-        req = requests.post(post_url, data=data)
+        return post_url, data
+    
+    def _payment_request_failed(self, payment_type, post_url, order_id, exception):
+        # on a read timeout the payment may still have been booked at the provider, so this needs checking
+        logger.critical('Payments: BetterPayment Payment of type "%s" failed, request did not complete. The payment might have been processed by the provider anyways, check this manually!' % payment_type, 
+                        extra={'post_url': post_url, 'order_id': order_id, 'exception': exception})
+        return (None, _('Error: "%(error_message)s" (%(error_code)d)') % {'error_message': _('The payment provider could not be reached.'), 'error_code': -1})
+    
+    def _handle_payment_response(self, req, post_url, data, payment_type, order_id, params, user=None, is_recurring=False, make_postponed=False):
+        """ Checks and logs the response of the payment API call and creates the (unsaved) `Payment`.
+            @return: A tuple of (Payment`, None) if successful or (None, Str-error-message) """
         if not req.status_code == 200:
-            extra = {'post_url': post_url, 'status':req.status_code, 'content': req._content}
+            extra = {'post_url': post_url, 'status':req.status_code, 'content': req.content}
             logger.error('Payments: BetterPayment Payment of type "%s" failed, request did not return status=200.' % payment_type, extra=extra)
             return (None, _('Error: "%(error_message)s" (%(error_code)d)') % {'error_message': _('The payment provider could not be reached.'), 'error_code': -1})
         
@@ -365,8 +453,8 @@ class BetterPaymentBackend(BaseBackend):
             'user': user.id if user else 'None',
             'order_id': order_id,
         })
-        TransactionLog.objects.create(
-            type=TransactionLog.TYPE_REQUEST,
+        log_transaction(
+            log_type=TransactionLog.TYPE_REQUEST,
             url=post_url,
             data=log_data
         )
@@ -403,8 +491,8 @@ class BetterPaymentBackend(BaseBackend):
                     'TYPE': 'SPECIAL ERROR DEBUG',
                     'order_id': order_id
                 })
-                TransactionLog.objects.create(
-                    type=TransactionLog.TYPE_REQUEST,
+                log_transaction(
+                    log_type=TransactionLog.TYPE_REQUEST,
                     url=post_url,
                     data=special_data
                 )
@@ -526,129 +614,244 @@ class BetterPaymentBackend(BaseBackend):
         
             Always save the data, and if it could be handled in a proper way, return a 200.
             Otherwise return a different status.
+            Copies of an already handled postback, which the provider re-sends e.g. after a timeout,
+            are answered with a 200 right away (see `PostbackDeduplicator`).
             @return: True if a 200 should be returned and the data was handled properly,
                         False if a 404 should be returned so the postback will be posted again """
         if self._validate_incoming_checksum(params, 'postback'):
-            # drop sensitive data from postback
-            params = _strip_sensitive_data(params)
-            try:
-                TransactionLog.objects.create(
-                    type=TransactionLog.TYPE_POSTBACK,
+            deduplicator = get_postback_deduplicator()
+            dedup_key = deduplicator.make_key(params)
+            if deduplicator.is_handled(dedup_key):
+                increment('postback.duplicates')
+                return True
+            handled = self._handle_validated_postback(params)
+            if handled:
+                deduplicator.mark_handled(dedup_key)
+            return handled
+        return False
+    
+    def _handle_validated_postback(self, params):
+        # drop sensitive data from postback
+        params = _strip_sensitive_data(params)
+        try:
+            log_transaction(
+                log_type=TransactionLog.TYPE_POSTBACK,
+                data=params,
+            )
+        except Exception as e:
+            logger.error('Payments: Error during postback processing! Postbacked data could not be saved!', 
+                         extra={'params': params, 'exception': e})
+        
+        try:
+            missing_params = [param for param in ['transaction_id', 'order_id', 'status_code'] if param not in params]
+            if missing_params:
+                logger.error('BetterPayments Postback: Missing parameters: [%s]. Could not handle postback!' % ', '.join(missing_params), extra={'params': params})
+                return False
+            
+            if settings.PAYMENTS_POSTBACK_ASYNC:
+                # park the postback and answer right away. it is applied in order with the other postbacks
+                # of its order by a postback worker, once this request's transaction has been committed
+                order_id = params['order_id']
+                PendingPostback.objects.create(
+                    order_id=order_id,
+                    transaction_id=params['transaction_id'],
                     data=params,
+                    reason=PendingPostback.REASON_1_QUEUED,
                 )
-            except Exception as e:
-                logger.error('Payments: Error during postback processing! Postbacked data could not be saved!', 
-                             extra={'params': params, 'exception': e})
+                transaction.on_commit(lambda: self.queue_postback_processing(order_id))
+                return True
             
-            try:
-                missing_params = [param for param in ['transaction_id', 'order_id', 'status_code'] if param not in params]
-                if missing_params:
-                    logger.error('BetterPayments Postback: Missing parameters: [%s]. Could not handle postback!' % ', '.join(missing_params), extra={'params': params})
-                    return False
-                
-                # find referenced payment
-                payment = get_object_or_None(Payment, 
-                    vendor_transaction_id=params['transaction_id'],
-                    internal_transaction_id=params['order_id']
+            # find referenced payment
+            payment = get_object_or_None(Payment, 
+                vendor_transaction_id=params['transaction_id'],
+                internal_transaction_id=params['order_id']
+            )
+            if payment is None:
+                # sometimes, the returning postback for a transaction is actually faster than
+                # our DB can save the payment! instead of waiting for it, we park the postback
+                # and answer it right away. it will be applied once the payment has been saved.
+                PendingPostback.objects.create(
+                    order_id=params['order_id'],
+                    transaction_id=params['transaction_id'],
+                    data=params,
                 )
+                logger.info('BetterPayments Postback: Could not match a Payment object for given Postback yet, deferred it for reconciliation.', 
+                            extra={'params': params})
+                return True
+            return self._apply_postback(payment, params)
+        except Exception as e:
+            logger.error('Payments: Error during postback processing! Postbacked data was saved, but payment status could not be updated!', extra={'params': params, 'exception': e})
+            return False
+    
+    def _apply_postback(self, payment, params):
+        """ Applies the status of a validated postback to its matched payment.
+            @return: True if the postback was handled and should be answered with a 200 """
+        # Transaction Statuses see https://testdashboard.betterpayment.de/docs/#transaction-statuses
+        status = int(params['status_code'])
+        if status in [self.BETTERPAYMENT_STATUS_STARTED, self.BETTERPAYMENT_STATUS_PENDING]:
+            # case 'started', 'pending': no further action required, we are waiting for the transaction to complete
+            return True
+        elif status == self.BETTERPAYMENT_STATUS_SUCCESS and payment.status == Payment.STATUS_PAID:
+            # got a postback on an already paid Payment, so we do not do anything
+            logger.info('Payments: Received a postback for a successful payment, but the payment\'s status was already PAID!', 
+                        extra={'betterpayment_status_code': status, 'internal_transaction_id': payment.internal_transaction_id, 'vendor_transaction_id': payment.vendor_transaction_id})
+            return True
+        elif status == self.BETTERPAYMENT_STATUS_SUCCESS:
+            # case 'succcess': the payment was successful, update the Payment and start a subscription
+            # depending on `is_postponed_payment` and the payment.status, switch states here to preauthorized or paid!
+            if settings.PAYMENTS_POSTPONED_PAYMENTS_IMPLEMENTED and payment.is_postponed_payment:
+                # TODO: incomplete logic for postponed payments
+                if payment.status in [Payment.STATUS_STARTED, Payment.STATUS_COMPLETED_BUT_UNCONFIRMED]:
+                    payment.status = Payment.STATUS_PREAUTHORIZED_UNPAID
+                    # create_new_subscription = True
+                    # TODO incomplete: create new subscription here!
+                elif payment.status == Payment.STATUS_PREAUTHORIZED_UNPAID:
+                    payment.status = Payment.STATUS_PAID
+                    payment.completed_at = now()
+                    # we do not change our subscription here because one should already have been created
+                    # at the time of pre-authorization for this payment
+                payment.save()
+                # TODO: incomplete!
+            else:
+                # regular success handling 
+                payment.status = Payment.STATUS_PAID
+                payment.completed_at = now()
+                logger.info('Payments: Received a status "paid" postback for a successful payment of type "%s"' % payment.type,
+                    extra={'user': payment.user.id, 'order_id': payment.internal_transaction_id})
+                payment.save()
+                handle_successful_payment(payment)
+            return True
+        elif status == self.BETTERPAYMENT_STATUS_CANCELED:
+            # case 'error', 'canceled', 'declined': mark the payment as canceled. no further action is required.
+            payment.status = Payment.STATUS_CANCELED
+            payment.save()
+            return True
+        elif status in [self.BETTERPAYMENT_STATUS_ERROR, self.BETTERPAYMENT_STATUS_DECLINED]:
+            # case 'error', 'declined': mark the payment as failed
+            payment.status = Payment.STATUS_FAILED
+            payment.save()
+            logger.info('Payments: Received a status "error" or "declined" postback for a payment.',
+                extra={'user': payment.user.id, 'order_id': payment.internal_transaction_id})
+            # if the payment is a recurring one, we take the safe route and suspend the 
+            # subscription. we do NOT want to cause multiple failed booking attempts on a user's account
+            if not payment.is_reference_payment:
+                if payment.subscription:
+                    suspend_failed_subscription(payment.subscription, payment=payment)
+                else:
+                    logger.critical('Payments: Received a status "error" or "declined" postback for a non-reference payment without attached subscription! The subscription for this payment must be found manually and canceled!',
+                            extra={'user': payment.user.id, 'order_id': payment.internal_transaction_id})
+            elif payment.subscription:
+                # if it was a first payment, set the subscription to state ended
+                # TODO: should we inform the user that the payment failed? 
+                # send_payment_event_payment_email(payment)
+                payment.subscription.state = Subscription.STATE_0_TERMINATED
+                payment.subscription.save()
+            else:
+                logger.info('Payments: Received a status "error" or "declined" postback for a payment without attached subscription, so just cancelling the payment.',
+                            extra={'user': payment.user.id, 'order_id': payment.internal_transaction_id})
+            return True
+        elif status in [self.BETTERPAYMENT_STATUS_REFUNDED, self.BETTERPAYMENT_STATUS_CHARGEBACK]:
+            # on a chargeback, immediately suspend the subscription to stop any further transactions. 
+            # we also send out an admin mail, because in this case we have to manually retract a bill
+            # in our accounting system 
+            payment.status = Payment.STATUS_RETRACTED
+            payment.save()
+            handle_payment_refunded(payment, status)
+            return True
+        else:
+            # we do not know what to do with this status
+            logger.critical('NYI: Received postback with a status we cannot handle (Status: %d)!' % status, extra={'betterpayment_status_code': status, 'internal_transaction_id': payment.internal_transaction_id, 'vendor_transaction_id': payment.vendor_transaction_id})
+            return True
+    
+    def reconcile_pending_postbacks(self, order_id=None):
+        """ Applies deferred postbacks to their payments, once these have been saved.
+            Each pending postback is claimed before it is applied, so concurrent reconciliations
+            never apply the same postback twice. Postbacks that still cannot be matched or applied are
+            retried later, with a delay that doubles with each attempt. The postbacks of an order are
+            applied in the order they came in: while one of them waits for its retry, the later ones wait as well.
+            @param order_id: If given, only the pending postbacks for this order id are reconciled
+                (regardless of their retry delay). Otherwise, all postbacks due for a retry are.
+            @return: The number of postbacks that were applied """
+        pending_postbacks = PendingPostback.objects.filter(processed_at__isnull=True,
+                    attempts__lt=settings.PAYMENTS_POSTBACK_RECONCILE_MAX_ATTEMPTS)
+        if order_id is not None:
+            pending_postbacks = pending_postbacks.filter(order_id=order_id)
+        else:
+            pending_postbacks = pending_postbacks.filter(next_attempt_at__lte=now())
+        
+        applied = 0
+        # orders with a postback that waits for its retry
+        stopped_order_ids = set()
+        # the mails of all applied postbacks are sent over one mail connection, and their transaction logs
+        # are written after the transactions
+        with buffered_transaction_logs(), batched_payment_emails():
+            for pending_postback in pending_postbacks.order_by('id'):
+                params = pending_postback.data
+                if pending_postback.order_id in stopped_order_ids:
+                    continue
+                success = False
+                with transaction.atomic():
+                    # the lock on the payment makes sure that the postbacks of an order are applied one after another,
+                    # even by different processes. as they are handled by id, they are applied in the order they came in
+                    payment = Payment.objects.select_for_update().filter(
+                        vendor_transaction_id=pending_postback.transaction_id,
+                        internal_transaction_id=pending_postback.order_id
+                    ).first()
+                    # an earlier postback of the order that waits for its retry must be applied first
+                    if PendingPostback.objects.filter(order_id=pending_postback.order_id, processed_at__isnull=True,
+                            attempts__lt=settings.PAYMENTS_POSTBACK_RECONCILE_MAX_ATTEMPTS, id__lt=pending_postback.id).exists():
+                        stopped_order_ids.add(pending_postback.order_id)
+                        continue
+                    # claim the postback by marking it as processed
+                    claimed = PendingPostback.objects.filter(id=pending_postback.id, processed_at__isnull=True)\
+                            .update(processed_at=now())
+                    if not claimed:
+                        continue
+                    try:
+                        if payment is not None:
+                            with transaction.atomic():
+                                success = self._apply_postback(payment, params)
+                    except Exception as e:
+                        logger.error('Payments: Error during reconciliation of a deferred postback! Payment status could not be updated!', 
+                                     extra={'params': params, 'exception': e})
+                    if success:
+                        applied += 1
+                        continue
                 
-                if payment is None:
-                    # sometimes, the returning postback for a transaction is actually faster than
-                    # our DB can save the payment! we wait for 5 seconds and retry.
-                    time.sleep(10)
-                    # find referenced payment again
-                    # TODO: why does this often still fail after 10 secs of sleeping?
-                    payment = get_object_or_None(Payment, 
-                        vendor_transaction_id=params['transaction_id'],
-                        internal_transaction_id=params['order_id']
+                    # release the claim and schedule the next attempt. the later postbacks of the order wait for it
+                    stopped_order_ids.add(pending_postback.order_id)
+                    attempts = pending_postback.attempts + 1
+                    retry_minutes = settings.PAYMENTS_POSTBACK_RECONCILE_RETRY_MINUTES * (2 ** pending_postback.attempts)
+                    PendingPostback.objects.filter(id=pending_postback.id).update(
+                        processed_at=None,
+                        attempts=F('attempts') + 1,
+                        next_attempt_at=now() + timedelta(minutes=retry_minutes),
                     )
-                    if payment is None:
-                        # after waiting and retrying, we give up and error out.
-                        # since we return a non-success here, it will be posted again though.
-                        logger.error('BetterPayments Postback: Could not match a Payment object for given Postback! The postback was possibly too fast for us to save the payment object.', 
-                                     extra={'params': params})
-                        return False
-                
-                # Transaction Statuses see https://testdashboard.betterpayment.de/docs/#transaction-statuses
-                status = int(params['status_code'])
-                if status in [self.BETTERPAYMENT_STATUS_STARTED, self.BETTERPAYMENT_STATUS_PENDING]:
-                    # case 'started', 'pending': no further action required, we are waiting for the transaction to complete
-                    return True
-                elif status == self.BETTERPAYMENT_STATUS_SUCCESS and payment.status == Payment.STATUS_PAID:
-                    # got a postback on an already paid Payment, so we do not do anything
-                    logger.info('Payments: Received a postback for a successful payment, but the payment\'s status was already PAID!', 
-                                extra={'betterpayment_status_code': status, 'internal_transaction_id': payment.internal_transaction_id, 'vendor_transaction_id': payment.vendor_transaction_id})
-                    return True
-                elif status == self.BETTERPAYMENT_STATUS_SUCCESS:
-                    # case 'succcess': the payment was successful, update the Payment and start a subscription
-                    # depending on `is_postponed_payment` and the payment.status, switch states here to preauthorized or paid!
-                    if settings.PAYMENTS_POSTPONED_PAYMENTS_IMPLEMENTED and payment.is_postponed_payment:
-                        # TODO: incomplete logic for postponed payments
-                        if payment.status in [Payment.STATUS_STARTED, Payment.STATUS_COMPLETED_BUT_UNCONFIRMED]:
-                            payment.status = Payment.STATUS_PREAUTHORIZED_UNPAID
-                            # create_new_subscription = True
-                            # TODO incomplete: create new subscription here!
-                        elif payment.status == Payment.STATUS_PREAUTHORIZED_UNPAID:
-                            payment.status = Payment.STATUS_PAID
-                            payment.completed_at = now()
-                            # we do not change our subscription here because one should already have been created
-                            # at the time of pre-authorization for this payment
-                        payment.save()
-                        # TODO: incomplete!
-                    else:
-                        # regular success handling 
-                        payment.status = Payment.STATUS_PAID
-                        payment.completed_at = now()
-                        logger.info('Payments: Received a status "paid" postback for a successful payment of type "%s"' % payment.type,
-                            extra={'user': payment.user.id, 'order_id': payment.internal_transaction_id})
-                        payment.save()
-                        handle_successful_payment(payment)
-                    return True
-                elif status == self.BETTERPAYMENT_STATUS_CANCELED:
-                    # case 'error', 'canceled', 'declined': mark the payment as canceled. no further action is required.
-                    payment.status = Payment.STATUS_CANCELED
-                    payment.save()
-                    return True
-                elif status in [self.BETTERPAYMENT_STATUS_ERROR, self.BETTERPAYMENT_STATUS_DECLINED]:
-                    # case 'error', 'declined': mark the payment as failed
-                    payment.status = Payment.STATUS_FAILED
-                    payment.save()
-                    logger.info('Payments: Received a status "error" or "declined" postback for a payment.',
-                        extra={'user': payment.user.id, 'order_id': payment.internal_transaction_id})
-                    # if the payment is a recurring one, we take the safe route and suspend the 
-                    # subscription. we do NOT want to cause multiple failed booking attempts on a user's account
-                    if not payment.is_reference_payment:
-                        if payment.subscription:
-                            suspend_failed_subscription(payment.subscription, payment=payment)
-                        else:
-                            logger.critical('Payments: Received a status "error" or "declined" postback for a non-reference payment without attached subscription! The subscription for this payment must be found manually and canceled!',
-                                    extra={'user': payment.user.id, 'order_id': payment.internal_transaction_id})
-                    elif payment.subscription:
-                        # if it was a first payment, set the subscription to state ended
-                        # TODO: should we inform the user that the payment failed? 
-                        # send_payment_event_payment_email(payment)
-                        payment.subscription.state = Subscription.STATE_0_TERMINATED
-                        payment.subscription.save()
-                    else:
-                        logger.info('Payments: Received a status "error" or "declined" postback for a payment without attached subscription, so just cancelling the payment.',
-                                    extra={'user': payment.user.id, 'order_id': payment.internal_transaction_id})
-                    return True
-                elif status in [self.BETTERPAYMENT_STATUS_REFUNDED, self.BETTERPAYMENT_STATUS_CHARGEBACK]:
-                    # on a chargeback, immediately suspend the subscription to stop any further transactions. 
-                    # we also send out an admin mail, because in this case we have to manually retract a bill
-                    # in our accounting system 
-                    payment.status = Payment.STATUS_RETRACTED
-                    payment.save()
-                    handle_payment_refunded(payment, status)
-                    return True
-                else:
-                    # we do not know what to do with this status
-                    logger.critical('NYI: Received postback with a status we cannot handle (Status: %d)!' % status, extra={'betterpayment_status_code': status, 'internal_transaction_id': payment.internal_transaction_id, 'vendor_transaction_id': payment.vendor_transaction_id})
-                    return True
-            except Exception as e:
-                logger.error('Payments: Error during postback processing! Postbacked data was saved, but payment status could not be updated!', extra={'params': params, 'exception': e})
-                return False
-        return False
+                if attempts >= settings.PAYMENTS_POSTBACK_RECONCILE_MAX_ATTEMPTS:
+                    logger.critical('BetterPayments Postback: Giving up on a deferred postback that could not be matched to a Payment object or applied! This needs to be investigated manually!', 
+                                    extra={'params': params, 'pending_postback_id': pending_postback.id, 'attempts': attempts})
+        return applied
+    
+    def queue_postback_processing(self, order_id):
+        """ Hands the parked postbacks of an order to a postback worker of this process. If there are no workers
+            or the queue is full, they are applied by the `process_pending_postbacks` command or the reconciliation cron. """
+        work_queue = get_postback_work_queue()
+        if work_queue is not None:
+            # while a job for the order is queued or running, no other one is started for it
+            work_queue.submit(('postbacks', order_id), self.process_queued_postbacks, order_id)
+    
+    def process_queued_postbacks(self, order_id):
+        """ Applies all new parked postbacks of an order. Postbacks that were parked while this runs are
+            picked up as well, so none are left behind by the deduplication of the work queue. This is repeated
+            at most `PAYMENTS_POSTBACK_QUEUE_MAX_ROUNDS` times, so a stream of postbacks cannot keep a worker busy.
+            Postbacks that fail (or are left over) are applied by the reconciliation cron. """
+        new_postbacks = PendingPostback.objects.filter(order_id=order_id, processed_at__isnull=True, attempts=0)
+        for __ in range(settings.PAYMENTS_POSTBACK_QUEUE_MAX_ROUNDS):
+            if not new_postbacks.exists():
+                break
+            if not self.reconcile_pending_postbacks(order_id=order_id):
+                # the remaining postbacks wait for an earlier one of the order, or for their retry
+                break
     
     def _validate_incoming_checksum(self, params, endpoint):
         """ Validates an incoming request's checksum to make sure it was not faked.
@@ -661,8 +864,8 @@ class BetterPaymentBackend(BaseBackend):
             It is recommended to verify the authenticity of the data by validating the checksum. 
             This checksum is calculated like with outgoing data, only the incoming key is used this time.
             See https://testdashboard.betterpayment.de/docs/#authentication-and-data-authenticity. """
-        valid_checksum = self.calculate_request_checksum(params, settings.PAYMENTS_BETTERPAYMENT_INCOMING_KEY)
-        if not 'checksum' in params or not params['checksum'] == valid_checksum:
+        is_valid, valid_checksum = get_checksum_signer(settings.PAYMENTS_BETTERPAYMENT_INCOMING_KEY).validate(params)
+        if not is_valid:
             params.update({'valid_checksum_should_have_been': valid_checksum})
             logger.warning('Payments: Received an invalid or faked BetterPayments request on "%s". Discarding data.' % endpoint, extra=params)
             return False
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import re
+import threading
+from urllib.parse import urlparse
+
+from django.core.exceptions import ImproperlyConfigured
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from wechange_payments.conf import settings
+from wechange_payments.utils.metrics import timer, increment
+
+logger = logging.getLogger('wechange-payments')
+
+# path segments that contain an ID (UUIDs, hashes, numbers), which are replaced in metric tags
+ID_PATH_SEGMENT_RE = re.compile(r'/(?=[^/]*\d)[0-9a-fA-F-]{6,}(?=/|$)|/\d+(?=/|$)')
+
+
+def _get_request_metric_tags(method, url):
+    """ @return: dict of metric tags for a provider request, with IDs stripped from the endpoint """
+    parsed_url = urlparse(url)
+    return {
+        'method': method,
+        'host': parsed_url.netloc,
+        'endpoint': ID_PATH_SEGMENT_RE.sub('/:id', parsed_url.path),
+    }
+
+
+class HttpTransport(object):
+    """ A pooled, keep-alive HTTP transport for the provider backends.
+        Each backend holds one transport, so that all of its API calls (e.g. all payments
+        of a nightly billing run) re-use the same open connections instead of doing a new
+        TCP+TLS handshake for every request.
+
+        All requests get a connect and read timeout. Only idempotent requests (GET, HEAD, ...)
+        are retried on connection errors and gateway errors, POSTs are never retried,
+        as they might book a payment or create an invoice twice. """
+
+    def __init__(self, pool_connections=None, pool_maxsize=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None):
+        self.pool_connections = pool_connections or settings.PAYMENTS_HTTP_POOL_CONNECTIONS
+        self.pool_maxsize = pool_maxsize or settings.PAYMENTS_HTTP_POOL_MAXSIZE
+        self.connect_timeout = connect_timeout or settings.PAYMENTS_HTTP_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or settings.PAYMENTS_HTTP_READ_TIMEOUT
+        self.max_retries = settings.PAYMENTS_HTTP_MAX_RETRIES if max_retries is None else max_retries
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _make_session(self):
+        retry = Retry(
+            total=self.max_retries,
+            backoff_factor=settings.PAYMENTS_HTTP_RETRY_BACKOFF_FACTOR,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, # idempotent methods only, no POST
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @property
+    def session(self):
+        """ The shared session, created on first use. The connection pool is thread-safe,
+            so the billing worker threads can share it. """
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._make_session()
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        tags = _get_request_metric_tags(method, url)
+        with timer('provider.request', **tags):
+            response = self.session.request(method, url, **kwargs)
+        increment('provider.responses', status=response.status_code, **tags)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        """ Closes all pooled connections. The next request opens a new session. """
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+class AsyncHttpTransport(object):
+    """ The asyncio counterpart of `HttpTransport`, based on `httpx` (which only needs to be installed
+        if the async backend API is used). Besides the connection pool, it limits the number of
+        requests that are in flight at the same time, to respect the provider's rate limits.
+        
+        An `httpx.AsyncClient` is bound to the event loop it is used in, so open one transport per
+        batch of concurrent calls and close it afterwards:
+        
+            async with AsyncHttpTransport() as transport:
+                await asyncio.gather(*[backend.amake_recurring_payment(p, transport=transport) for p in payments])
+        
+        Only connection failures are retried (the request was never sent), so retries are safe for POSTs. """
+    
+    def __init__(self, max_concurrency=None, pool_maxsize=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None):
+        try:
+            import httpx
+        except ImportError:
+            raise ImproperlyConfigured('The async payment backend API requires the `httpx` package to be installed!')
+        max_concurrency = max_concurrency or settings.PAYMENTS_HTTP_ASYNC_MAX_CONCURRENCY
+        pool_maxsize = pool_maxsize or max_concurrency
+        connect_timeout = connect_timeout or settings.PAYMENTS_HTTP_CONNECT_TIMEOUT
+        read_timeout = read_timeout or settings.PAYMENTS_HTTP_READ_TIMEOUT
+        max_retries = settings.PAYMENTS_HTTP_MAX_RETRIES if max_retries is None else max_retries
+        
+        # catch this exception type around requests, like `requests.exceptions.RequestException` for `HttpTransport`
+        self.request_error = httpx.HTTPError
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        limits = httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize)
+        self._client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(limits=limits, retries=max_retries),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+    
+    async def request(self, method, url, **kwargs):
+        tags = _get_request_metric_tags(method, url)
+        async with self._semaphore:
+            with timer('provider.request', **tags):
+                response = await self._client.request(method, url, **kwargs)
+        increment('provider.responses', status=response.status_code, **tags)
+        return response
+    
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+    
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+    
+    async def aclose(self):
+        await self._client.aclose()
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
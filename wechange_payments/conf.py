@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from builtins import object
+import logging
+
 from django.conf import settings  # noqa
 
 from appconf import AppConf
@@ -80,6 +82,13 @@ class WechangePaymentsDefaultSettings(AppConf):
     PRE_NOTIFICATION_BEFORE_PAYMENT_DAYS = 10
     # should the payment popup show a "no thanks" button to dismiss it?
     POPUP_SHOW_NO_THANKS_BUTTON = False
+    # how many seconds the per-user "popup suppressed until" deadline for members of premium conferences is cached.
+    # it is invalidated when the user's memberships or any premium conference change
+    POPUP_SUPPRESSED_UNTIL_CACHE_SECONDS = 60 * 60 * 24
+    # if set, a user's subscription state (shown on every page) is cached for this many seconds.
+    # it is invalidated whenever a change to one of the user's subscriptions is committed. 0 disables the cache,
+    # the state is then still only loaded once per request
+    SUBSCRIPTION_STATE_CACHE_SECONDS = 0
     
     # should SEPA payments be treated as instantly paid, or wait for a success postback from betterpayments?
     # all signs for betterpayment point to "yes"
@@ -90,6 +99,79 @@ class WechangePaymentsDefaultSettings(AppConf):
     # the user tries to access their unretrieved invoice, or with a gather-all-missing cronjob
     INVOICE_PROVIDER_RETRY_MINUTES = 5
     
+    # the `GenerateMissingInvoices` cronjob runs each invoice API step (create, finalize, download)
+    # for all missing invoices, using this many worker threads
+    INVOICE_PIPELINE_MAX_WORKERS = 4
+    # the number of invoices that are handed to a worker thread at once
+    INVOICE_PIPELINE_CHUNK_SIZE = 20
+    # invoices created after a payment (or from the admin) are generated in the background by a
+    # process-wide work queue with this many worker threads (each uses its own DB connection)
+    INVOICE_QUEUE_MAX_WORKERS = 2
+    # the maximum number of invoice jobs waiting in the queue. further jobs are dropped and the
+    # invoices are generated later by the `GenerateMissingInvoices` cronjob
+    INVOICE_QUEUE_MAX_QUEUED = 500
+    
+    # invoice downloads can be handed to the front proxy, which then streams the file itself:
+    # None (the file is streamed by the app), 'x-accel-redirect' (nginx) or 'x-sendfile' (apache, lighttpd).
+    # 'x-sendfile' needs a filesystem storage, with other storages the file is streamed by the app
+    INVOICE_DOWNLOAD_OFFLOAD = None
+    # for 'x-accel-redirect': the internal nginx location that serves the files of the invoice storage.
+    # the file's storage name is appended to it
+    INVOICE_DOWNLOAD_X_ACCEL_LOCATION = '/protected-media/'
+    # browsers may reuse a downloaded invoice for this many seconds before revalidating it with its ETag
+    INVOICE_DOWNLOAD_MAX_AGE = 60 * 60 * 24
+    
+    # invoice files are stored once per content as `InvoiceBlob`. the files of blobs created more than this
+    # many days ago are gzip-compressed by the `maintain_invoice_blobs` command. None disables compression
+    INVOICE_BLOB_COMPRESS_AFTER_DAYS = 365
+    # a blob file is only kept compressed if that saves at least this fraction of its size
+    INVOICE_BLOB_COMPRESSION_MIN_SAVING = 0.1
+    # unreferenced files in the invoice folders are only deleted by `maintain_invoice_blobs` if they
+    # are older than this many hours, so files of invoices that are just being downloaded are kept
+    INVOICE_BLOB_GC_GRACE_HOURS = 24
+    
+    # transaction logs older than this many days are moved to gzipped JSONL archive files
+    # by the `archive_transaction_logs` management command
+    TRANSACTION_LOG_RETENTION_DAYS = 365
+    # the directory the transaction log archive files are written to. if None, the
+    # `archive_transaction_logs` command requires the `--output-dir` argument
+    TRANSACTION_LOG_ARCHIVE_DIR = None
+    # if True, transaction logs made during a request or a billing chunk are buffered and written
+    # together with a single bulk insert at its end, instead of one insert per provider API call
+    TRANSACTION_LOG_BUFFERED = True
+    # the maximum number of buffered transaction logs before they are written early
+    TRANSACTION_LOG_BUFFER_SIZE = 100
+    # transaction logs that could not be written to the DB are appended to this file as JSON lines.
+    # if None, they are only logged as critical errors
+    TRANSACTION_LOG_FALLBACK_FILE = None
+    
+    # postbacks that arrive before their payment was saved are deferred and reconciled later.
+    # this is the delay in minutes before the first retry, which doubles with each further attempt
+    POSTBACK_RECONCILE_RETRY_MINUTES = 1
+    # after how many failed reconciliation attempts we give up on a deferred postback (and log it as critical)
+    POSTBACK_RECONCILE_MAX_ATTEMPTS = 12
+    # if True, the postback endpoint only validates a postback, parks it as `PendingPostback` and answers it.
+    # the payment state changes (subscriptions, invoices, mails) are then applied by background workers,
+    # in order for each order id
+    POSTBACK_ASYNC = False
+    # the number of worker threads per server process that apply parked postbacks. if 0, they are only
+    # applied by the `process_pending_postbacks` command or the reconciliation cron
+    POSTBACK_QUEUE_MAX_WORKERS = 2
+    # the maximum number of order ids waiting for a postback worker. postbacks of further orders are
+    # applied by the `process_pending_postbacks` command or the reconciliation cron
+    POSTBACK_QUEUE_MAX_QUEUED = 500
+    # how often a postback worker looks for new postbacks of its order after applying them, before it leaves
+    # the rest to the `process_pending_postbacks` command or the reconciliation cron
+    POSTBACK_QUEUE_MAX_ROUNDS = 10
+    # handled postbacks are remembered for this many seconds by their transaction id, status code and checksum.
+    # copies re-sent by the provider are then answered right away, without any DB access. 0 disables this
+    POSTBACK_DEDUP_TTL_SECONDS = 60 * 60
+    # the maximum number of handled postbacks each server process remembers
+    POSTBACK_DEDUP_MAX_SIZE = 10000
+    # the name of a cache in `CACHES` that is shared by all server processes, to also remember the postbacks
+    # handled by other processes. if None, each process only remembers its own
+    POSTBACK_DEDUP_CACHE = None
+    
     # the default tax rate in percent to use with the invoice provider. change this for any MwSt changes!
     INVOICE_PROVIDER_TAX_RATE_PERCENT = 19
     
@@ -119,7 +201,18 @@ class WechangePaymentsDefaultSettings(AppConf):
     # if the current portal's slug matches one in the list.
     # if it is empty, the cron will run without portal restriction
     CRON_ENABLED_FOR_SPECIFIC_PORTAL_SLUGS_ONLY = []
-    
+
+    # the number of due subscriptions that are handed to a billing worker at once
+    BILLING_CHUNK_SIZE = 100
+    # the maximum number of worker threads that book due subscription payments in parallel.
+    # each worker uses its own DB connection, so keep this well below the DB connection limit.
+    # set to 1 to process all subscriptions in the cron's own thread
+    BILLING_MAX_WORKERS = 4
+    # if True, each billing worker books the due payments of its chunk concurrently, using the
+    # async backend API (requires `httpx`). no transaction is held open during the payment requests,
+    # the result of each is saved in its own transaction. not used while postponed payments are implemented
+    BILLING_ASYNC = False
+
     """ Test System settings """
     
     # if True, enables additional views for payments
@@ -135,6 +228,44 @@ class WechangePaymentsDefaultSettings(AppConf):
     BETTERPAYMENT_INCOMING_KEY = ''
     BETTERPAYMENT_OUTGOING_KEY = ''
     BETTERPAYMENT_API_DOMAIN = ''
+    
+    """ Provider HTTP transport settings """
+    
+    # each payment and invoice backend keeps a pool of open keep-alive connections to its provider.
+    # the number of hosts to keep connection pools for
+    HTTP_POOL_CONNECTIONS = 4
+    # the number of connections kept open per host. should be at least `PAYMENTS_BILLING_MAX_WORKERS`
+    HTTP_POOL_MAXSIZE = 10
+    # seconds to wait for a connection to a provider to be established
+    HTTP_CONNECT_TIMEOUT = 5
+    # seconds to wait for a provider's response. keep this generous, a timed out payment request
+    # might still have been booked by the provider
+    HTTP_READ_TIMEOUT = 30
+    # how often idempotent requests (GET) are retried on connection errors or 502/503/504 responses.
+    # POST requests are never retried
+    HTTP_MAX_RETRIES = 3
+    # the backoff factor between retries (0.5 means sleeping 0.5s, 1s, 2s, ...)
+    HTTP_RETRY_BACKOFF_FACTOR = 0.5
+    # the maximum number of concurrent provider requests of the async backend API (see `PAYMENTS_BILLING_ASYNC`).
+    # make sure this respects the provider's rate limits
+    HTTP_ASYNC_MAX_CONCURRENCY = 20
+    
+    """ Instrumentation settings """
+    
+    # dotted paths of the metrics sinks that receive the timings and counters of provider API calls,
+    # payment DB writes, views and cron phases. an empty list disables the instrumentation.
+    # available: `wechange_payments.utils.metrics.LoggingSink`, `...StatsdSink`, `...PrometheusSink`
+    METRICS_SINKS = []
+    # the prefix of all metric names
+    METRICS_PREFIX = 'wechange_payments'
+    # the log level of the `LoggingSink`
+    METRICS_LOG_LEVEL = logging.INFO
+    # the statsd daemon the `StatsdSink` sends UDP packets to
+    METRICS_STATSD_HOST = '127.0.0.1'
+    METRICS_STATSD_PORT = 8125
+    # if set, the metrics endpoint of the `PrometheusSink` can be scraped with an
+    # "Authorization: Bearer <token>" header. otherwise only superusers can access it
+    METRICS_ENDPOINT_TOKEN = None
 
     # the auth data parameters for the configured invoice backend
     # should only be defined in .env
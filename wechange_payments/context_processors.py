@@ -3,19 +3,23 @@ from datetime import timedelta
 import logging
 
 from dateutil import parser
+from django.core.cache import cache
+from django.db.models import Max, Q
 from django.utils.timezone import now
 
 from cosinnus.core.middleware.cosinnus_middleware import LOGIN_URLS
 from cosinnus.models.group import CosinnusPortal
 from wechange_payments.conf import settings
-from wechange_payments.models import Subscription,\
+from wechange_payments.models import UserSubscriptionState,\
     USERPROFILE_SETTING_POPUP_CLOSED, USERPROFILE_SETTING_POPUP_CLOSED_TIMES,\
     USERPROFILE_SETTING_POPUP_USER_IS_NEW
+from wechange_payments.utils.metrics import instrumented
 from cosinnus.utils.group import get_cosinnus_group_model
 
 
 logger = logging.getLogger('wechange-payments')
 
+@instrumented('context_processor.current_subscription')
 def current_subscription(request):
     # enabled only if payments are enabled
     if not getattr(settings, 'COSINNUS_PAYMENTS_ENABLED', False) and not \
@@ -24,8 +28,9 @@ def current_subscription(request):
     
     context = dict()
     
-    current_subscription = Subscription.get_current_for_user(request.user)
-    suspended_subscription = Subscription.get_suspended_for_user(request.user)
+    subscription_state = UserSubscriptionState.for_request(request)
+    current_subscription = subscription_state.current
+    suspended_subscription = subscription_state.suspended
     context.update({
         'current_subscription': current_subscription,
         'suspended_subscription': suspended_subscription,
@@ -46,25 +51,9 @@ def current_subscription(request):
                     # if the user would be shown a payments popup, but they are in any premium conference
                     # that is younger than 1y, we postpone their nag-popup time by 1y after the conference ends
                     if settings.COSINNUS_CONFERENCES_ENABLED:
-                        from cosinnus.models.conference import CosinnusConferencePremiumBlock
-                        premium_conference_delay = timedelta(weeks=52)
-                        
-                        user_group_ids = get_cosinnus_group_model().objects.get_for_user_pks(request.user)
-                        blocks_from_user_groups = CosinnusConferencePremiumBlock.objects.filter(conference__id__in=user_group_ids)
-                        block_group_ids = list(set(blocks_from_user_groups.values_list('conference_id', flat=True)))
-                        permanently_premium_groups = get_cosinnus_group_model().objects.filter(id__in=user_group_ids, is_premium_permanently=True)
-                        permanently_premium_group_ids = list(set(permanently_premium_groups.values_list('id', flat=True)))
-                        
-                        sorted_premium_groups = get_cosinnus_group_model().objects.filter(id__in=block_group_ids+permanently_premium_group_ids)\
-                                .filter(to_date__gte=now()-premium_conference_delay).order_by('-to_date')
-                        if sorted_premium_groups.count() > 0:
-                            # a premium group of less than year's end date exists, postpone for the newest
+                        suppressed_until = get_popup_suppressed_until(request.user)
+                        if suppressed_until is not None and now() <= suppressed_until:
                             do_add_popup = False
-                            postpone_date = (sorted_premium_groups[0].to_date + premium_conference_delay) - timedelta(days=settings.PAYMENTS_POPUP_SHOW_AGAIN_DAYS)
-                            # snooze popup into the future
-                            profile = request.user.cosinnus_profile
-                            profile.settings[USERPROFILE_SETTING_POPUP_CLOSED] = str(postpone_date)
-                            profile.save(update_fields=['settings'])
                             
                     if do_add_popup:
                         context.update({
@@ -79,3 +68,57 @@ def current_subscription(request):
                 raise
     
     return context
+
+
+# how long a premium conference suppresses the payment popup after the conference ended
+PREMIUM_CONFERENCE_POPUP_DELAY = timedelta(weeks=52)
+
+POPUP_SUPPRESSED_UNTIL_CACHE_KEY = 'wechange_payments/popup_suppressed_until/%d/%d' # generation, user id
+POPUP_SUPPRESSED_UNTIL_GENERATION_CACHE_KEY = 'wechange_payments/popup_suppressed_until/generation'
+# cached value for users who are in no premium conference
+_NOT_SUPPRESSED = 'none'
+
+
+def get_popup_suppressed_until(user):
+    """ Returns the datetime until which the payment popup is suppressed for a user because they
+        are a member of a premium conference (one year after the newest conference's end), or None.
+        The deadline is cached per user. It is invalidated when the user's memberships change, and for
+        all users when any premium block or group changes (see `invalidate_popup_suppressed_until()`). """
+    cache_key = POPUP_SUPPRESSED_UNTIL_CACHE_KEY % (_get_popup_suppressed_until_generation(), user.id)
+    suppressed_until = cache.get(cache_key)
+    if suppressed_until is None:
+        suppressed_until = _compute_popup_suppressed_until(user) or _NOT_SUPPRESSED
+        cache.set(cache_key, suppressed_until, settings.PAYMENTS_POPUP_SUPPRESSED_UNTIL_CACHE_SECONDS)
+    if suppressed_until == _NOT_SUPPRESSED:
+        return None
+    return suppressed_until
+
+
+def invalidate_popup_suppressed_until(user_id=None):
+    """ Drops the cached popup deadline of a user, or of all users if no user id is given. """
+    if user_id is None:
+        try:
+            cache.incr(POPUP_SUPPRESSED_UNTIL_GENERATION_CACHE_KEY)
+        except ValueError:
+            # key is missing, start a new generation
+            cache.set(POPUP_SUPPRESSED_UNTIL_GENERATION_CACHE_KEY, _get_popup_suppressed_until_generation() + 1, None)
+    else:
+        cache.delete(POPUP_SUPPRESSED_UNTIL_CACHE_KEY % (_get_popup_suppressed_until_generation(), user_id))
+
+
+def _get_popup_suppressed_until_generation():
+    return cache.get_or_set(POPUP_SUPPRESSED_UNTIL_GENERATION_CACHE_KEY, 1, None)
+
+
+def _compute_popup_suppressed_until(user):
+    from cosinnus.models.conference import CosinnusConferencePremiumBlock
+    group_model = get_cosinnus_group_model()
+    user_group_ids = group_model.objects.get_for_user_pks(user)
+    blocks_from_user_groups = CosinnusConferencePremiumBlock.objects.filter(conference__id__in=user_group_ids)
+    premium_groups = group_model.objects.filter(id__in=user_group_ids)\
+            .filter(Q(id__in=blocks_from_user_groups.values('conference_id')) | Q(is_premium_permanently=True))\
+            .filter(to_date__isnull=False)
+    newest_to_date = premium_groups.aggregate(newest_to_date=Max('to_date'))['newest_to_date']
+    if newest_to_date is None:
+        return None
+    return newest_to_date + PREMIUM_CONFERENCE_POPUP_DELAY
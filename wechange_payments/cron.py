@@ -8,8 +8,9 @@ from django_cron import CronJobBase, Schedule
 from cosinnus.cron import CosinnusCronJobBase
 from wechange_payments.payment import process_due_subscription_payments
 from wechange_payments.conf import settings
-from wechange_payments.backends import get_invoice_backend, get_additional_invoice_backends
+from wechange_payments.backends import get_backend, get_invoice_backend, get_additional_invoice_backends
 from wechange_payments.models import Payment, AdditionalInvoice
+from wechange_payments.utils.metrics import instrumented
 from django.db.models import Q
 
 logger = logging.getLogger('wechange-payments')
@@ -22,6 +23,7 @@ class ProcessDueSubscriptionPayments(CosinnusCronJobBase):
     
     cosinnus_code = 'wechange_payments.process_due_subscription_payments'
     
+    @instrumented('cron.process_due_subscription_payments')
     def do(self):
         # check if a portal restriction applies for the cron
         disabled_msg = _check_cron_disabled_on_portal()
@@ -29,10 +31,14 @@ class ProcessDueSubscriptionPayments(CosinnusCronJobBase):
             return disabled_msg
         
         # process subscriptions and return counts as log
-        (ended_subscriptions, booked_subscriptions) = process_due_subscription_payments()
-        logger.info('Cron-based daily subscription payment processing finished. Details in extra.',
-                extra={'ended_subscriptions': ended_subscriptions, 'booked_subscriptions': booked_subscriptions})
-        return "End expired subs: %d. Payments for due subs: %d" % (ended_subscriptions, booked_subscriptions)
+        stats = {}
+        (ended_subscriptions, booked_subscriptions) = process_due_subscription_payments(stats=stats)
+        extra = {'ended_subscriptions': ended_subscriptions, 'booked_subscriptions': booked_subscriptions}
+        extra.update(stats)
+        logger.info('Cron-based daily subscription payment processing finished. Details in extra.', extra=extra)
+        return "End expired subs: %d. Payments for due subs: %d (of %d selected, in %d chunks, %.1fs)" \
+            % (ended_subscriptions, booked_subscriptions, stats.get('due_subscriptions', 0), 
+               stats.get('chunks', 0), stats.get('total_seconds', 0.0))
 
 
 class GenerateMissingInvoices(CosinnusCronJobBase):
@@ -45,34 +51,72 @@ class GenerateMissingInvoices(CosinnusCronJobBase):
     
     cosinnus_code = 'wechange_payments.generate_missing_invoices'
     
+    @instrumented('cron.generate_missing_invoices')
     def do(self):
         # check if a portal restriction applies for the cron
         disabled_msg = _check_cron_disabled_on_portal()
         if disabled_msg:
             return disabled_msg
         
-        successful_invoices = ''
         invoice_backend = get_invoice_backend()
-        missing_invoice_payments = Payment.objects.filter(status=Payment.STATUS_PAID).filter(
+        missing_invoice_qs = Payment.objects.filter(status=Payment.STATUS_PAID).filter(
             Q(invoice=None) | Q(invoice__is_ready=False))
-        missing_before = missing_invoice_payments.count()
+        missing_invoice_payments = list(missing_invoice_qs.select_related('invoice', 'user'))
+        missing_before = len(missing_invoice_payments)
+        
+        invoices = []
         invoices_created = 0
         for payment in missing_invoice_payments:
-            invoice_backend.create_invoice_for_payment(payment, threaded=False)
-            if payment.invoice is not None:
-                invoice = payment.invoice
-                invoices_created += 1
-                if invoice.state > invoice.STATE_0_NOT_CREATED:
-                    successful_invoices += 'Changed state of Invoice id "%s" (internal id "%s") to "%s".\n' % (invoice.id, invoice.provider_id, invoice.state)
+            try:
+                invoice = getattr(payment, 'invoice', None)
+                if invoice is None:
+                    invoice = invoice_backend.get_or_create_invoice_for_payment(payment)
+                    invoices_created += 1
+            except Exception as e:
+                logger.error('Payments: Critical: Error during (our) invoice creation: Could not create an `Invoice` instance for a Payment! This must be manually repeated!', extra={'exception': e, 'payment_internal_transaction_id': payment.internal_transaction_id})
+                if settings.DEBUG:
+                    raise
+                continue
+            invoices.append(invoice)
+        states_before = dict([(invoice.id, invoice.state) for invoice in invoices])
         
-        still_missing = Payment.objects.filter(status=Payment.STATUS_PAID).filter(Q(invoice=None) | Q(invoice__is_ready=False)).count()
-        ret_msg = "Missing: %d. Invoices generated: %d. Still missing: %d"\
-             % (missing_before, invoices_created, still_missing)
+        stats = invoice_backend.create_invoices_in_stages(invoices)
+        
+        successful_invoices = ''
+        for invoice in invoices:
+            if invoice.state > states_before[invoice.id]:
+                successful_invoices += 'Changed state of Invoice id "%s" (internal id "%s") to "%s".\n' % (invoice.id, invoice.provider_id, invoice.state)
+        # counted again, as invoices of other payments may have been completed (or new payments paid) in the meantime
+        still_missing = missing_invoice_qs.count()
+        ret_msg = "Missing: %d. Invoices generated: %d. Created at provider: %d. Finalized: %d. Downloaded: %d. Failed: %d. Still missing: %d"\
+             % (missing_before, invoices_created, stats['created'], stats['finalized'], stats['downloaded'], stats['failed'], still_missing)
         if successful_invoices:
             ret_msg += '\n\n-----------\n' + successful_invoices
         return ret_msg
 
 
+class ReconcilePendingPostbacks(CosinnusCronJobBase):
+    """ Postbacks that arrived before their payment was saved are deferred.
+        Most are applied as soon as the payment is saved, this cron retries
+        any that are left over. With `PAYMENTS_POSTBACK_ASYNC`, it also applies
+        queued postbacks that no postback worker picked up. """
+    
+    RUN_EVERY_MINS = 5
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+    
+    cosinnus_code = 'wechange_payments.reconcile_pending_postbacks'
+    
+    @instrumented('cron.reconcile_pending_postbacks')
+    def do(self):
+        # check if a portal restriction applies for the cron
+        disabled_msg = _check_cron_disabled_on_portal()
+        if disabled_msg:
+            return disabled_msg
+        
+        applied = get_backend().reconcile_pending_postbacks()
+        return "Deferred postbacks applied: %d" % applied
+
+
 def _check_cron_disabled_on_portal():
     """ If anything but False is returned, payment crons should not run on this portal """
     # check if payments are soft disabled currently
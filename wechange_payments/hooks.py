@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
+from django.core.signals import request_started, request_finished
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from wechange_payments.signals import successful_payment_made
 from wechange_payments.backends import get_invoice_backend, get_additional_invoice_backends
+from wechange_payments.models import Invoice, AdditionalInvoice, InvoiceBlob
+from wechange_payments.context_processors import invalidate_popup_suppressed_until
+from wechange_payments.utils.transaction_log import start_buffering_transaction_logs, \
+    flush_transaction_logs
+from cosinnus.utils.group import get_cosinnus_group_model
 
 import logging
 logger = logging.getLogger('wechange-payments')
@@ -16,5 +23,41 @@ def start_invoice_generation(sender, payment, **kwargs):
         additional_invoice_backend.create_invoice_for_payment(payment, threaded=True, additional_invoice=True)
 
 
-    
-                        
\ No newline at end of file
+@receiver(post_delete, sender=Invoice)
+@receiver(post_delete, sender=AdditionalInvoice)
+def release_invoice_blob(sender, instance, **kwargs):
+    """ A deleted invoice no longer references its file's `InvoiceBlob` """
+    InvoiceBlob.release(instance.blob_id)
+
+
+@receiver(post_save, sender='cosinnus.CosinnusGroupMembership')
+@receiver(post_delete, sender='cosinnus.CosinnusGroupMembership')
+def invalidate_popup_suppression_on_membership_change(sender, instance, **kwargs):
+    """ A user's premium conference memberships decide if their payment popup is suppressed """
+    invalidate_popup_suppressed_until(instance.user_id)
+
+
+@receiver(post_save, sender='cosinnus.CosinnusConferencePremiumBlock')
+@receiver(post_delete, sender='cosinnus.CosinnusConferencePremiumBlock')
+def invalidate_popup_suppression_on_premium_block_change(sender, **kwargs):
+    """ Premium blocks affect the popup of all members of their conference """
+    invalidate_popup_suppressed_until()
+
+
+@receiver(post_save, sender=get_cosinnus_group_model())
+def invalidate_popup_suppression_on_group_change(sender, instance, **kwargs):
+    """ The end date of a (potentially) premium group affects the popup of all its members """
+    if getattr(instance, 'to_date', None) or getattr(instance, 'is_premium_permanently', False):
+        invalidate_popup_suppressed_until()
+
+
+@receiver(request_started)
+def buffer_transaction_logs_during_request(sender, **kwargs):
+    """ Transaction logs made during a request are written together after the response was sent """
+    start_buffering_transaction_logs()
+
+
+@receiver(request_finished)
+def flush_transaction_logs_after_request(sender, **kwargs):
+    flush_transaction_logs(stop_buffering=True)
+
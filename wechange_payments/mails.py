@@ -2,9 +2,14 @@
 
 from wechange_payments.conf import settings, PAYMENT_TYPE_DIRECT_DEBIT
 
+from contextlib import contextmanager
 import logging
+import smtplib
+import threading
+
 from cosinnus.utils.functions import resolve_class
-from django.template.loader import render_to_string
+from django.core.mail import get_connection
+from django.template.loader import get_template
 from wechange_payments import signals
 from django.utils.translation import pgettext_lazy
 from cosinnus.models.group import CosinnusPortal
@@ -12,9 +17,17 @@ from cosinnus.templatetags.cosinnus_tags import full_name
 from django.urls.base import reverse
 from django.templatetags.l10n import localize
 from django.utils import translation
+from wechange_payments.utils.metrics import increment
 
 logger = logging.getLogger('wechange-payments')
 
+# the mail function that accepts a `connection`, so a batch can send all its mails over one connection
+DJANGO_SEND_MAIL_FUNCTION = 'django.core.mail.send_mail'
+
+MAIL_TEMPLATE = 'wechange_payments/mail/mail_base.html'
+MAIL_SUBJECT_TEMPLATE = 'wechange_payments/mail/subject_base.txt'
+MAIL_SEPA_MANDATE_TEMPLATE = 'wechange_payments/mail/sepa_mandate_partial.html'
+
 # email templates depending on payment statuses and types, see `EMAIL_TEMPLATES_STATUS_MAP`
 EMAIL_TEMPLATES_SUCCESS = {
     'wechange_payments/mail/sepa_payment_success.html',
@@ -65,96 +78,240 @@ MAIL_SUBJECT = {
 }
 
 
-def send_payment_event_payment_email(payment, event):
+def send_payment_event_payment_email(payment, event, subscription=None):
     """ Sends an email to a user for an event such ass success/errors in payments, or updates to subscriptions.
         Mail type depends on the given event.
+        If called within `batched_payment_emails()`, the mail is sent as part of that batch.
         @param payment: Always supply a payment for this function, the subscription will be taken from its
             `subscription` relation. If all you have is a subscription, supply the `subscription.last_payment`.
         @param event: one of the values of `PAYMENT_EVENTS`. 
+        @param subscription: The payment's subscription, if it is loaded already. Saves its queries.
         @return: True if the mail was successfully relayed, False or raises otherwise. 
     """
-    cur_language = translation.get_language()
+    batch = getattr(_local, 'batch', None)
+    if batch is not None:
+        return batch.send(payment, event, subscription=subscription)
+    with batched_payment_emails(report=False) as batch:
+        return batch.send(payment, event, subscription=subscription)
+
+
+def send_payment_event_payment_emails(payments, event):
+    """ Sends the mail for the given event to the users of all given payments, in one batch.
+        The users, subscriptions and reference payments are fetched along with the payments.
+        @param payments: A queryset or list of payments
+        @return: dict of the numbers of 'sent', 'failed' and 'skipped' mails """
+    from wechange_payments.models import Payment
+    payments = Payment.objects.filter(id__in=[payment.id for payment in payments]).order_by('id')\
+            .select_related('user__cosinnus_profile', 'subscription__reference_payment')
+    with batched_payment_emails() as batch:
+        for payment in payments:
+            batch.send(payment, event)
+    return batch.get_counts()
+
+
+_local = threading.local()
+
+@contextmanager
+def batched_payment_emails(report=True):
+    """ Sends all payment event mails of this block (in this thread) as one batch, see `PaymentEmailBatch`.
+        Nested blocks add their mails to the outermost one.
+        @param report: If True, the counts of the batch are logged at its end """
+    batch = getattr(_local, 'batch', None)
+    if batch is not None:
+        yield batch
+        return
+    batch = PaymentEmailBatch()
+    _local.batch = batch
     try:
-        if not payment.user:
-            logger.warning('Sending payment status message was ignored because no user was attached to the payment',
-                    extra={'payment': payment.id})
-            return 
-        if not event in PAYMENT_EVENTS:
-            logger.error('Could not send out a payment event email because the event type was unknown.',
-                    extra={'payment': payment.id})
-            return
-        user = payment.user
-        email = user.email
-        template = 'wechange_payments/mail/mail_base.html'
-        subject_template = 'wechange_payments/mail/subject_base.txt'
-        portal = CosinnusPortal.get_current()
-        
-        # switch language to user's preference language
-        translation.activate(getattr(user.cosinnus_profile, 'language', settings.LANGUAGES[0][0]))
-        
-        link_html = '[' + str(pgettext_lazy('(URL-LABEL)', 'Link')) + '](' + portal.get_domain() + '%s)'
-        mail_html = '[%s](mailto:%s)'
-        
-        # prepare all possible variables
-        sepa_mandate = None
-        iban = None
-        if payment.type == PAYMENT_TYPE_DIRECT_DEBIT:
-            reference_payment = payment.subscription.reference_payment
-            sepa_mandate = reference_payment.extra_data.get('sepa_mandate_token', None)
-            iban = reference_payment.extra_data.get('iban', None)
+        yield batch
+    finally:
+        _local.batch = None
+        batch.close()
+        if report and (batch.sent or batch.failed):
+            logger.info('Payments: Sent a batch of payment event emails.', extra=batch.get_counts())
+
+
+class PaymentEmailBatch(object):
+    """ Sends payment event mails over one shared mail connection, instead of one connection per mail.
+        The portal, the compiled templates and the translated mail texts are the same for many mails,
+        and are only loaded once per batch (per language and event for the texts). """
+    
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self._portal = None
+        self._mail_func = None
+        self._connection = None
+        self._templates = {}
+        self._language_parts = {}
+        self._event_parts = {}
+    
+    def get_counts(self):
+        return {'sent': self.sent, 'failed': self.failed, 'skipped': self.skipped}
+    
+    def _get_portal(self):
+        if self._portal is None:
+            self._portal = CosinnusPortal.get_current()
+        return self._portal
+    
+    def _get_template(self, template_name):
+        template = self._templates.get(template_name, None)
+        if template is None:
+            template = get_template(template_name)
+            self._templates[template_name] = template
+        return template
+    
+    def _get_language_parts(self, language):
+        """ The mail parts for the currently active language that are the same for all events """
+        parts = self._language_parts.get(language, None)
+        if parts is None:
+            portal = self._get_portal()
+            link_html = '[' + str(pgettext_lazy('(URL-LABEL)', 'Link')) + '](' + portal.get_domain() + '%s)'
+            mail_html = '[%s](mailto:%s)'
+            parts = {
+                'link_payment_info': link_html % reverse('wechange_payments:payment-infos'),
+                'link_invoices': link_html % reverse('wechange_payments:invoices'),
+                'link_new_payment': link_html % reverse('wechange_payments:payment'),
+                'link_payment_issues': link_html % reverse('wechange_payments:suspended-subscription'),
+                'support_email': mail_html % (portal.support_email, portal.support_email),
+                'mail_pre': str(MAIL_PRE),
+                'mail_links': str(MAIL_LINKS),
+                'mail_post': str(MAIL_POST),
+            }
+            self._language_parts[language] = parts
+        return parts
+    
+    def _get_event_parts(self, language, event):
+        """ The translated mail body and subject of an event for the currently active language """
+        key = (language, event)
+        parts = self._event_parts.get(key, None)
+        if parts is None:
+            parts = (str(MAIL_BODY.get(event)), str(MAIL_SUBJECT.get(event)))
+            self._event_parts[key] = parts
+        return parts
+    
+    def send(self, payment, event, subscription=None):
+        """ Sends the mail for an event, see `send_payment_event_payment_email()`. """
+        cur_language = translation.get_language()
+        try:
+            if not payment.user_id:
+                logger.warning('Sending payment status message was ignored because no user was attached to the payment',
+                        extra={'payment': payment.id})
+                self.skipped += 1
+                return 
+            if not event in PAYMENT_EVENTS:
+                logger.error('Could not send out a payment event email because the event type was unknown.',
+                        extra={'payment': payment.id})
+                self.skipped += 1
+                return
+            if subscription is None or subscription.id != payment.subscription_id:
+                subscription = payment.subscription
+            if subscription is not None and subscription.user_id == payment.user_id:
+                # the subscription's user may have been loaded along with its profile
+                user = subscription.user
+            else:
+                user = payment.user
+            email = user.email
+            portal = self._get_portal()
             
-        variables = {
-            'payment': payment,
-            'link_payment_info': link_html % reverse('wechange_payments:payment-infos'),
-            'link_invoices': link_html % reverse('wechange_payments:invoices'),
-            'link_new_payment': link_html % reverse('wechange_payments:payment'),
-            'link_payment_issues': link_html % reverse('wechange_payments:suspended-subscription'),
-            'portal_name': portal.name,
-            'username': full_name(payment.user),
-            'payment_amount': str(int(payment.debit_amount)),
-            'payment_debit_period': payment.get_debit_period_display(),
-            'vat_amount': str(int(settings.PAYMENTS_INVOICE_PROVIDER_TAX_RATE_PERCENT)),
-            'subscription_amount': str(int(payment.subscription.debit_amount)),
-            'subscription_debit_period': payment.subscription.get_debit_period_display(),
-            'next_debit_date': localize(payment.subscription.get_next_payment_date()),
-            'payment_method': payment.get_type_string(),
-            'support_email': mail_html % (portal.support_email, portal.support_email),
-            'sepa_mandate': sepa_mandate,
-            'iban': iban,
-            'sepa_creditor': settings.PAYMENTS_SEPA_CREDITOR_ID,
-        }
-        # compose email parts
-        data = {
-            'mail_pre': MAIL_PRE % variables,
-            'mail_links': MAIL_LINKS % variables,
-            'mail_post': MAIL_POST % variables,
-            'mail_body': MAIL_BODY.get(event) % variables,
-            'mail_subject': MAIL_SUBJECT.get(event) % variables,
-        }
-        # add SEPA mandate info to mail body for successful SEPA payment email
-        if payment.type == PAYMENT_TYPE_DIRECT_DEBIT and event == PAYMENT_EVENT_SUCCESSFUL_PAYMENT:
-            sepa_variables = {
-                'payment': payment.subscription.reference_payment,
-                'payment_amount': payment.debit_amount,  # the amount from the current payment, not the reference payment, in case it has changed since!
-                'SETTINGS': settings,
+            # switch language to user's preference language
+            language = getattr(user.cosinnus_profile, 'language', settings.LANGUAGES[0][0])
+            translation.activate(language)
+            language_parts = self._get_language_parts(language)
+            mail_body, mail_subject = self._get_event_parts(language, event)
+            
+            # prepare all possible variables
+            sepa_mandate = None
+            iban = None
+            if payment.type == PAYMENT_TYPE_DIRECT_DEBIT:
+                reference_payment = subscription.reference_payment
+                sepa_mandate = reference_payment.extra_data.get('sepa_mandate_token', None)
+                iban = reference_payment.extra_data.get('iban', None)
+                
+            variables = {
+                'payment': payment,
+                'link_payment_info': language_parts['link_payment_info'],
+                'link_invoices': language_parts['link_invoices'],
+                'link_new_payment': language_parts['link_new_payment'],
+                'link_payment_issues': language_parts['link_payment_issues'],
+                'portal_name': portal.name,
+                'username': full_name(user),
+                'payment_amount': str(int(payment.debit_amount)),
+                'payment_debit_period': payment.get_debit_period_display(),
+                'vat_amount': str(int(settings.PAYMENTS_INVOICE_PROVIDER_TAX_RATE_PERCENT)),
+                'subscription_amount': str(int(subscription.debit_amount)),
+                'subscription_debit_period': subscription.get_debit_period_display(),
+                'next_debit_date': localize(subscription.get_next_payment_date()),
+                'payment_method': payment.get_type_string(),
+                'support_email': language_parts['support_email'],
+                'sepa_mandate': sepa_mandate,
+                'iban': iban,
+                'sepa_creditor': settings.PAYMENTS_SEPA_CREDITOR_ID,
+            }
+            # compose email parts
+            data = {
+                'mail_pre': language_parts['mail_pre'] % variables,
+                'mail_links': language_parts['mail_links'] % variables,
+                'mail_post': language_parts['mail_post'] % variables,
+                'mail_body': mail_body % variables,
+                'mail_subject': mail_subject % variables,
             }
-            data['mail_body'] += '\n\n-\n\n' + render_to_string('wechange_payments/mail/sepa_mandate_partial.html', sepa_variables)
-        
-        # send mail
-        if settings.PAYMENTS_USE_HOOK_INSTEAD_OF_SEND_MAIL == True:
-            signals.success_email_sender.send(sender=payment, to_user=user, template=template, subject_template=subject_template, data=data)
-        else:
-            subject = render_to_string(subject_template, data)
-            message = render_to_string(template, data)
-            mail_func = resolve_class(settings.PAYMENTS_SEND_MAIL_FUNCTION)
-            mail_func(subject, message, settings.DEFAULT_FROM_EMAIL, [email])
-        return True
-    except Exception as e:
-        logger.warning('Payments: Sending a payment status email to the user failed!', extra={'internal_transaction_id': payment.internal_transaction_id, 'vendor_transaction_id': payment.vendor_transaction_id, 'exception': e})
-        if settings.DEBUG:
-            raise
-        return False
-        
-    # switch language back to previous
-    translation.activate(cur_language)
-    
\ No newline at end of file
+            # add SEPA mandate info to mail body for successful SEPA payment email
+            if payment.type == PAYMENT_TYPE_DIRECT_DEBIT and event == PAYMENT_EVENT_SUCCESSFUL_PAYMENT:
+                sepa_variables = {
+                    'payment': subscription.reference_payment,
+                    'payment_amount': payment.debit_amount,  # the amount from the current payment, not the reference payment, in case it has changed since!
+                    'SETTINGS': settings,
+                }
+                data['mail_body'] += '\n\n-\n\n' + self._get_template(MAIL_SEPA_MANDATE_TEMPLATE).render(sepa_variables)
+            
+            # send mail
+            if settings.PAYMENTS_USE_HOOK_INSTEAD_OF_SEND_MAIL == True:
+                signals.success_email_sender.send(sender=payment, to_user=user, template=MAIL_TEMPLATE, 
+                                                  subject_template=MAIL_SUBJECT_TEMPLATE, data=data)
+            else:
+                subject = self._get_template(MAIL_SUBJECT_TEMPLATE).render(data)
+                message = self._get_template(MAIL_TEMPLATE).render(data)
+                self._send_mail(subject, message, email)
+            self.sent += 1
+            increment('mails.sent', event=event)
+            return True
+        except Exception as e:
+            self.failed += 1
+            increment('mails.failed', event=event)
+            logger.warning('Payments: Sending a payment status email to the user failed!', extra={'internal_transaction_id': payment.internal_transaction_id, 'vendor_transaction_id': payment.vendor_transaction_id, 'exception': e})
+            if settings.DEBUG:
+                raise
+            return False
+        finally:
+            # switch language back to previous
+            if cur_language:
+                translation.activate(cur_language)
+            else:
+                translation.deactivate()
+    
+    def _send_mail(self, subject, message, email):
+        if self._mail_func is None:
+            self._mail_func = resolve_class(settings.PAYMENTS_SEND_MAIL_FUNCTION)
+        if settings.PAYMENTS_SEND_MAIL_FUNCTION != DJANGO_SEND_MAIL_FUNCTION:
+            self._mail_func(subject, message, settings.DEFAULT_FROM_EMAIL, [email])
+            return
+        if self._connection is None:
+            self._connection = get_connection()
+            self._connection.open()
+        try:
+            self._mail_func(subject, message, settings.DEFAULT_FROM_EMAIL, [email], connection=self._connection)
+        except smtplib.SMTPServerDisconnected:
+            # the server closed the idle connection between two mails. nothing was sent, so reconnect once
+            self._connection.close()
+            self._connection.open()
+            self._mail_func(subject, message, settings.DEFAULT_FROM_EMAIL, [email], connection=self._connection)
+    
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception as e:
+                logger.warning('Payments: Could not close the mail connection of a payment email batch.', extra={'exception': e})
+            self._connection = None
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+import gzip
+import json
+import logging
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.timezone import now
+
+from wechange_payments.conf import settings
+from wechange_payments.models import TransactionLog
+
+
+logger = logging.getLogger('wechange-payments')
+
+
+class Command(BaseCommand):
+    help = 'Moves transaction logs older than `PAYMENTS_TRANSACTION_LOG_RETENTION_DAYS` into a gzipped \
+            JSONL archive file (one log per line) and deletes them from the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=settings.PAYMENTS_TRANSACTION_LOG_RETENTION_DAYS,
+                            help='Archive logs created more than this many days ago.')
+        parser.add_argument('--output-dir', default=settings.PAYMENTS_TRANSACTION_LOG_ARCHIVE_DIR,
+                            help='The directory to write the archive file to.')
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help='The number of logs read and deleted at once.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the logs that would be archived.')
+
+    def handle(self, *args, **options):
+        cutoff = now() - timedelta(days=options['older_than_days'])
+        batch_size = options['batch_size']
+        old_logs = TransactionLog.objects.filter(created__lt=cutoff).order_by('id')
+
+        if options['dry_run']:
+            self.stdout.write('%d transaction logs older than %s would be archived.' % (old_logs.count(), cutoff))
+            return
+        output_dir = options['output_dir']
+        if not output_dir:
+            raise CommandError('No archive directory given. Set `PAYMENTS_TRANSACTION_LOG_ARCHIVE_DIR` or use --output-dir.')
+        os.makedirs(output_dir, exist_ok=True)
+
+        # write the archive completely before deleting anything
+        file_path = os.path.join(output_dir, 'transaction_logs_until_%s_%s.jsonl.gz'
+                                 % (cutoff.strftime('%Y%m%d'), now().strftime('%Y%m%d%H%M%S')))
+        archived = 0
+        last_archived_id = None
+        with gzip.open(file_path, 'wt', encoding='utf-8') as archive_file:
+            for log in old_logs.values('id', 'created', 'url', 'type', 'data', 'order_id', 'transaction_id', 'user_id')\
+                    .iterator(chunk_size=batch_size):
+                archive_file.write(json.dumps(log, cls=DjangoJSONEncoder) + '\n')
+                archived += 1
+                last_archived_id = log['id']
+        # the gzip file is closed (and its trailer written) now, make sure it is on disk before deleting
+        with open(file_path, 'rb') as written_file:
+            os.fsync(written_file.fileno())
+
+        if last_archived_id is None:
+            os.remove(file_path)
+            self.stdout.write('No transaction logs older than %s found.' % cutoff)
+            return
+
+        # only delete what was archived. logs are created with the current date, so no new ones can match
+        archived_logs = old_logs.filter(id__lte=last_archived_id)
+        deleted = 0
+        while True:
+            batch_ids = list(archived_logs.values_list('id', flat=True)[:batch_size])
+            if not batch_ids:
+                break
+            deleted += TransactionLog.objects.filter(id__in=batch_ids).delete()[0]
+
+        logger.info('Payments: Archived old transaction logs.',
+                    extra={'archived': archived, 'deleted': deleted, 'file_path': file_path, 'cutoff': cutoff})
+        self.stdout.write('Archived %d transaction logs to "%s" and deleted %d from the database.' % (archived, file_path, deleted))
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+from functools import wraps
+import math
+import time
+from urllib.parse import urlparse
+
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.timezone import now
+
+from cosinnus.core.middleware.cosinnus_middleware import initialize_cosinnus_after_startup
+from wechange_payments import backends
+from wechange_payments.backends.invoice.lexoffice import LexofficeInvoiceBackend
+from wechange_payments.backends.payment.betterpayments import BetterPaymentBackend
+from wechange_payments.conf import settings, PAYMENT_TYPE_DIRECT_DEBIT
+from wechange_payments.cron import GenerateMissingInvoices
+from wechange_payments.hooks import start_invoice_generation
+from wechange_payments.models import Payment, Subscription, InvoiceBlob
+from wechange_payments.payment import process_due_subscription_payments
+from wechange_payments.signals import successful_payment_made
+from wechange_payments.utils.fake_providers import FakeProviderAdapter, mount_fake_provider_adapter,\
+    FAKE_BETTERPAYMENT_API_DOMAIN, FAKE_LEXOFFICE_API_DOMAIN
+
+
+FAKE_BETTERPAYMENT_KEY = 'benchmark'
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _timed(samples, func):
+    """ Wraps `func` so that the duration of each call is appended to `samples` """
+    @wraps(func)
+    def timed_func(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            samples.append(time.monotonic() - started)
+    return timed_func
+
+
+def _percentile(samples, percent):
+    """ Nearest-rank percentile of a list of durations """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[max(0, int(math.ceil(percent / 100.0 * len(ordered))) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks subscription billing, invoice generation and postback handling against a local \
+            stand-in for the BetterPayment and Lexoffice APIs. Seeds a number of due SEPA subscriptions, \
+            runs `process_due_subscription_payments`, delivers the postbacks to the postback endpoint and \
+            runs the `GenerateMissingInvoices` cron, and reports wall time, queries per item and p50/p99 latencies. \
+            Everything is rolled back afterwards, unless --commit is given.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscriptions', type=int, default=100,
+                            help='The number of due subscriptions to seed.')
+        parser.add_argument('--latency-ms', type=float, default=50.0,
+                            help='The simulated response time of the providers.')
+        parser.add_argument('--latency-jitter-ms', type=float, default=0.0,
+                            help='A random amount of up to this many ms is added to each response time.')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='The share (0.0-1.0) of provider requests that fail with a 503.')
+        parser.add_argument('--workers', type=int, default=settings.PAYMENTS_BILLING_MAX_WORKERS,
+                            help='The number of billing and invoice worker threads. Only used with --commit, \
+                            as worker threads cannot see the uncommitted benchmark data.')
+        parser.add_argument('--confirm-by-postback', action='store_true',
+                            help='Treat SEPA payments as unconfirmed until their postback arrives, \
+                            instead of instantly successful.')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Seed for the random latencies and errors.')
+        parser.add_argument('--commit', action='store_true',
+                            help='Keep the seeded and processed data. Use on a throwaway database only!')
+
+    def handle(self, *args, **options):
+        initialize_cosinnus_after_startup()
+        workers = options['workers'] if options['commit'] else 1
+        overrides = {
+            'PAYMENTS_BETTERPAYMENT_API_DOMAIN': FAKE_BETTERPAYMENT_API_DOMAIN,
+            'PAYMENTS_BETTERPAYMENT_API_KEY': FAKE_BETTERPAYMENT_KEY,
+            'PAYMENTS_BETTERPAYMENT_INCOMING_KEY': FAKE_BETTERPAYMENT_KEY,
+            'PAYMENTS_BETTERPAYMENT_OUTGOING_KEY': FAKE_BETTERPAYMENT_KEY,
+            'PAYMENTS_SEPA_IS_INSTANTLY_SUCCESSFUL': not options['confirm_by_postback'],
+            'PAYMENTS_BILLING_ASYNC': False,
+            'PAYMENTS_BILLING_MAX_WORKERS': workers,
+            'PAYMENTS_INVOICE_PIPELINE_MAX_WORKERS': workers,
+            'EMAIL_BACKEND': 'django.core.mail.backends.locmem.EmailBackend',
+            'ALLOWED_HOSTS': list(settings.ALLOWED_HOSTS) + ['testserver'],
+        }
+        saved_backends = (backends.BACKEND, backends.INVOICE_BACKEND, backends.ADDITIONAL_INVOICE_BACKENDS)
+        # invoices are generated by the cron in their own phase, not in the background after each payment
+        successful_payment_made.disconnect(start_invoice_generation)
+        try:
+            with override_settings(**overrides):
+                self._run(options, workers)
+        finally:
+            successful_payment_made.connect(start_invoice_generation)
+            backends.BACKEND, backends.INVOICE_BACKEND, backends.ADDITIONAL_INVOICE_BACKENDS = saved_backends
+
+    def _run(self, options, workers):
+        payment_backend = BetterPaymentBackend()
+        invoice_backend = LexofficeInvoiceBackend(auth_data={
+            'api_domain': FAKE_LEXOFFICE_API_DOMAIN,
+            'api_key': FAKE_BETTERPAYMENT_KEY,
+        })
+        adapter = FakeProviderAdapter(
+            latency=options['latency_ms'] / 1000.0,
+            latency_jitter=options['latency_jitter_ms'] / 1000.0,
+            error_rate=options['error_rate'],
+            postback_signer=lambda params: dict(params, checksum=payment_backend.calculate_request_checksum(
+                params, FAKE_BETTERPAYMENT_KEY)),
+            seed=options['seed'],
+        )
+        mount_fake_provider_adapter(payment_backend.transport, adapter)
+        mount_fake_provider_adapter(invoice_backend.transport, adapter)
+        backends.BACKEND = payment_backend
+        backends.INVOICE_BACKEND = invoice_backend
+        backends.ADDITIONAL_INVOICE_BACKENDS = []
+
+        billing_samples = []
+        payment_backend.request_recurring_payment = _timed(billing_samples, payment_backend.request_recurring_payment)
+        invoice_samples = {}
+        for step_name in ('_create_invoice_at_provider', '_finalize_invoice_at_provider', '_download_invoice_from_provider'):
+            invoice_samples[step_name] = []
+            setattr(invoice_backend, step_name, _timed(invoice_samples[step_name], getattr(invoice_backend, step_name)))
+
+        run_started = now()
+        results = []
+        invoice_file_names = []
+        try:
+            with transaction.atomic():
+                seeded = self._seed_subscriptions(options['subscriptions'])
+                results.append(self._measure('Billing (process_due_subscription_payments)', seeded, billing_samples, workers,
+                                             process_due_subscription_payments))
+                postback_samples = []
+                results.append(self._measure('Postback handling', None, postback_samples, 1,
+                                             self._deliver_postbacks, adapter, postback_samples))
+                invoice_result = self._measure('Invoices (GenerateMissingInvoices)', None, None, workers,
+                                               GenerateMissingInvoices().do)
+                invoice_result[1] = len(invoice_samples['_create_invoice_at_provider'])
+                results.append(invoice_result)
+                if not options['commit']:
+                    # stored files are not part of the transaction, so the downloaded PDFs are removed separately.
+                    # only files of blobs created by this run, as a blob that already existed keeps its file
+                    invoice_file_names = list(InvoiceBlob.objects.filter(created__gte=run_started)\
+                            .values_list('file', flat=True))
+                    raise _Rollback()
+        except _Rollback:
+            pass
+        finally:
+            self._delete_files(invoice_file_names)
+            payment_backend.transport.close()
+            invoice_backend.transport.close()
+
+        self.stdout.write('Seeded %d subscriptions, provider latency %.0fms (+%.0fms jitter), error rate %.1f%%, %d worker(s).%s'
+                          % (options['subscriptions'], options['latency_ms'], options['latency_jitter_ms'],
+                             options['error_rate'] * 100, workers, '' if options['commit'] else ' All changes were rolled back.'))
+        for name, item_count, seconds, query_count, samples in results:
+            self._write_result(name, item_count, seconds, query_count, samples)
+        for step_name, samples in invoice_samples.items():
+            self._write_result('  %s' % step_name.strip('_'), len(samples), None, None, samples)
+        self.stdout.write('Provider requests: %s' % ', '.join(['%s=%d' % (handler.strip('_'), count)
+                                                              for handler, count in sorted(adapter.request_counts.items())]))
+        if adapter.error_counts:
+            self.stdout.write('Injected provider errors: %s' % ', '.join(['%s=%d' % (handler.strip('_'), count)
+                                                                         for handler, count in sorted(adapter.error_counts.items())]))
+
+    def _seed_subscriptions(self, count):
+        """ Creates `count` users with an active SEPA subscription that is due today.
+            @return: the number of seeded subscriptions """
+        run_id = now().strftime('%Y%m%d%H%M%S')
+        completed_at = now() - timedelta(days=31)
+        for i in range(count):
+            username = 'payments_benchmark_%s_%d' % (run_id, i)
+            user = get_user_model().objects.create(username=username, email='%s@mail.com' % username, is_active=True)
+            payment = Payment.objects.create(
+                user=user,
+                vendor_transaction_id='benchmark-%s-%d' % (run_id, i),
+                internal_transaction_id='benchmark-order-%s-%d' % (run_id, i),
+                amount=5.0,
+                type=PAYMENT_TYPE_DIRECT_DEBIT,
+                status=Payment.STATUS_PAID,
+                completed_at=completed_at,
+                first_name='Bench',
+                last_name='Mark %d' % i,
+                email=user.email,
+                address='Benchmarkstr. 1',
+                city='Berlin',
+                postal_code='10115',
+                country='DE',
+                backend='%s.%s' % (BetterPaymentBackend.__module__, BetterPaymentBackend.__name__),
+                extra_data={},
+            )
+            subscription = Subscription.objects.create(
+                user=user,
+                reference_payment=payment,
+                last_payment=payment,
+                state=Subscription.STATE_2_ACTIVE,
+                amount=5.0,
+                next_due_date=now().date(),
+            )
+            payment.subscription = subscription
+            payment.save()
+        return count
+
+    def _deliver_postbacks(self, adapter, samples):
+        """ Posts all postbacks collected by the fake provider to our postback endpoint, one request each """
+        client = Client()
+        delivered = 0
+        for postback_url, params in adapter.pop_postbacks():
+            started = time.monotonic()
+            response = client.post(urlparse(postback_url).path, params)
+            samples.append(time.monotonic() - started)
+            if response.status_code != 200:
+                self.stderr.write('Postback for order "%s" was answered with status %d.' % (params['order_id'], response.status_code))
+            delivered += 1
+        return delivered
+
+    def _measure(self, name, item_count, samples, workers, func, *args):
+        """ Runs a benchmark phase and counts its queries. Queries of worker threads use their own
+            connections and are not counted, so the count is only reported for a single worker.
+            @return: list [name, item count, wall seconds, query count or None, latency samples] """
+        with CaptureQueriesContext(connection) as queries:
+            started = time.monotonic()
+            result = func(*args)
+            seconds = time.monotonic() - started
+        if item_count is None:
+            item_count = result if isinstance(result, int) else len(samples or [])
+        return [name, item_count, seconds, len(queries) if workers <= 1 else None, samples]
+
+    def _write_result(self, name, item_count, seconds, query_count, samples):
+        line = '%s: %d items' % (name, item_count)
+        if seconds is not None:
+            line += ', %.2fs wall time' % seconds
+            if item_count and seconds:
+                line += ' (%.1f/s)' % (item_count / seconds)
+        if query_count is not None and item_count:
+            line += ', %.1f queries/item' % (query_count / item_count)
+        if samples:
+            line += ', p50 %.1fms, p99 %.1fms' % (_percentile(samples, 50) * 1000, _percentile(samples, 99) * 1000)
+        self.stdout.write(line)
+
+    def _delete_files(self, file_names):
+        for file_name in file_names:
+            try:
+                default_storage.delete(file_name)
+            except Exception as e:
+                self.stderr.write('Could not delete benchmark invoice file "%s": %s' % (file_name, e))
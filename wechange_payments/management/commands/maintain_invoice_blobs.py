@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+import gzip
+import hashlib
+import logging
+from os import path
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.timezone import now
+
+from cosinnus.utils.files import get_cosinnus_media_file_folder
+from wechange_payments.conf import settings
+from wechange_payments.models import Invoice, AdditionalInvoice, InvoiceBlob
+
+
+logger = logging.getLogger('wechange-payments')
+
+INVOICE_MODELS = (Invoice, AdditionalInvoice)
+
+
+class Command(BaseCommand):
+    help = 'Maintains the content-addressed invoice file storage (see `InvoiceBlob`): moves invoice files stored \
+            before blobs existed into blobs, compresses the files of old blobs and deletes unused blobs and \
+            orphaned invoice files. Runs all of these steps if no step is given. \
+            With --verify, also checks the content hash of every blob file and corrects the reference counts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--import-legacy', action='store_true',
+                            help='Move invoice files that are not stored as blobs yet into blobs.')
+        parser.add_argument('--compress', action='store_true',
+                            help='Compress the files of blobs older than `PAYMENTS_INVOICE_BLOB_COMPRESS_AFTER_DAYS`.')
+        parser.add_argument('--gc', action='store_true',
+                            help='Delete unused blobs and files in the invoice folders that no invoice or blob uses.')
+        parser.add_argument('--verify', action='store_true',
+                            help='Check the files of all blobs and correct their reference counts.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be changed.')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        steps = [step for step in ('import_legacy', 'compress', 'gc', 'verify') if options[step]]
+        if not steps:
+            steps = ['import_legacy', 'compress', 'gc']
+        for step in steps:
+            getattr(self, step)()
+
+    def _report(self, message, **extra):
+        if not self.dry_run:
+            logger.info('Payments: %s' % message, extra=extra)
+        self.stdout.write(('(Dry run) ' if self.dry_run else '') + message + ' ' + str(extra))
+
+    def import_legacy(self):
+        imported = 0
+        failed = 0
+        for invoice_model in INVOICE_MODELS:
+            legacy_invoices = invoice_model.objects.filter(blob__isnull=True).exclude(file='').exclude(file=None)
+            for invoice in legacy_invoices.iterator():
+                if self.dry_run:
+                    imported += 1
+                    continue
+                legacy_file_name = invoice.file.name
+                try:
+                    with default_storage.open(legacy_file_name, 'rb') as legacy_file:
+                        content = legacy_file.read()
+                    with transaction.atomic():
+                        invoice.store_file(content)
+                        invoice.save(update_fields=['blob', 'file'])
+                except Exception as e:
+                    logger.error('Payments: Could not move an invoice file into a blob.',
+                                 extra={'invoice_id': invoice.id, 'file_name': legacy_file_name, 'exception': e})
+                    failed += 1
+                    continue
+                self._delete_file_if_unused(legacy_file_name)
+                imported += 1
+        self._report('Moved legacy invoice files into blobs.', imported=imported, failed=failed)
+
+    def compress(self):
+        compress_after_days = settings.PAYMENTS_INVOICE_BLOB_COMPRESS_AFTER_DAYS
+        if compress_after_days is None:
+            return
+        cold_blobs = InvoiceBlob.objects.filter(is_compressed=False, compression_checked_at__isnull=True,
+                                                created__lt=now() - timedelta(days=compress_after_days))
+        compressed = 0
+        saved_bytes = 0
+        for blob_id in list(cold_blobs.values_list('id', flat=True)):
+            with transaction.atomic():
+                blob = InvoiceBlob.objects.select_for_update().get(id=blob_id)
+                content = blob.read()
+                compressed_content = gzip.compress(content, mtime=0)
+                if len(compressed_content) > len(content) * (1 - settings.PAYMENTS_INVOICE_BLOB_COMPRESSION_MIN_SAVING):
+                    if not self.dry_run:
+                        blob.compression_checked_at = now()
+                        blob.save(update_fields=['compression_checked_at'])
+                    continue
+                compressed += 1
+                saved_bytes += len(content) - len(compressed_content)
+                if self.dry_run:
+                    continue
+                uncompressed_file_name = blob.file.name
+                blob.file.save('invoice.pdf' + InvoiceBlob.COMPRESSED_SUFFIX, ContentFile(compressed_content), save=False)
+                blob.is_compressed = True
+                blob.stored_size = len(compressed_content)
+                blob.compression_checked_at = now()
+                blob.save(update_fields=['file', 'is_compressed', 'stored_size', 'compression_checked_at'])
+                for invoice_model in INVOICE_MODELS:
+                    invoice_model.objects.filter(blob=blob).update(file=blob.file.name)
+                transaction.on_commit(lambda file_name=uncompressed_file_name: default_storage.delete(file_name))
+        self._report('Compressed the files of old invoice blobs.', compressed=compressed, saved_bytes=saved_bytes)
+
+    def gc(self):
+        deleted_blobs = 0
+        for blob_id in list(InvoiceBlob.objects.filter(ref_count__lte=0).values_list('id', flat=True)):
+            with transaction.atomic():
+                blob = InvoiceBlob.objects.select_for_update().get(id=blob_id)
+                if blob.ref_count > 0 or self._count_blob_references(blob) > 0:
+                    continue
+                deleted_blobs += 1
+                if not self.dry_run:
+                    blob.delete()
+                    transaction.on_commit(lambda file_name=blob.file.name: default_storage.delete(file_name))
+        
+        # files no blob or invoice knows of, e.g. left behind by deleted invoices or failed downloads
+        used_file_names = set(InvoiceBlob.objects.values_list('file', flat=True))
+        for invoice_model in INVOICE_MODELS:
+            used_file_names.update(invoice_model.objects.exclude(file='').exclude(file=None).values_list('file', flat=True))
+        grace_cutoff = now() - timedelta(hours=settings.PAYMENTS_INVOICE_BLOB_GC_GRACE_HOURS)
+        deleted_files = 0
+        payments_folder = path.join(get_cosinnus_media_file_folder(), 'payments')
+        for folder in (path.join(payments_folder, 'invoices'), path.join(payments_folder, 'invoice_blobs')):
+            for file_name in self._walk_storage(folder):
+                if file_name in used_file_names:
+                    continue
+                try:
+                    if default_storage.get_modified_time(file_name) > grace_cutoff:
+                        continue
+                except NotImplementedError:
+                    # without a modification time, a file that is just being stored can't be told apart
+                    continue
+                deleted_files += 1
+                if not self.dry_run:
+                    default_storage.delete(file_name)
+        self._report('Deleted unused invoice blobs and orphaned invoice files.',
+                     deleted_blobs=deleted_blobs, deleted_files=deleted_files)
+
+    def verify(self):
+        verified = 0
+        broken = 0
+        corrected_ref_counts = 0
+        for blob in InvoiceBlob.objects.all().iterator():
+            try:
+                valid = hashlib.sha256(blob.read()).hexdigest() == blob.sha256
+            except Exception as e:
+                logger.error('Payments: An invoice blob file could not be read.',
+                             extra={'blob_id': blob.id, 'file_name': blob.file.name, 'exception': e})
+                valid = False
+            if not valid:
+                logger.critical('Payments: NEED TO INVESTIGATE! An invoice blob file is missing or its content does not match its hash!',
+                                extra={'blob_id': blob.id, 'file_name': blob.file.name})
+                broken += 1
+            else:
+                verified += 1
+            
+            if self.dry_run:
+                if self._count_blob_references(blob) != blob.ref_count:
+                    corrected_ref_counts += 1
+                continue
+            with transaction.atomic():
+                # the lock keeps new references from being made while counting
+                blob = InvoiceBlob.objects.select_for_update().get(id=blob.id)
+                ref_count = self._count_blob_references(blob)
+                if ref_count != blob.ref_count:
+                    corrected_ref_counts += 1
+                blob.ref_count = ref_count
+                blob.verified_at = now() if valid else None
+                blob.save(update_fields=['ref_count', 'verified_at'])
+        self._report('Verified the invoice blobs.', verified=verified, broken=broken,
+                     corrected_ref_counts=corrected_ref_counts)
+
+    def _count_blob_references(self, blob):
+        return sum([invoice_model.objects.filter(blob=blob).count() for invoice_model in INVOICE_MODELS])
+
+    def _delete_file_if_unused(self, file_name):
+        if any([invoice_model.objects.filter(file=file_name).exists() for invoice_model in INVOICE_MODELS]):
+            return
+        try:
+            default_storage.delete(file_name)
+        except Exception as e:
+            logger.warning('Payments: Could not delete a legacy invoice file after moving it into a blob.',
+                           extra={'file_name': file_name, 'exception': e})
+
+    def _walk_storage(self, folder):
+        """ Yields the names of all files in the storage folder and its subfolders """
+        try:
+            dir_names, file_names = default_storage.listdir(folder)
+        except (OSError, NotImplementedError):
+            return
+        for file_name in file_names:
+            yield path.join(folder, file_name)
+        for dir_name in dir_names:
+            yield from self._walk_storage(path.join(folder, dir_name))
@@ -22,9 +22,11 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         try:
             initialize_cosinnus_after_startup()
-            (ended_subscriptions, booked_subscriptions) = process_due_subscription_payments()
-            logger.info('Manual subscription payment processing finished.',
-                extra={'ended_subscriptions': ended_subscriptions, 'booked_subscriptions': booked_subscriptions})
+            stats = {}
+            (ended_subscriptions, booked_subscriptions) = process_due_subscription_payments(stats=stats)
+            extra = {'ended_subscriptions': ended_subscriptions, 'booked_subscriptions': booked_subscriptions}
+            extra.update(stats)
+            logger.info('Manual subscription payment processing finished.', extra=extra)
         except Exception as e:
             logger.error('A critical error occured during daily subscription payment processing and bubbled up completely! Exception was: %s' % force_str(e),
                          extra={'exception': e, 'trace': traceback.format_exc()})
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import time
+import traceback
+
+from django.core.management.base import BaseCommand
+
+from cosinnus.conf import settings
+from cosinnus.core.middleware.cosinnus_middleware import initialize_cosinnus_after_startup
+from wechange_payments.backends import get_backend
+
+
+logger = logging.getLogger('wechange-payments')
+
+
+class Command(BaseCommand):
+    help = 'Applies all parked postbacks that are due, in the order they came in. \
+            Use --loop to run as a dedicated postback worker process next to the web workers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and apply new postbacks as they are parked.')
+        parser.add_argument('--interval', type=float, default=2.0,
+                            help='Seconds to wait between two runs when looping (default: 2).')
+
+    def handle(self, *args, **options):
+        initialize_cosinnus_after_startup()
+        backend = get_backend()
+        while True:
+            try:
+                applied = backend.reconcile_pending_postbacks()
+                if applied or not options['loop']:
+                    self.stdout.write('Postbacks applied: %d' % applied)
+            except Exception as e:
+                logger.error('Payments: An error occured while applying parked postbacks!',
+                             extra={'exception': e, 'trace': traceback.format_exc()})
+                if settings.DEBUG or not options['loop']:
+                    raise
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from wechange_payments.models import UserPaymentSummary
+from wechange_payments.utils.utils import chunked
+
+
+logger = logging.getLogger('wechange-payments')
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the precomputed `UserPaymentSummary` of all users that have any payments, subscriptions \
+            or invoices (or only of the given users), and deletes the summaries of all other users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, action='append', dest='user_ids',
+                            help='Only rebuild the summary of this user. Can be given multiple times.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='The number of summaries computed and written at once.')
+
+    def handle(self, *args, **options):
+        user_ids = options['user_ids']
+        if user_ids is None:
+            user_ids = get_user_model().objects.filter(
+                Q(payments__isnull=False) | Q(subscriptions__isnull=False) | Q(invoices__isnull=False))\
+                    .distinct().order_by('id').values_list('id', flat=True)
+            deleted = UserPaymentSummary.objects.exclude(user_id__in=user_ids).delete()[0]
+            user_ids = user_ids.iterator()
+        else:
+            deleted = 0
+        
+        rebuilt = 0
+        for batch_user_ids in chunked(user_ids, options['batch_size']):
+            UserPaymentSummary.refresh_for_users(batch_user_ids)
+            rebuilt += len(batch_user_ids)
+        
+        logger.info('Payments: Rebuilt the user payment summaries.', extra={'rebuilt': rebuilt, 'deleted': deleted})
+        self.stdout.write('Rebuilt %d user payment summaries and deleted %d stale ones.' % (rebuilt, deleted))
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from wechange_payments.models import Payment
+
+
+class Command(BaseCommand):
+    help = 'Reports all payments that share an `internal_transaction_id` (order id) or a `vendor_transaction_id` \
+            with another payment. These must be resolved by hand before the unique constraints on these ids \
+            can be migrated. Exits with status 1 if any duplicates were found.'
+
+    def handle(self, *args, **options):
+        found = 0
+        for field_name in ('internal_transaction_id', 'vendor_transaction_id'):
+            duplicate_values = Payment.objects.exclude(**{field_name: ''}).values(field_name).order_by(field_name)\
+                    .annotate(count=Count('id')).filter(count__gt=1).values_list(field_name, flat=True)
+            for value in duplicate_values.iterator():
+                found += 1
+                self.stdout.write('Duplicate %s "%s":' % (field_name, value))
+                payments = Payment.objects.filter(**{field_name: value}).order_by('id')\
+                        .values_list('id', 'user_id', 'status', 'amount', 'completed_at', 'internal_transaction_id', 'vendor_transaction_id')
+                for payment_id, user_id, status, amount, completed_at, order_id, vendor_id in payments:
+                    self.stdout.write('    Payment %d: user %s, status %d, amount %s, completed at %s, order id "%s", vendor id "%s"'
+                                      % (payment_id, user_id, status, amount, completed_at, order_id, vendor_id))
+        if found:
+            self.stdout.write('Found %d duplicate transaction ids.' % found)
+            raise SystemExit(1)
+        self.stdout.write('No duplicate transaction ids found.')
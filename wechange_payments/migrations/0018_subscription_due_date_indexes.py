@@ -0,0 +1,21 @@
+# Generated by Django 4.2.14 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechange_payments', '0017_payment_debit_period_subscription_debit_period_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['state', 'next_due_date'], name='payments_sub_state_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['state', 'last_pre_notification_at'], name='payments_sub_state_prenot_idx'),
+        ),
+    ]
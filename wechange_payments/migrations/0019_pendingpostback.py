@@ -0,0 +1,37 @@
+# Generated by Django 4.2.14 on 2026-10-17 09:40
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechange_payments', '0018_subscription_due_date_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingPostback',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('order_id', models.CharField(db_index=True, editable=False, max_length=50, verbose_name='Order Id')),
+                ('transaction_id', models.CharField(editable=False, max_length=50, verbose_name='Vendor Transaction Id')),
+                ('data', models.JSONField(editable=False, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('attempts', models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Reconciliation attempts')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Next attempt at')),
+                ('processed_at', models.DateTimeField(blank=True, editable=False, help_text='Set once the postback has been applied to its payment.', null=True, verbose_name='Processed at')),
+            ],
+            options={
+                'verbose_name': 'Pending Postback',
+                'verbose_name_plural': 'Pending Postbacks',
+                'ordering': ('id',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='pendingpostback',
+            index=models.Index(fields=['processed_at', 'next_attempt_at'], name='payments_postback_due_idx'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.2.14 on 2026-10-17 14:03
+
+from django.db import migrations, models
+
+
+def extract_transaction_log_fields(data):
+    """ A copy of `wechange_payments.models.extract_transaction_log_fields()` as of this migration """
+    if not isinstance(data, dict):
+        data = {}
+    order_id = data.get('order_id', None)
+    transaction_id = data.get('transaction_id', None)
+    try:
+        user_id = int(data.get('user', data.get('customer_id', None)))
+    except (TypeError, ValueError):
+        user_id = None
+    return {
+        'order_id': str(order_id)[:50] if order_id else None,
+        'transaction_id': str(transaction_id)[:50] if transaction_id else None,
+        'user_id': user_id if user_id is not None and user_id >= 0 else None,
+    }
+
+
+def backfill_indexed_fields(apps, schema_editor):
+    TransactionLog = apps.get_model('wechange_payments', 'TransactionLog')
+    batch = []
+    for log in TransactionLog.objects.only('id', 'data').iterator(chunk_size=2000):
+        for field_name, value in extract_transaction_log_fields(log.data).items():
+            setattr(log, field_name, value)
+        batch.append(log)
+        if len(batch) >= 2000:
+            TransactionLog.objects.bulk_update(batch, ['order_id', 'transaction_id', 'user_id'])
+            batch = []
+    if batch:
+        TransactionLog.objects.bulk_update(batch, ['order_id', 'transaction_id', 'user_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechange_payments', '0019_pendingpostback'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transactionlog',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Created'),
+        ),
+        migrations.AddField(
+            model_name='transactionlog',
+            name='order_id',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=50, null=True, verbose_name='Order Id'),
+        ),
+        migrations.AddField(
+            model_name='transactionlog',
+            name='transaction_id',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=50, null=True, verbose_name='Vendor Transaction Id'),
+        ),
+        migrations.AddField(
+            model_name='transactionlog',
+            name='user_id',
+            field=models.PositiveIntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='User Id'),
+        ),
+        migrations.RunPython(backfill_indexed_fields, migrations.RunPython.noop),
+    ]
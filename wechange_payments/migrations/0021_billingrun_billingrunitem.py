@@ -0,0 +1,52 @@
+# Generated by Django 4.2.14 on 2026-10-17 14:05
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechange_payments', '0020_transactionlog_indexed_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillingRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_date', models.DateField(editable=False, unique=True, verbose_name='Run date')),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Started at')),
+                ('finished_at', models.DateTimeField(blank=True, editable=False, help_text='Unset while the run is in progress, or if it was interrupted.', null=True, verbose_name='Finished at')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, editable=False, help_text='How often the run was started. More than one means it was resumed.', verbose_name='Attempts')),
+                ('stats', models.JSONField(blank=True, editable=False, encoder=django.core.serializers.json.DjangoJSONEncoder, help_text='The counts and timings of the last attempt.', null=True)),
+            ],
+            options={
+                'verbose_name': 'Billing Run',
+                'verbose_name_plural': 'Billing Runs',
+                'ordering': ('-run_date',),
+            },
+        ),
+        migrations.CreateModel(
+            name='BillingRunItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.CharField(editable=False, max_length=50, unique=True, verbose_name='Idempotency key')),
+                ('state', models.PositiveSmallIntegerField(choices=[(0, 'Claimed'), (1, 'Booked'), (2, 'Failed')], default=0, editable=False, verbose_name='State')),
+                ('previous_payment_id', models.PositiveIntegerField(blank=True, editable=False, help_text='The last payment of the subscription at claim time, to find a payment of an interrupted booking.', null=True, verbose_name='Previous payment id')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Attempts')),
+                ('claimed_at', models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Claimed at')),
+                ('finished_at', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Finished at')),
+                ('billing_run', models.ForeignKey(editable=False, help_text='The run of the last attempt.', on_delete=django.db.models.deletion.CASCADE, related_name='items', to='wechange_payments.billingrun', verbose_name='Billing Run')),
+                ('payment', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='wechange_payments.payment', verbose_name='Payment')),
+                ('subscription', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='billing_run_items', to='wechange_payments.subscription', verbose_name='Subscription')),
+            ],
+            options={
+                'verbose_name': 'Billing Run Item',
+                'verbose_name_plural': 'Billing Run Items',
+                'ordering': ('-claimed_at',),
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.14 on 2026-10-17 15:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('wechange_payments', '0021_billingrun_billingrunitem'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserPaymentSummary',
+            fields=[
+                ('user', models.OneToOneField(editable=False, on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='payment_summary', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='User')),
+                ('lifetime_paid_sum', models.FloatField(default=0.0, editable=False, help_text='The sum of all paid debit amounts.', verbose_name='Paid in total')),
+                ('year_paid_sum', models.FloatField(default=0.0, editable=False, help_text='The sum of all debit amounts paid in the last 360 days, as of the last refresh.', verbose_name='Paid in the last year')),
+                ('last_paid_at', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Last paid at')),
+                ('invoice_count', models.PositiveIntegerField(default=0, editable=False, verbose_name='Invoices')),
+                ('refreshed_at', models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Refreshed at')),
+                ('active_subscription', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='wechange_payments.subscription', verbose_name='Active Subscription')),
+            ],
+            options={
+                'verbose_name': 'User Payment Summary',
+                'verbose_name_plural': 'User Payment Summaries',
+            },
+        ),
+    ]
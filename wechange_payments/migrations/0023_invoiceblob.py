@@ -0,0 +1,45 @@
+# Generated by Django 4.2.14 on 2026-10-17 16:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import wechange_payments.utils.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechange_payments', '0022_userpaymentsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoiceBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(editable=False, help_text='The hash of the uncompressed file content.', max_length=64, unique=True, verbose_name='SHA-256')),
+                ('file', models.FileField(editable=False, max_length=250, upload_to=wechange_payments.utils.utils._get_invoice_blob_filename, verbose_name='File')),
+                ('size', models.PositiveIntegerField(editable=False, help_text='The size of the uncompressed file content in bytes.', verbose_name='Size')),
+                ('stored_size', models.PositiveIntegerField(editable=False, verbose_name='Stored size')),
+                ('is_compressed', models.BooleanField(default=False, editable=False, verbose_name='Is compressed')),
+                ('ref_count', models.IntegerField(default=0, editable=False, verbose_name='Reference count')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('compression_checked_at', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Compression checked at')),
+                ('verified_at', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Verified at')),
+            ],
+            options={
+                'verbose_name': 'Invoice Blob',
+                'verbose_name_plural': 'Invoice Blobs',
+                'ordering': ('-created',),
+            },
+        ),
+        migrations.AddField(
+            model_name='additionalinvoice',
+            name='blob',
+            field=models.ForeignKey(blank=True, editable=False, help_text='The stored file content. `file` points to the file of this blob.', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='wechange_payments.invoiceblob', verbose_name='Blob'),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='blob',
+            field=models.ForeignKey(blank=True, editable=False, help_text='The stored file content. `file` points to the file of this blob.', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='wechange_payments.invoiceblob', verbose_name='Blob'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.14 on 2026-10-17 16:45
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+TRANSACTION_ID_FIELDS = ('internal_transaction_id', 'vendor_transaction_id')
+
+
+def check_for_duplicate_transaction_ids(apps, schema_editor):
+    """ The unique constraints can't be added while duplicates exist. They must be resolved by hand,
+        as they are payment records """
+    Payment = apps.get_model('wechange_payments', 'Payment')
+    for field_name in TRANSACTION_ID_FIELDS:
+        duplicates = Payment.objects.exclude(**{field_name: ''}).values(field_name).order_by()\
+                .annotate(count=Count('id')).filter(count__gt=1).count()
+        if duplicates:
+            raise RuntimeError('Payments: %d values of `Payment.%s` are used by more than one payment. Run the '
+                               '`report_duplicate_transaction_ids` management command and resolve them before migrating.'
+                               % (duplicates, field_name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechange_payments', '0023_invoiceblob'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_for_duplicate_transaction_ids, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='payment',
+            constraint=models.UniqueConstraint(condition=models.Q(('internal_transaction_id', ''), _negated=True), fields=('internal_transaction_id',), name='payments_payment_order_id_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='payment',
+            constraint=models.UniqueConstraint(condition=models.Q(('vendor_transaction_id', ''), _negated=True), fields=('vendor_transaction_id',), name='payments_payment_vendor_id_uniq'),
+        ),
+    ]
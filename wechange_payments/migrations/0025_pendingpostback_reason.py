@@ -0,0 +1,18 @@
+# Generated by Django 4.2.14 on 2026-10-17 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechange_payments', '0024_payment_transaction_id_constraints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendingpostback',
+            name='reason',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Payment not found'), (1, 'Queued')], default=0, editable=False, verbose_name='Reason'),
+        ),
+    ]
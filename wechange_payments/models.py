@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import gzip
+import hashlib
 import logging
+import weakref
 
 from annoying.functions import get_object_or_None
 from dateutil import relativedelta
-from django.db import models
+from django.core.files.base import ContentFile
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, ExpressionWrapper, Case, When, Q, Sum, Max, Count
 from django.contrib import admin
 from django.core.serializers.json import DjangoJSONEncoder
 from django.urls.base import reverse
@@ -14,7 +19,7 @@ from django_countries.fields import CountryField
 
 from wechange_payments.conf import settings, PAYMENT_TYPE_DIRECT_DEBIT, \
     PAYMENT_TYPE_CREDIT_CARD, PAYMENT_TYPE_PAYPAL
-from wechange_payments.utils.utils import _get_invoice_filename
+from wechange_payments.utils.utils import _get_invoice_filename, _get_invoice_blob_filename
 from datetime import timedelta
 
 
@@ -161,15 +166,52 @@ class Payment(DebitPeriodMixin, models.Model):
         app_label = 'wechange_payments'
         verbose_name = _('Payment')
         verbose_name_plural = _('Payments')
+        # postbacks and redirects look up payments by these ids. use the `report_duplicate_transaction_ids`
+        # command to find payments that would violate these constraints
+        constraints = [
+            models.UniqueConstraint(fields=['internal_transaction_id'], condition=~Q(internal_transaction_id=''),
+                                    name='payments_payment_order_id_uniq'),
+            models.UniqueConstraint(fields=['vendor_transaction_id'], condition=~Q(vendor_transaction_id=''),
+                                    name='payments_payment_vendor_id_uniq'),
+        ]
     
     def get_type_string(self):
         return dict(self.TYPE_CHOICES).get(self.type)
     
+    def save(self, *args, **kwargs):
+        super(Payment, self).save(*args, **kwargs)
+        UserPaymentSummary.refresh_on_commit(self.user_id)
+        PendingPostback.reconcile_on_commit(self.internal_transaction_id)
+    
+    def delete(self, *args, **kwargs):
+        user_id = self.user_id
+        ret = super(Payment, self).delete(*args, **kwargs)
+        UserPaymentSummary.refresh_on_commit(user_id)
+        return ret
+    
     def get_admin_change_url(self):
         """ Returns the django admin edit page for this object. """
         return reverse('admin:wechange_payments_payment_change', kwargs={'object_id': self.id})
 
 
+def extract_transaction_log_fields(data):
+    """ Returns the indexed fields of a `TransactionLog` for its `data`.
+        Requests log the user as `user`, postbacks as `customer_id`. """
+    if not isinstance(data, dict):
+        data = {}
+    order_id = data.get('order_id', None)
+    transaction_id = data.get('transaction_id', None)
+    try:
+        user_id = int(data.get('user', data.get('customer_id', None)))
+    except (TypeError, ValueError):
+        user_id = None
+    return {
+        'order_id': str(order_id)[:50] if order_id else None,
+        'transaction_id': str(transaction_id)[:50] if transaction_id else None,
+        'user_id': user_id if user_id is not None and user_id >= 0 else None,
+    }
+
+
 class TransactionLog(models.Model):
     
     TYPE_REQUEST = 0
@@ -181,22 +223,131 @@ class TransactionLog(models.Model):
         (TYPE_POSTBACK, _('Received Postback')),
     )
     
-    created = models.DateTimeField(verbose_name=_('Created'), editable=False, auto_now_add=True)
+    created = models.DateTimeField(verbose_name=_('Created'), editable=False, auto_now_add=True, db_index=True)
     url = models.CharField(_('API Endpoint URL'), max_length=150, null=True, blank=True)
     type = models.PositiveSmallIntegerField(_('Transaction Type'), blank=False,
         default=TYPE_REQUEST, choices=TYPE_CHOICES, editable=False)
     data = models.JSONField(encoder=DjangoJSONEncoder)
     
+    # copied from `data` on save, so logs can be searched without scanning the JSON data
+    order_id = models.CharField(_('Order Id'), max_length=50, null=True, blank=True, editable=False, db_index=True)
+    transaction_id = models.CharField(_('Vendor Transaction Id'), max_length=50, null=True, blank=True,
+        editable=False, db_index=True)
+    user_id = models.PositiveIntegerField(_('User Id'), null=True, blank=True, editable=False, db_index=True)
+    
     class Meta(object):
         app_label = 'wechange_payments'
         verbose_name = _('Payment Transaction Log')
         verbose_name_plural = _('Payment Transaction Logs')
+    
+    def save(self, *args, **kwargs):
+        self.extract_indexed_fields()
+        super(TransactionLog, self).save(*args, **kwargs)
+    
+    def extract_indexed_fields(self):
+        """ Sets the indexed `order_id`, `transaction_id` and `user_id` fields from `data`.
+            Call this before saving logs with `bulk_create()`, which skips `save()`. """
+        for field_name, value in extract_transaction_log_fields(self.data).items():
+            setattr(self, field_name, value)
         
     def get_admin_change_url(self):
         """ Returns the django admin edit page for this object. """
         return reverse('admin:wechange_payments_transactionlog_change', kwargs={'object_id': self.id})
 
 
+class PendingPostback(models.Model):
+    """ A validated postback from the payment provider, that is applied to its `Payment` later.
+        The provider's postback is sometimes faster than our own commit of the `Payment` it refers to.
+        Instead of blocking the request until the payment shows up, the postback is parked here and
+        answered immediately. With `PAYMENTS_POSTBACK_ASYNC`, all postbacks are parked here and applied
+        by a background worker.
+        Postbacks are applied by the backend's `reconcile_pending_postbacks()`, either right after they
+        were parked or the matching payment has been saved, or by the reconciliation cron, with an 
+        increasing delay between attempts. """
+    
+    # the payment of the postback had not been saved yet
+    REASON_0_UNMATCHED = 0
+    # the postback was parked to be applied in the background (see `PAYMENTS_POSTBACK_ASYNC`)
+    REASON_1_QUEUED = 1
+    
+    REASONS = (
+        (REASON_0_UNMATCHED, _('Payment not found')),
+        (REASON_1_QUEUED, _('Queued')),
+    )
+    
+    created = models.DateTimeField(verbose_name=_('Created'), editable=False, auto_now_add=True)
+    order_id = models.CharField(_('Order Id'), max_length=50, db_index=True, editable=False)
+    transaction_id = models.CharField(_('Vendor Transaction Id'), max_length=50, editable=False)
+    data = models.JSONField(encoder=DjangoJSONEncoder, editable=False)
+    reason = models.PositiveSmallIntegerField(_('Reason'), choices=REASONS, default=REASON_0_UNMATCHED, editable=False)
+    
+    attempts = models.PositiveSmallIntegerField(_('Reconciliation attempts'), default=0, editable=False)
+    next_attempt_at = models.DateTimeField(verbose_name=_('Next attempt at'), default=now, editable=False)
+    processed_at = models.DateTimeField(verbose_name=_('Processed at'), editable=False, blank=True, null=True,
+        help_text='Set once the postback has been applied to its payment.')
+    
+    class Meta(object):
+        app_label = 'wechange_payments'
+        ordering = ('id',)
+        verbose_name = _('Pending Postback')
+        verbose_name_plural = _('Pending Postbacks')
+        indexes = [
+            models.Index(fields=['processed_at', 'next_attempt_at'], name='payments_postback_due_idx'),
+        ]
+    
+    @classmethod
+    def reconcile_on_commit(cls, order_id):
+        """ Applies the postbacks that were deferred for the order once the current transaction commits
+            (or right away outside of a transaction). Called from `Payment.save()`. The check for deferred
+            postbacks is only made then, so postbacks that were parked while the transaction was still open
+            are found as well. """
+        if not order_id:
+            return
+        transaction.on_commit(lambda: cls._reconcile_order(order_id))
+    
+    @classmethod
+    def _reconcile_order(cls, order_id):
+        if not cls.objects.filter(order_id=order_id, processed_at__isnull=True).exists():
+            return
+        from wechange_payments.backends import get_backend
+        get_backend().reconcile_pending_postbacks(order_id=order_id)
+    
+    def get_admin_change_url(self):
+        """ Returns the django admin edit page for this object. """
+        return reverse('admin:wechange_payments_pendingpostback_change', kwargs={'object_id': self.id})
+
+
+class SubscriptionQuerySet(models.QuerySet):
+    """ Queries for the daily subscription processing, that select only the subscriptions
+        that actually need work on a given date. These are backed by the `(state, next_due_date)`
+        and `(state, last_pre_notification_at)` indexes of `Subscription`. """
+    
+    def due_for_payment(self, date):
+        """ Active subscriptions with a `next_due_date` on or before the given date.
+            SQL equivalent of `Subscription.check_payment_due()`. """
+        return self.filter(state=Subscription.STATE_2_ACTIVE, next_due_date__lte=date)
+    
+    def due_for_termination(self, date):
+        """ Cancelled subscriptions with a `next_due_date` on or before the given date.
+            SQL equivalent of `Subscription.check_termination_due()`. """
+        return self.filter(state=Subscription.STATE_1_CANCELLED_BUT_ACTIVE, next_due_date__lte=date)
+    
+    def due_for_pre_notification(self, date):
+        """ Active SEPA subscriptions whose next payment is within the pre-notification window
+            and which have not had a pre-notification sent for it yet.
+            SQL equivalent of `Subscription.check_pre_notification_due()`. """
+        notification_days = settings.PAYMENTS_PRE_NOTIFICATION_BEFORE_PAYMENT_DAYS
+        last_unsent_date = ExpressionWrapper(F('next_due_date') - timedelta(days=notification_days + 1),
+                                             output_field=models.DateField())
+        return self.filter(
+            state=Subscription.STATE_2_ACTIVE,
+            reference_payment__type=PAYMENT_TYPE_DIRECT_DEBIT,
+            next_due_date__lte=date + timedelta(days=notification_days),
+            last_pre_notification_at__isnull=False,
+            last_pre_notification_at__date__lte=last_unsent_date,
+        )
+
+
 class Subscription(DebitPeriodMixin, models.Model):
     """
         Subscription model. Has an initial reference payment which can be used
@@ -387,10 +538,16 @@ class Subscription(DebitPeriodMixin, models.Model):
     cancelled = models.DateTimeField(verbose_name=_('Cancelled by User'), editable=False, blank=True, null=True)
     terminated = models.DateTimeField(verbose_name=_('Finally terminated by System'), editable=False, blank=True, null=True)
     
+    objects = SubscriptionQuerySet.as_manager()
+    
     class Meta(object):
         ordering = ('created',)
         verbose_name = _('Subscription')
         verbose_name_plural = _('Subscription')
+        indexes = [
+            models.Index(fields=['state', 'next_due_date'], name='payments_sub_state_due_idx'),
+            models.Index(fields=['state', 'last_pre_notification_at'], name='payments_sub_state_prenot_idx'),
+        ]
         
     def __init__(self, *args, **kwargs):
         super(Subscription, self).__init__(*args, **kwargs)
@@ -543,12 +700,419 @@ class Subscription(DebitPeriodMixin, models.Model):
                 raise Exception('Payments: Fatal: Sanity check failed for subscription: \
                     Tried to save a subscription when another subscription with an exclusive state exists for the same user!')
         super(Subscription, self).save(*args, **kwargs)
+        UserSubscriptionState.invalidate(self.user_id)
+        UserPaymentSummary.refresh_on_commit(self.user_id)
+    
+    def delete(self, *args, **kwargs):
+        user_id = self.user_id
+        ret = super(Subscription, self).delete(*args, **kwargs)
+        UserSubscriptionState.invalidate(user_id)
+        UserPaymentSummary.refresh_on_commit(user_id)
+        return ret
     
     def get_admin_change_url(self):
         """ Returns the django admin edit page for this object. """
         return reverse('admin:wechange_payments_subscription_change', kwargs={'object_id': self.id})
 
 
+class UserSubscriptionState(object):
+    """ All non-terminated subscriptions of a user, loaded with a single query.
+        Use `UserSubscriptionState.for_request(request)` in views and context processors: it is
+        loaded at most once per request (and, if `PAYMENTS_SUBSCRIPTION_STATE_CACHE_SECONDS` is set,
+        cached across requests). Once a `Subscription.save()` or `delete()` is committed, the cache and
+        the per-request copies of that user's state are invalidated. """
+    
+    CACHE_KEY = 'wechange_payments/subscription_state/%d'
+    REQUEST_ATTR = '_payments_subscription_state'
+    
+    # the version of each user's state in this process, bumped on every change of the user's subscriptions
+    # to invalidate their per-request copies. when too many users are tracked, the versions are dropped
+    # and all per-request copies are invalidated at once by a new epoch
+    MAX_TRACKED_USERS = 10000
+    _versions = {}
+    _epoch = 0
+    
+    def __init__(self, subscriptions):
+        self.subscriptions_by_state = dict([(sub.state, sub) for sub in subscriptions])
+    
+    @property
+    def active(self):
+        return self.subscriptions_by_state.get(Subscription.STATE_2_ACTIVE, None)
+    
+    @property
+    def canceled(self):
+        return self.subscriptions_by_state.get(Subscription.STATE_1_CANCELLED_BUT_ACTIVE, None)
+    
+    @property
+    def current(self):
+        """ The active or canceled-but-active subscription. See `Subscription.get_current_for_user()` """
+        return self.active or self.canceled
+    
+    @property
+    def waiting(self):
+        return self.subscriptions_by_state.get(Subscription.STATE_3_WAITING_TO_BECOME_ACTIVE, None)
+    
+    @property
+    def suspended(self):
+        return self.subscriptions_by_state.get(Subscription.STATE_99_FAILED_PAYMENTS_SUSPENDED, None)
+    
+    @classmethod
+    def load(cls, user):
+        """ Loads the subscription state of a user from the DB (or the cache, if enabled). """
+        if not user.is_authenticated:
+            return cls([])
+        timeout = settings.PAYMENTS_SUBSCRIPTION_STATE_CACHE_SECONDS
+        if timeout:
+            from django.core.cache import cache
+            subscriptions = cache.get(cls.CACHE_KEY % user.id)
+            if subscriptions is not None:
+                return cls(subscriptions)
+        subscriptions = list(Subscription.objects.filter(user=user).exclude(state=Subscription.STATE_0_TERMINATED)\
+                             .select_related('last_payment'))
+        if timeout:
+            cache.set(cls.CACHE_KEY % user.id, subscriptions, timeout)
+        return cls(subscriptions)
+    
+    @classmethod
+    def for_request(cls, request):
+        """ Returns the subscription state for the request's user, loading it only once per request. """
+        version = (cls._epoch, cls._versions.get(request.user.id, 0))
+        memoized = getattr(request, cls.REQUEST_ATTR, None)
+        if memoized is not None and memoized[0] == version:
+            return memoized[1]
+        state = cls.load(request.user)
+        setattr(request, cls.REQUEST_ATTR, (version, state))
+        return state
+    
+    @classmethod
+    def invalidate(cls, user_id):
+        """ Drops the cached and the per-request subscription states of the user once the current
+            transaction commits (or right away outside of a transaction), so no other request can cache
+            the state from before the change in the meantime. """
+        if user_id is None:
+            return
+        transaction.on_commit(lambda: cls._invalidate_now(user_id))
+    
+    @classmethod
+    def _invalidate_now(cls, user_id):
+        if user_id not in UserSubscriptionState._versions and len(UserSubscriptionState._versions) >= cls.MAX_TRACKED_USERS:
+            UserSubscriptionState._versions = {}
+            UserSubscriptionState._epoch += 1
+        UserSubscriptionState._versions[user_id] = UserSubscriptionState._versions.get(user_id, 0) + 1
+        if settings.PAYMENTS_SUBSCRIPTION_STATE_CACHE_SECONDS:
+            from django.core.cache import cache
+            cache.delete(cls.CACHE_KEY % user_id)
+
+
+class UserPaymentSummary(models.Model):
+    """ A precomputed summary of the payments, subscriptions and invoices of a user, so pages that
+        show these figures only need to read a single row. It is refreshed after each commit that
+        saved or deleted a payment, subscription or invoice of the user (see `refresh_on_commit()`),
+        and can be rebuilt completely with the `rebuild_payment_summaries` management command.
+        
+        The rolling-year sum changes as payments grow older, so a summary that was refreshed before
+        today is refreshed again when it is read with `get_for_user()`.
+        Note: This is a display cache. The payment safety checks always use the raw `Payment` table! """
+    
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, verbose_name=_('User'), primary_key=True,
+        related_name='payment_summary', on_delete=models.CASCADE, editable=False)
+    lifetime_paid_sum = models.FloatField(_('Paid in total'), default=0.0, editable=False,
+        help_text='The sum of all paid debit amounts.')
+    year_paid_sum = models.FloatField(_('Paid in the last year'), default=0.0, editable=False,
+        help_text='The sum of all debit amounts paid in the last 360 days, as of the last refresh.')
+    last_paid_at = models.DateTimeField(verbose_name=_('Last paid at'), editable=False, blank=True, null=True)
+    active_subscription = models.ForeignKey('wechange_payments.Subscription', verbose_name=_('Active Subscription'),
+        related_name='+', on_delete=models.SET_NULL, null=True, blank=True, editable=False)
+    invoice_count = models.PositiveIntegerField(_('Invoices'), default=0, editable=False)
+    refreshed_at = models.DateTimeField(verbose_name=_('Refreshed at'), editable=False, default=now)
+    
+    class Meta(object):
+        app_label = 'wechange_payments'
+        verbose_name = _('User Payment Summary')
+        verbose_name_plural = _('User Payment Summaries')
+    
+    @classmethod
+    def get_for_user(cls, user):
+        """ Returns the user's summary, refreshing it first if it is missing or was refreshed before today. """
+        summary = get_object_or_None(cls, user_id=user.id)
+        if summary is None or summary.refreshed_at.date() < now().date():
+            cls.refresh_for_users([user.id])
+            summary = cls.objects.get(user_id=user.id)
+        return summary
+    
+    @classmethod
+    def refresh_for_users(cls, user_ids):
+        """ Recomputes and saves the summaries of the given users, using one query per source table.
+            @param user_ids: A list of user ids """
+        if not user_ids:
+            return
+        from django.contrib.auth import get_user_model
+        # skips users that were deleted in the meantime
+        user_ids = list(get_user_model().objects.filter(id__in=set(user_ids)).values_list('id', flat=True))
+        refreshed_at = now()
+        one_year = refreshed_at - timedelta(days=360)
+        debit_amount = Case(*[When(debit_period=debit_period, then=F('amount') * months)
+                              for debit_period, months in Payment.DEBIT_PERIOD_MONTHS.items()],
+                            default=F('amount'), output_field=models.FloatField())
+        payment_figures = dict([(row['user_id'], row) for row in
+            Payment.objects.filter(user_id__in=user_ids, status=Payment.STATUS_PAID)\
+                .values('user_id').order_by('user_id')\
+                .annotate(lifetime_paid_sum=Sum(debit_amount),
+                          year_paid_sum=Sum(debit_amount, filter=Q(completed_at__gt=one_year)),
+                          last_paid_at=Max('completed_at'))])
+        active_subscription_ids = dict(Subscription.objects.filter(user_id__in=user_ids, state=Subscription.STATE_2_ACTIVE)\
+                                       .values_list('user_id', 'id'))
+        invoice_counts = dict(Invoice.objects.filter(user_id__in=user_ids).values('user_id').order_by('user_id')\
+                              .annotate(count=Count('id')).values_list('user_id', 'count'))
+        summaries = []
+        for user_id in user_ids:
+            figures = payment_figures.get(user_id, {})
+            summaries.append(cls(
+                user_id=user_id,
+                lifetime_paid_sum=figures.get('lifetime_paid_sum') or 0.0,
+                year_paid_sum=figures.get('year_paid_sum') or 0.0,
+                last_paid_at=figures.get('last_paid_at'),
+                active_subscription_id=active_subscription_ids.get(user_id),
+                invoice_count=invoice_counts.get(user_id, 0),
+                refreshed_at=refreshed_at,
+            ))
+        cls.objects.bulk_create(summaries, update_conflicts=True, unique_fields=['user'],
+            update_fields=['lifetime_paid_sum', 'year_paid_sum', 'last_paid_at', 'active_subscription',
+                           'invoice_count', 'refreshed_at'])
+    
+    @classmethod
+    def refresh_on_commit(cls, user_id):
+        """ Refreshes the user's summary once the current transaction commits (or right away outside
+            of a transaction). All users changed in the same transaction are refreshed together, with a
+            single commit callback. Called from the `save()` and `delete()` of payments, subscriptions
+            and invoices. """
+        if user_id is None:
+            return
+        connection = transaction.get_connection()
+        pending_ref = getattr(connection, '_payments_pending_summary_refresh', None)
+        pending = pending_ref() if pending_ref is not None else None
+        if pending is None or pending.done:
+            pending = _PendingSummaryRefresh()
+            pending.add(user_id)
+            connection._payments_pending_summary_refresh = weakref.ref(pending)
+            transaction.on_commit(pending)
+        else:
+            pending.add(user_id)
+
+
+class _PendingSummaryRefresh(set):
+    """ The commit callback that refreshes the summaries of the users changed in the current transaction.
+        The connection only keeps a weak reference to it: if the transaction (or the savepoint it was
+        registered in) is rolled back, Django drops the callback and the next change registers a new one. """
+    
+    done = False
+    
+    def __call__(self):
+        self.done = True
+        UserPaymentSummary.refresh_for_users(list(self))
+
+
+class BillingRun(models.Model):
+    """ The ledger of the daily subscription billing, one per run date.
+        A run that was interrupted (e.g. by a crash or a deploy) is resumed by the next run on the
+        same date. Its items record the outcome for each subscription, see `BillingRunItem`. """
+    
+    run_date = models.DateField(_('Run date'), unique=True, editable=False)
+    started_at = models.DateTimeField(verbose_name=_('Started at'), editable=False, default=now)
+    finished_at = models.DateTimeField(verbose_name=_('Finished at'), editable=False, blank=True, null=True,
+        help_text='Unset while the run is in progress, or if it was interrupted.')
+    attempts = models.PositiveSmallIntegerField(_('Attempts'), default=0, editable=False,
+        help_text='How often the run was started. More than one means it was resumed.')
+    stats = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder, editable=False,
+        help_text='The counts and timings of the last attempt.')
+    
+    class Meta(object):
+        app_label = 'wechange_payments'
+        ordering = ('-run_date',)
+        verbose_name = _('Billing Run')
+        verbose_name_plural = _('Billing Runs')
+    
+    @classmethod
+    def start(cls, run_date):
+        """ Returns the billing run for the given date, starting or resuming it. """
+        billing_run, __ = cls.objects.get_or_create(run_date=run_date)
+        billing_run.attempts += 1
+        billing_run.started_at = now()
+        billing_run.finished_at = None
+        billing_run.save(update_fields=['attempts', 'started_at', 'finished_at'])
+        return billing_run
+    
+    def finish(self, stats):
+        self.finished_at = now()
+        self.stats = stats
+        self.save(update_fields=['finished_at', 'stats'])
+
+
+class BillingRunItem(models.Model):
+    """ Records the booking of one due payment of a subscription. The `idempotency_key` is derived from
+        the subscription and its `next_due_date`, so each due payment can only ever be claimed once.
+        
+        An item is claimed (and committed) *before* the payment provider is called, and finished
+        with the outcome afterwards. An item that is still claimed on a later run means that its
+        run died while the provider was being called. As the payment may have been made at the
+        provider, such an item is never booked again automatically. """
+    
+    # claimed, the provider is being called (or the run died while calling it)
+    STATE_0_CLAIMED = 0
+    # the payment was made
+    STATE_1_BOOKED = 1
+    # the payment could not be made. it is retried on the next run date
+    STATE_2_FAILED = 2
+    
+    STATES = (
+        (STATE_0_CLAIMED, _('Claimed')),
+        (STATE_1_BOOKED, _('Booked')),
+        (STATE_2_FAILED, _('Failed')),
+    )
+    
+    billing_run = models.ForeignKey('wechange_payments.BillingRun', verbose_name=_('Billing Run'),
+        related_name='items', on_delete=models.CASCADE, editable=False,
+        help_text='The run of the last attempt.')
+    subscription = models.ForeignKey('wechange_payments.Subscription', verbose_name=_('Subscription'),
+        related_name='billing_run_items', on_delete=models.CASCADE, editable=False)
+    idempotency_key = models.CharField(_('Idempotency key'), max_length=50, unique=True, editable=False)
+    state = models.PositiveSmallIntegerField(_('State'), choices=STATES, default=STATE_0_CLAIMED, editable=False)
+    payment = models.ForeignKey('wechange_payments.Payment', verbose_name=_('Payment'),
+        related_name='+', on_delete=models.SET_NULL, null=True, blank=True, editable=False)
+    previous_payment_id = models.PositiveIntegerField(_('Previous payment id'), null=True, blank=True, editable=False,
+        help_text='The last payment of the subscription at claim time, to find a payment of an interrupted booking.')
+    attempts = models.PositiveSmallIntegerField(_('Attempts'), default=0, editable=False)
+    claimed_at = models.DateTimeField(verbose_name=_('Claimed at'), editable=False, default=now)
+    finished_at = models.DateTimeField(verbose_name=_('Finished at'), editable=False, blank=True, null=True)
+    
+    class Meta(object):
+        app_label = 'wechange_payments'
+        ordering = ('-claimed_at',)
+        verbose_name = _('Billing Run Item')
+        verbose_name_plural = _('Billing Run Items')
+    
+    @classmethod
+    def make_idempotency_key(cls, subscription):
+        return '%d:%s' % (subscription.id, subscription.next_due_date.isoformat())
+    
+    @classmethod
+    def claim(cls, billing_run, subscription):
+        """ Claims the booking of the subscription's current due payment in the given run.
+            Must be called while holding a lock on the subscription.
+            @return: The claimed item, or None if the payment was already booked, was already attempted
+                in this run, or its earlier booking was interrupted """
+        key = cls.make_idempotency_key(subscription)
+        item = get_object_or_None(cls, idempotency_key=key)
+        if item is None:
+            return cls.objects.create(
+                billing_run=billing_run,
+                subscription=subscription,
+                idempotency_key=key,
+                previous_payment_id=subscription.last_payment_id,
+                attempts=1,
+            )
+        if item.state == cls.STATE_1_BOOKED:
+            return None
+        if item.state == cls.STATE_2_FAILED:
+            if item.billing_run_id == billing_run.id:
+                return None
+            item.billing_run = billing_run
+            item.state = cls.STATE_0_CLAIMED
+            item.attempts += 1
+            item.claimed_at = now()
+            item.finished_at = None
+            item.save()
+            return item
+        
+        # the item is still claimed: its run died while booking the payment
+        payment = Payment.objects.filter(subscription=subscription, is_reference_payment=False,
+                                         id__gt=item.previous_payment_id or 0).order_by('-id').first()
+        if payment is not None:
+            logger.warning('Payments: Found the payment of an interrupted billing run booking, marking it as booked.',
+                           extra={'subscription_id': subscription.id, 'idempotency_key': key, 'payment_id': payment.id})
+            item.finish(payment)
+        else:
+            logger.critical('Payments: NEED TO INVESTIGATE! A billing run died while booking the payment of a subscription. The provider may have made the payment, so it will not be booked again automatically! Check the provider and mark the billing run item as failed to retry.',
+                            extra={'subscription_id': subscription.id, 'idempotency_key': key, 'billing_run_item_id': item.id})
+        return None
+    
+    def finish(self, payment):
+        """ Records the outcome of the booking.
+            @param payment: The booked payment, or None if no payment could be made """
+        self.payment = payment
+        self.state = self.STATE_1_BOOKED if payment is not None else self.STATE_2_FAILED
+        self.finished_at = now()
+        self.save(update_fields=['payment', 'state', 'finished_at'])
+
+
+class InvoiceBlob(models.Model):
+    """ An invoice file, stored once under the hash of its content. All invoices with the same file
+        content point to the same blob (and their `file` field to its file), so re-downloaded invoices
+        don't leave duplicate files behind.
+        
+        `ref_count` counts the invoices using the blob. Blobs that are no longer used are deleted by the
+        `maintain_invoice_blobs` management command, which also compresses the files of old blobs and
+        verifies their integrity. """
+    
+    # the file extension of gzip-compressed blob files
+    COMPRESSED_SUFFIX = '.gz'
+    
+    sha256 = models.CharField(_('SHA-256'), max_length=64, unique=True, editable=False,
+        help_text='The hash of the uncompressed file content.')
+    file = models.FileField(_('File'), max_length=250, upload_to=_get_invoice_blob_filename, editable=False)
+    size = models.PositiveIntegerField(_('Size'), editable=False,
+        help_text='The size of the uncompressed file content in bytes.')
+    stored_size = models.PositiveIntegerField(_('Stored size'), editable=False)
+    is_compressed = models.BooleanField(_('Is compressed'), default=False, editable=False)
+    ref_count = models.IntegerField(_('Reference count'), default=0, editable=False)
+    created = models.DateTimeField(verbose_name=_('Created'), editable=False, auto_now_add=True)
+    compression_checked_at = models.DateTimeField(verbose_name=_('Compression checked at'), editable=False,
+        blank=True, null=True)
+    verified_at = models.DateTimeField(verbose_name=_('Verified at'), editable=False, blank=True, null=True)
+    
+    class Meta(object):
+        app_label = 'wechange_payments'
+        ordering = ('-created',)
+        verbose_name = _('Invoice Blob')
+        verbose_name_plural = _('Invoice Blobs')
+    
+    @classmethod
+    def store(cls, content):
+        """ Returns the blob for the given file content, storing it first if it does not exist yet,
+            and counts a new reference to it. Must be called inside a transaction.
+            @param content: The uncompressed file content as bytes """
+        digest = hashlib.sha256(content).hexdigest()
+        blob = cls.objects.select_for_update().filter(sha256=digest).first()
+        if blob is None:
+            blob = cls(sha256=digest, size=len(content), stored_size=len(content))
+            blob.file.save('invoice.pdf', ContentFile(content), save=False)
+            try:
+                with transaction.atomic():
+                    blob.save()
+            except IntegrityError:
+                # stored concurrently by another thread, which got the file name
+                blob.file.storage.delete(blob.file.name)
+                blob = cls.objects.select_for_update().get(sha256=digest)
+        cls.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+        return blob
+    
+    @classmethod
+    def release(cls, blob_id):
+        """ Counts a removed reference to a blob. Unused blobs are deleted by the `maintain_invoice_blobs` command. """
+        if blob_id is not None:
+            cls.objects.filter(pk=blob_id).update(ref_count=F('ref_count') - 1)
+    
+    def read(self):
+        """ @return: The uncompressed file content as bytes """
+        with self.file.storage.open(self.file.name, 'rb') as blob_file:
+            content = blob_file.read()
+        return gzip.decompress(content) if self.is_compressed else content
+    
+    def get_admin_change_url(self):
+        """ Returns the django admin edit page for this object. """
+        return reverse('admin:wechange_payments_invoiceblob_change', kwargs={'object_id': self.id})
+
+
 class BaseInvoice(models.Model):
     
     # not created yet at the provider. if an invoice is stuck at this state, the api might not be available
@@ -575,6 +1139,9 @@ class BaseInvoice(models.Model):
         help_text='An indicator flag to show that the invoice has been created in the invoice provider and can be downloaded')
     
     file = models.FileField(_('File'), blank=True, null=True, max_length=250, upload_to=_get_invoice_filename, editable=False)
+    blob = models.ForeignKey('wechange_payments.InvoiceBlob', verbose_name=_('Blob'), related_name='+',
+        on_delete=models.PROTECT, blank=True, null=True, editable=False,
+        help_text='The stored file content. `file` points to the file of this blob.')
     provider_id = models.CharField(_('Provider Invoice ID'), max_length=255, blank=True, null=True, editable=False)
     backend = models.CharField(_('Invoice Provider Backend class used'), max_length=255, editable=False)
     extra_data = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder,
@@ -588,6 +1155,19 @@ class BaseInvoice(models.Model):
         abstract = True
         ordering = ('-created',)
     
+    def store_file(self, content):
+        """ Sets the invoice's file to the given content, stored as (deduplicated) `InvoiceBlob`.
+            Must be called inside a transaction, which should also save the invoice.
+            @param content: The file content as bytes """
+        previous_blob_id = self.blob_id
+        self.blob = InvoiceBlob.store(content)
+        self.file.name = self.blob.file.name
+        InvoiceBlob.release(previous_blob_id)
+    
+    @property
+    def is_file_compressed(self):
+        return bool(self.file) and self.file.name.endswith(InvoiceBlob.COMPRESSED_SUFFIX)
+    
     def get_absolute_url(self):
         return reverse('wechange-payments:invoice-detail', kwargs={'pk': self.pk})
 
@@ -610,6 +1190,16 @@ class Invoice(BaseInvoice):
         help_text='The payment for which this main invoice is created.')
     user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('User'),
         editable=False, related_name='invoices', on_delete=models.CASCADE, null=False)
+    
+    def save(self, *args, **kwargs):
+        super(Invoice, self).save(*args, **kwargs)
+        UserPaymentSummary.refresh_on_commit(self.user_id)
+    
+    def delete(self, *args, **kwargs):
+        user_id = self.user_id
+        ret = super(Invoice, self).delete(*args, **kwargs)
+        UserPaymentSummary.refresh_on_commit(user_id)
+        return ret
         
 
 class AdditionalInvoice(BaseInvoice):
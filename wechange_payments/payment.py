@@ -1,25 +1,37 @@
 # -*- coding: utf-8 -*-
 
 from wechange_payments.conf import settings
+from asgiref.sync import async_to_sync, sync_to_async
 from django.db import transaction
 from django.utils.timezone import now
 
+import asyncio
+from functools import partial
 import logging
-from wechange_payments.models import Subscription, Payment
+import time
+from wechange_payments.models import Subscription, Payment, BillingRun, BillingRunItem
 from wechange_payments.backends import get_backend
 from datetime import timedelta
 from wechange_payments.mails import PAYMENT_EVENT_NEW_SUBSCRIPTION_CREATED,\
     PAYMENT_EVENT_NEW_REPLACEMENT_SUBSCRIPTION_CREATED,\
-    send_payment_event_payment_email, PAYMENT_EVENT_SUCCESSFUL_PAYMENT,\
+    send_payment_event_payment_email, PAYMENT_EVENT_SUCCESSFUL_PAYMENT, batched_payment_emails,\
     PAYMENT_EVENT_SUBSCRIPTION_AMOUNT_CHANGED,\
     PAYMENT_EVENT_SUBSCRIPTION_TERMINATED, PAYMENT_EVENT_SUBSCRIPTION_SUSPENDED,\
     PAYMENT_EVENT_SUBSCRIPTION_PAYMENT_PRE_NOTIFICATION
-from wechange_payments.utils.utils import send_admin_mail_notification
+from wechange_payments.utils.utils import send_admin_mail_notification, chunked,\
+    run_in_worker_threads
+from wechange_payments.utils.transaction_log import buffered_transaction_logs
+from wechange_payments.utils.metrics import instrumented, timer, increment
 from wechange_payments import signals
 
 logger = logging.getLogger('wechange-payments')
 
+# the relations of a subscription that its payment event mails need. loaded along with the subscriptions
+# of the daily processing, without locking their rows
+MAIL_RELATED_FIELDS = ('user__cosinnus_profile', 'reference_payment', 'last_payment')
 
+
+@instrumented('payment.create_subscription_for_payment')
 def create_subscription_for_payment(payment):
     """ Creates the subscription object for a user after the initial payment 
         for the subscription has completed successfully. 
@@ -98,101 +110,421 @@ def create_subscription_for_payment(payment):
     return subscription
 
 
-def process_due_subscription_payments():
+def process_due_subscription_payments(stats=None):
     """ Main loop for subscription management. Checks all subscriptions for
         validity, terminates expired subscriptions, activates waiting subscriptions
-        and triggers payments on active subscriptions where a payment is due. """
-    
+        and triggers payments on active subscriptions where a payment is due.
+
+        Only subscriptions that have a payment or a pre-notification due are selected (see
+        `SubscriptionQuerySet`). These are split into chunks of `PAYMENTS_BILLING_CHUNK_SIZE` and processed
+        by up to `PAYMENTS_BILLING_MAX_WORKERS` worker threads. Each subscription is row-locked
+        while being processed, so no two workers or cron hosts can ever book the same subscription.
+
+        @param stats: If a dict is given, it will be filled with counts and timings of the run.
+        @return: tuple (number of ended subscriptions, number of booked subscriptions) """
+
+    if stats is None:
+        stats = {}
+    started = time.monotonic()
+    today = now().date()
+
     ended_subscriptions = 0
-    # check for terminating subs, and activate valid waiting subs, afterwards all active subs will be valid 
-    for ending_sub in Subscription.objects.filter(state=Subscription.STATE_1_CANCELLED_BUT_ACTIVE):
-        try:
-            ended = ending_sub.validate_state_and_cycle()
-            if ended:
-                ended_subscriptions += 1
-        except Exception as e:
-            logger.error('Payments: Exception during the call validate_state_and_cycle on a subscription! This is critical and needs to be fixed!', 
-                         extra={'user': ending_sub.user, 'subscription': ending_sub, 'exception': e})
-            if settings.DEBUG:
-                raise
-            return (ended_subscriptions, 0)
+    # check for terminating subs, and activate valid waiting subs, afterwards all active subs will be valid
+    with timer('billing.termination', count_queries=True):
+        for ending_sub in Subscription.objects.due_for_termination(today):
+            try:
+                ended = ending_sub.validate_state_and_cycle()
+                if ended:
+                    ended_subscriptions += 1
+            except Exception as e:
+                logger.error('Payments: Exception during the call validate_state_and_cycle on a subscription! This is critical and needs to be fixed!', 
+                             extra={'user': ending_sub.user, 'subscription': ending_sub, 'exception': e})
+                if settings.DEBUG:
+                    raise
+                stats['total_seconds'] = time.monotonic() - started
+                return (ended_subscriptions, 0)
+    stats['termination_seconds'] = time.monotonic() - started
     
     # switch for not-implemented postponed subscriptions
     if settings.PAYMENTS_POSTPONED_PAYMENTS_IMPLEMENTED:
-        # for each waiting sub, check to see if the user has neither an active or canceled sub 
-        # (i.e. their canceled sub was just terminated)
-        for waiting_sub in Subscription.objects.filter(state=Subscription.STATE_3_WAITING_TO_BECOME_ACTIVE):
-            active_or_canceled_sub = Subscription.get_current_for_user(waiting_sub.user)
-            if not active_or_canceled_sub:
-                # if there were no active subs, activate the waiting sub. its due date should have
-                # been set to the last sub at creation time.
-                waiting_sub.state = Subscription.STATE_2_ACTIVE
-                waiting_sub.save()
+        with timer('billing.waiting_activation', count_queries=True):
+            # for each waiting sub, check to see if the user has neither an active or canceled sub 
+            # (i.e. their canceled sub was just terminated)
+            for waiting_sub in Subscription.objects.filter(state=Subscription.STATE_3_WAITING_TO_BECOME_ACTIVE):
+                active_or_canceled_sub = Subscription.get_current_for_user(waiting_sub.user)
+                if not active_or_canceled_sub:
+                    # if there were no active subs, activate the waiting sub. its due date should have
+                    # been set to the last sub at creation time.
+                    waiting_sub.state = Subscription.STATE_2_ACTIVE
+                    waiting_sub.save()
+    
+    # select only active subscriptions that have a payment or a pre-notification due
+    booking_started = time.monotonic()
+    # a run that died earlier today is resumed, its booked subscriptions are skipped
+    billing_run = BillingRun.start(today)
+    with timer('billing.selection', count_queries=True):
+        due_subscription_ids = set(Subscription.objects.due_for_payment(today).filter(user__is_active=True)\
+                .values_list('id', flat=True))
+        due_subscription_ids.update(Subscription.objects.due_for_pre_notification(today).filter(user__is_active=True)\
+                .values_list('id', flat=True))
+    due_subscription_ids = sorted(due_subscription_ids)
+    chunks = list(chunked(due_subscription_ids, settings.PAYMENTS_BILLING_CHUNK_SIZE))
+    process_chunk = _process_active_subscription_chunk
+    if settings.PAYMENTS_BILLING_ASYNC and not settings.PAYMENTS_POSTPONED_PAYMENTS_IMPLEMENTED:
+        process_chunk = _process_active_subscription_chunk_async
+    # pre-notifications and payments are measured per subscription, the queries of the worker threads are not counted here
+    with timer('billing.booking'):
+        chunk_results = run_in_worker_threads(partial(process_chunk, billing_run), chunks, 
+                                              settings.PAYMENTS_BILLING_MAX_WORKERS)
+    booked_subscriptions = sum([booked for booked, __, __ in chunk_results])
+    skipped_locked = sum([skipped for __, skipped, __ in chunk_results])
+    skipped_completed = sum([skipped for __, __, skipped in chunk_results])
+    increment('billing.booked_subscriptions', booked_subscriptions)
+    increment('billing.skipped_locked_subscriptions', skipped_locked)
+    increment('billing.skipped_completed_subscriptions', skipped_completed)
     
+    stats.update({
+        'due_subscriptions': len(due_subscription_ids),
+        'chunks': len(chunks),
+        'workers': min(settings.PAYMENTS_BILLING_MAX_WORKERS, len(chunks)),
+        'skipped_locked': skipped_locked,
+        'skipped_completed': skipped_completed,
+        'billing_run_attempt': billing_run.attempts,
+        'booking_seconds': time.monotonic() - booking_started,
+        'total_seconds': time.monotonic() - started,
+    })
+    billing_run.finish(dict(stats, ended_subscriptions=ended_subscriptions, booked_subscriptions=booked_subscriptions))
+    return (ended_subscriptions, booked_subscriptions)
+
+
+def _process_active_subscription_chunk(billing_run, subscription_ids):
+    """ Processes a chunk of active subscriptions. Each subscription is processed in its own
+        transaction, while holding a row lock on it. Rows already locked by another worker or
+        cron host are skipped. The subscription is re-read after the lock is acquired, so it is
+        only booked if it is still active and due.
+        
+        The booking of a due payment is first claimed in the billing run's ledger (see `BillingRunItem`)
+        and committed, and only then made (see `_book_claimed_subscription()`). So if the run dies, a resumed run
+        skips all payments that were booked or might have been booked already.
+        @return: tuple (number of booked subscriptions, number of subscriptions skipped because of locks,
+            number of subscriptions skipped because their payment was already handled) """
+    with buffered_transaction_logs(), batched_payment_emails():
+        return _process_active_subscription_chunk_ids(billing_run, subscription_ids)
+
+
+def _process_active_subscription_chunk_ids(billing_run, subscription_ids):
     booked_subscriptions = 0
-    # check active subscriptions for due pre-notifications or payments
-    for active_sub in Subscription.objects.filter(state=Subscription.STATE_2_ACTIVE):
-        # check if pre-notification should be sent for SEPA subscription
-        if active_sub.check_pre_notification_due() and active_sub.user.is_active:
-            try:
-                send_pre_notification_for_subscription_payment(active_sub)
-            except Exception as e:
-                logger.error('Payments: Exception while trying to send a pre-notification for a subscription that has its notification due!', 
-                         extra={'user': active_sub.user, 'subscription': active_sub, 'exception': e})
-                if settings.DEBUG:
-                    raise
-                
-        # if an active subscription has its payment is due trigger a new payment on it
-        if active_sub.check_payment_due() and active_sub.user.is_active:
-            try:
-                if active_sub.has_pending_payment():
-                    # if a  subscription's recurring payment is still pending, we do not book another payment
-                    if active_sub.last_payment.last_action_at < (now() - timedelta(days=1)):
-                        # but if the payment has been made over 1 day ago and is still due, we trigger a critical alert!
-                        extra={'user': active_sub.user, 'subscription': active_sub, 'internal_transaction_id': str(active_sub.last_payment.internal_transaction_id)}
-                        logger.critical('Payments: A recurring payment that has been started over 1 day ago still has its status at pending and has not received a postback! Only postbacks can set payments to not pending. The subscription is therefore also pending and is basically frozen. This needs to be investigated manually!', extra=extra)
+    skipped_subscriptions = 0
+    completed_subscriptions = 0
+    for subscription_id in subscription_ids:
+        try:
+            with transaction.atomic():
+                active_sub = Subscription.objects.select_for_update(skip_locked=True, of=('self',))\
+                        .select_related(*MAIL_RELATED_FIELDS)\
+                        .filter(id=subscription_id, state=Subscription.STATE_2_ACTIVE).first()
+                if active_sub is None:
+                    # locked by a different worker, or no longer active
+                    skipped_subscriptions += 1
+                    continue
+                if not _prepare_active_subscription(active_sub):
                     continue
-                payment_or_none = book_next_subscription_payment(active_sub)
-                if payment_or_none is not None:
-                    booked_subscriptions += 1
+                billing_run_item = BillingRunItem.claim(billing_run, active_sub)
+                if billing_run_item is None:
+                    completed_subscriptions += 1
+                    continue
+            # the claim is committed now, before the provider is called
+            if _book_claimed_subscription(billing_run_item):
+                booked_subscriptions += 1
+        except Exception as e:
+            logger.error('Payments: Exception while locking or processing a due subscription!',
+                     extra={'subscription_id': subscription_id, 'exception': e})
+            if settings.DEBUG:
+                raise
+    return (booked_subscriptions, skipped_subscriptions, completed_subscriptions)
+
+
+def _book_claimed_subscription(billing_run_item):
+    """ Books the next payment of the subscription of a claimed `BillingRunItem`, and records the outcome in the item.
+        The provider is called without an open transaction, see `_prepare_claimed_subscriptions()` and
+        `_save_subscription_payment()` for the steps before and after. If the provider call or saving its result
+        raises an exception, the outcome is unknown, so the item stays claimed and is not booked again automatically.
+        @return: True if a payment was booked, False otherwise """
+    bookings = _prepare_claimed_subscriptions([billing_run_item])
+    if not bookings:
+        return False
+    active_sub, billing_run_item, reference_payment, prepared = bookings[0]
+    try:
+        payment, error = _request_subscription_payment(reference_payment, prepared)
+        payment = _save_subscription_payment(active_sub, reference_payment, prepared, payment, error,
+                                             billing_run_item=billing_run_item)
+    except Exception as e:
+        logger.error('Payments: Exception while trying to book the next subscruption payment for a due subscription!', 
+                 extra={'user': active_sub.user, 'subscription': active_sub, 'exception': e})
+        if settings.DEBUG:
+            raise
+        return False
+    return payment is not None
+
+
+def _prepare_claimed_subscriptions(billing_run_items):
+    """ Locks the subscriptions of claimed `BillingRunItem`s and prepares their next payments, in one short
+        transaction. The safety check figures of their users are computed under the lock, right before
+        the checks, so they include every payment that was booked before.
+        Items whose subscription was changed since the claim, or whose payment may not be made, are finished here.
+        @return: list of tuples (subscription, `BillingRunItem`, reference payment, prepared payment), see
+            `_prepare_subscription_payment()`, for the payments that should be requested from the provider """
+    bookings = []
+    with transaction.atomic():
+        claimed_subs = Subscription.objects.select_for_update(of=('self',))\
+                .select_related(*MAIL_RELATED_FIELDS).filter(state=Subscription.STATE_2_ACTIVE,
+                id__in=[item.subscription_id for item in billing_run_items]).order_by('id').in_bulk()
+        locked_subs = []
+        for billing_run_item in billing_run_items:
+            active_sub = claimed_subs.get(billing_run_item.subscription_id)
+            if active_sub is None or BillingRunItem.make_idempotency_key(active_sub) != billing_run_item.idempotency_key:
+                # the subscription was changed since it was claimed
+                billing_run_item.finish(None)
+                continue
+            locked_subs.append((active_sub, billing_run_item))
+        if not locked_subs:
+            return bookings
+        
+        safety_figures = get_backend().get_recurring_payment_safety_figures(
+            [active_sub.user_id for active_sub, __ in locked_subs])
+        for active_sub, billing_run_item in locked_subs:
+            try:
+                with transaction.atomic():
+                    reference_payment, prepared, error = _prepare_subscription_payment(active_sub,
+                                                    safety_figures=safety_figures[active_sub.user_id])
+                    if reference_payment is not None and error is None:
+                        bookings.append((active_sub, billing_run_item, reference_payment, prepared))
+                        continue
+                    if error is not None:
+                        _handle_next_subscription_payment_result(active_sub, None, error)
+                    billing_run_item.finish(None)
             except Exception as e:
-                logger.error('Payments: Exception while trying to book the next subscruption payment for a due subscription!', 
+                # the provider was not called yet, so the payment can be retried on the next run date
+                logger.error('Payments: Exception while preparing the next subscription payment for a due subscription!', 
                          extra={'user': active_sub.user, 'subscription': active_sub, 'exception': e})
                 if settings.DEBUG:
                     raise
-    
-    return (ended_subscriptions, booked_subscriptions)
+                billing_run_item.finish(None)
+    return bookings
+
+
+def _process_active_subscription_chunk_async(billing_run, subscription_ids):
+    """ Processes a chunk of active subscriptions like `_process_active_subscription_chunk()`, but books
+        all due payments concurrently using the async backend API (see `PAYMENTS_BILLING_ASYNC`).
+        All subscriptions of the chunk are locked and their bookings are claimed in one transaction. Then they
+        are locked again and prepared in a second, short transaction (see `_prepare_claimed_subscriptions()`).
+        The payment requests are made without an open transaction, and the result of each is saved in its
+        own transaction. The DB work of the async calls runs in this thread.
+        @return: tuple (number of booked subscriptions, number of subscriptions skipped because of locks,
+            number of subscriptions skipped because their payment was already handled) """
+    booked_subscriptions = 0
+    completed_subscriptions = 0
+    billing_run_items = []
+    with buffered_transaction_logs(), batched_payment_emails():
+        with transaction.atomic():
+            active_subs = list(Subscription.objects.select_for_update(skip_locked=True, of=('self',))\
+                    .select_related(*MAIL_RELATED_FIELDS).filter(id__in=subscription_ids, state=Subscription.STATE_2_ACTIVE).order_by('id'))
+            # locked by a different worker, or no longer active
+            skipped_subscriptions = len(subscription_ids) - len(active_subs)
+            for active_sub in active_subs:
+                try:
+                    with transaction.atomic():
+                        if not _prepare_active_subscription(active_sub):
+                            continue
+                        billing_run_item = BillingRunItem.claim(billing_run, active_sub)
+                        if billing_run_item is None:
+                            completed_subscriptions += 1
+                            continue
+                        billing_run_items.append(billing_run_item)
+                except Exception as e:
+                    logger.error('Payments: Exception while processing a due subscription!',
+                             extra={'subscription_id': active_sub.id, 'exception': e})
+                    if settings.DEBUG:
+                        raise
+        
+        # the claims are committed now, before the provider is called
+        if billing_run_items:
+            bookings = _prepare_claimed_subscriptions(billing_run_items)
+            if bookings:
+                booked_subscriptions = async_to_sync(_abook_subscription_payments)(bookings)
+    return (booked_subscriptions, skipped_subscriptions, completed_subscriptions)
 
 
-def book_next_subscription_payment(subscription):
+async def _abook_subscription_payments(bookings):
+    """ Concurrently books the next payments for the given prepared subscriptions, sharing one transport.
+        @param bookings: list of tuples, see `_prepare_claimed_subscriptions()`
+        @return: The number of booked subscriptions """
+    async with get_backend().open_async_transport() as transport:
+        results = await asyncio.gather(*[_abook_subscription_payment(booking, transport) for booking in bookings])
+    return sum(results)
+
+
+async def _abook_subscription_payment(booking, transport):
+    subscription, billing_run_item, reference_payment, prepared = booking
+    try:
+        payment, error = await _arequest_subscription_payment(reference_payment, prepared, transport=transport)
+        payment = await sync_to_async(_save_subscription_payment)(subscription, reference_payment, prepared,
+                                                                  payment, error, billing_run_item=billing_run_item)
+    except Exception as e:
+        # the outcome is unknown, so the billing run item stays claimed
+        logger.error('Payments: Exception while trying to book the next subscruption payment for a due subscription!', 
+                 extra={'subscription_id': subscription.id, 'exception': e})
+        if settings.DEBUG:
+            raise
+        return 0
+    return 1 if payment is not None else 0
+
+
+def _prepare_active_subscription(active_sub):
+    """ Sends a due pre-notification for an active subscription and checks if its next payment
+        should be booked now.
+        @return: True if a payment should be booked, False otherwise """
+    # check if pre-notification should be sent for SEPA subscription
+    if active_sub.check_pre_notification_due() and active_sub.user.is_active:
+        try:
+            send_pre_notification_for_subscription_payment(active_sub)
+        except Exception as e:
+            logger.error('Payments: Exception while trying to send a pre-notification for a subscription that has its notification due!', 
+                     extra={'user': active_sub.user, 'subscription': active_sub, 'exception': e})
+            if settings.DEBUG:
+                raise
+            
+    # if an active subscription has its payment is due trigger a new payment on it
+    if active_sub.check_payment_due() and active_sub.user.is_active:
+        try:
+            if active_sub.has_pending_payment():
+                # if a  subscription's recurring payment is still pending, we do not book another payment
+                if active_sub.last_payment.last_action_at < (now() - timedelta(days=1)):
+                    # but if the payment has been made over 1 day ago and is still due, we trigger a critical alert!
+                    extra={'user': active_sub.user, 'subscription': active_sub, 'internal_transaction_id': str(active_sub.last_payment.internal_transaction_id)}
+                    logger.critical('Payments: A recurring payment that has been started over 1 day ago still has its status at pending and has not received a postback! Only postbacks can set payments to not pending. The subscription is therefore also pending and is basically frozen. This needs to be investigated manually!', extra=extra)
+                return False
+            return True
+        except Exception as e:
+            logger.error('Payments: Exception while trying to book the next subscruption payment for a due subscription!', 
+                     extra={'user': active_sub.user, 'subscription': active_sub, 'exception': e})
+            if settings.DEBUG:
+                raise
+    return False
+
+
+@instrumented('payment.book_next_subscription_payment')
+def book_next_subscription_payment(subscription, safety_figures=None):
     """ Will create and book a new payment (using the reference payment as target) 
         for the current `amount` of money.
-        Afterwards, will set the next due date for this subscription. """
-    # check due date has passed and state is active!
-    if not subscription.check_payment_due() or not subscription.state == Subscription.STATE_2_ACTIVE:
-        logger.error('Payments: Prevented a call to a subscription payment on an inactive or not due subscription!', 
-                         extra={'user': subscription.user, 'subscription': subscription})
-        return 
-    
-    backend = get_backend()
-    reference_payment = subscription.reference_payment
+        Afterwards, will set the next due date for this subscription.
+        The provider is called between two transactions, so do not call this inside a transaction.
+        @param safety_figures: The user's precomputed `SafetyCheckFigures` (see `get_recurring_payment_safety_figures()`) """
+    reference_payment, prepared, error = _prepare_subscription_payment(subscription, safety_figures=safety_figures)
+    if reference_payment is None:
+        return
+    payment = None
+    if error is None:
+        payment, error = _request_subscription_payment(reference_payment, prepared)
+    return _save_subscription_payment(subscription, reference_payment, prepared, payment, error)
+
+
+async def abook_next_subscription_payment(subscription, transport=None, safety_figures=None):
+    """ Async variant of `book_next_subscription_payment()`, using the backend's `arequest_recurring_payment()`.
+        Cash-ins of postponed payments are not supported.
+        @param transport: An open `AsyncHttpTransport` shared by concurrent calls """
+    reference_payment, prepared, error = await sync_to_async(_prepare_subscription_payment)(subscription,
+                                                                    safety_figures=safety_figures)
+    if reference_payment is None:
+        return
+    payment = None
+    if error is None:
+        payment, error = await _arequest_subscription_payment(reference_payment, prepared, transport=transport)
+    return await sync_to_async(_save_subscription_payment)(subscription, reference_payment, prepared, payment, error)
+
+
+def _prepare_subscription_payment(subscription, safety_figures=None):
+    """ First step of booking the next payment of a subscription: checks the subscription and runs the
+        backend's safety checks. Call this while holding the row lock on the subscription.
+        @return: tuple (reference payment, prepared payment, error message). The prepared payment is the
+            (order_id, params) of a recurring payment, or None if a postponed payment is cashed in.
+            The reference payment is None if no payment may be made. """
+    reference_payment = _get_bookable_reference_payment(subscription)
+    if reference_payment is None:
+        return (None, None, None)
     
     # make a cash-in call on a preauthorized payment, or a recurring call on a previously cashed payment 
     if reference_payment.is_postponed_payment and settings.PAYMENTS_POSTPONED_PAYMENTS_IMPLEMENTED:
         if reference_payment.status == Payment.STATUS_PREAUTHORIZED_UNPAID:
             # cash in a pre-authorized payment
-            payment, error = backend.cash_in_postponed_payment(reference_payment)
-        elif reference_payment.status == Payment.STATUS_PAID:
-            # book a new recurring payment
-            payment, error = backend.make_recurring_payment(reference_payment)
-        else:
+            return (reference_payment, None, None)
+        elif not reference_payment.status == Payment.STATUS_PAID:
             logger.error('Payments: Did not know how to make a further payment from a reference payment due to incompatible payment states!', 
                          extra={'user': subscription.user, 'subscription': subscription})
-            return
-    else:
-        payment, error = backend.make_recurring_payment(reference_payment)
+            return (None, None, None)
+    # book a new recurring payment
+    prepared = get_backend().prepare_recurring_payment(reference_payment, safety_figures=safety_figures)
+    if isinstance(prepared, str):
+        # contains error message
+        return (reference_payment, None, prepared)
+    return (reference_payment, prepared, None)
 
-    
+
+def _request_subscription_payment(reference_payment, prepared):
+    """ Second step of booking the next payment of a subscription: the provider call.
+        Runs without an open transaction, so the payment is never rolled back after the provider accepted it.
+        @return: tuple (the new payment or None, error message or None) """
+    backend = get_backend()
+    if prepared is None:
+        return backend.cash_in_postponed_payment(reference_payment)
+    order_id, params = prepared
+    return backend.request_recurring_payment(reference_payment, order_id, params)
+
+
+async def _arequest_subscription_payment(reference_payment, prepared, transport=None):
+    """ Async variant of `_request_subscription_payment()` """
+    backend = get_backend()
+    if prepared is None:
+        return await sync_to_async(backend.cash_in_postponed_payment)(reference_payment)
+    order_id, params = prepared
+    return await backend.arequest_recurring_payment(reference_payment, order_id, params, transport=transport)
+
+
+def _save_subscription_payment(subscription, reference_payment, prepared, payment, error, billing_run_item=None):
+    """ Last step of booking the next payment of a subscription: saves the new payment, the subscription
+        and the outcome in the billing run item in one short transaction, while holding the lock on the subscription.
+        @return: The saved payment, or None if no payment was made """
+    with transaction.atomic():
+        # re-read the subscription under the lock, it may have been changed during the provider call
+        locked_sub = Subscription.objects.select_for_update(of=('self',)).select_related(*MAIL_RELATED_FIELDS)\
+                .get(id=subscription.id)
+        if reference_payment.subscription_id == locked_sub.id:
+            reference_payment.subscription = locked_sub
+        if error is None and payment is not None and prepared is not None:
+            payment = get_backend().save_recurring_payment(reference_payment, payment)
+        payment = _handle_next_subscription_payment_result(locked_sub, payment, error)
+        if billing_run_item is not None:
+            billing_run_item.finish(payment)
+    return payment
+
+
+def _get_bookable_reference_payment(subscription):
+    """ @return: The subscription's reference payment, or None if no payment may be booked on it """
+    # check due date has passed and state is active!
+    if not subscription.check_payment_due() or not subscription.state == Subscription.STATE_2_ACTIVE:
+        logger.error('Payments: Prevented a call to a subscription payment on an inactive or not due subscription!', 
+                         extra={'user': subscription.user, 'subscription': subscription})
+        return None
+    reference_payment = subscription.reference_payment
+    if reference_payment is not None and reference_payment.subscription_id == subscription.id:
+        # use the loaded (and locked) subscription for the checks on the reference payment
+        reference_payment.subscription = subscription
+    return reference_payment
+
+
+@instrumented('payment.handle_next_subscription_payment_result')
+def _handle_next_subscription_payment_result(subscription, payment, error):
+    """ Retries or suspends the subscription if booking its next payment failed,
+        and saves the new payment as its last payment otherwise. """
     if error or not payment:
         # TODO: TODO-ERROR-STATE: should we always retry when we get an error back instantly, or sometimes
         # even suspend the subscription here immediately, instead of only when a postback comes back as fail? 
@@ -230,6 +562,7 @@ def book_next_subscription_payment(subscription):
     return payment
 
 
+@instrumented('payment.send_pre_notification_for_subscription_payment')
 def send_pre_notification_for_subscription_payment(subscription):
     """ Sends out a mail for a SEPA subscription that has its next payment
         upcoming soon (required by law). """
@@ -238,7 +571,8 @@ def send_pre_notification_for_subscription_payment(subscription):
         return False
     # send mail
     if settings.PAYMENTS_SEND_PRE_NOTIFICATION_MAILS:
-        sent = send_payment_event_payment_email(subscription.last_payment, PAYMENT_EVENT_SUBSCRIPTION_PAYMENT_PRE_NOTIFICATION)
+        sent = send_payment_event_payment_email(subscription.last_payment, PAYMENT_EVENT_SUBSCRIPTION_PAYMENT_PRE_NOTIFICATION,
+                                                subscription=subscription)
     else:
         # we send no mail if pre-notifications are disabled, but`subscription.last_pre_notification_at` is still
         # being updated. this is so that if this gets re-enabled, no weirdly-dated mails are sent
@@ -249,6 +583,7 @@ def send_pre_notification_for_subscription_payment(subscription):
         subscription.save()
         
 
+@instrumented('payment.handle_successful_payment')
 def handle_successful_payment(payment):
     """ Handles the actions after a successful payment was made,
         triggered either after an instantly successful payment or after  a postback was received.
@@ -278,6 +613,7 @@ def handle_successful_payment(payment):
     signals.successful_payment_made.send(sender=payment, payment=payment)
     
 
+@instrumented('payment.handle_payment_refunded')
 def handle_payment_refunded(payment, status=None):
     """ Handles the case when we receive notification of a refunded payment.
         Since we have no automatism for this yet, we send out an email to the portal admins. """
@@ -296,6 +632,7 @@ def handle_payment_refunded(payment, status=None):
     suspend_failed_subscription(payment.subscription, payment=payment)
 
 
+@instrumented('payment.suspend_failed_subscription')
 def suspend_failed_subscription(subscription, payment=None):
     """ For various reasons, like failed payments to refunds pulled on a payment,
         this sets a subscription into a suspended "has problems and failed" state, where
@@ -313,19 +650,21 @@ def suspend_failed_subscription(subscription, payment=None):
         subscription.save()
         logger.info('Payments: Suspended a subscription for a user because of one or more failed payments',
             extra={'user': subscription.user.id, 'subscription_id': subscription.id})
-        send_payment_event_payment_email(subscription.last_payment, PAYMENT_EVENT_SUBSCRIPTION_SUSPENDED)
+        send_payment_event_payment_email(subscription.last_payment, PAYMENT_EVENT_SUBSCRIPTION_SUSPENDED, subscription=subscription)
 
 
+@instrumented('payment.cancel_subscription')
 def cancel_subscription(user):
     """ Cancels the currently active or waiting subscription for a user """
     subscription = Subscription.get_current_for_user(user)
     subscription.state = Subscription.STATE_1_CANCELLED_BUT_ACTIVE
     subscription.cancelled = now()
     subscription.save()
-    send_payment_event_payment_email(subscription.last_payment, PAYMENT_EVENT_SUBSCRIPTION_TERMINATED)
+    send_payment_event_payment_email(subscription.last_payment, PAYMENT_EVENT_SUBSCRIPTION_TERMINATED, subscription=subscription)
     return True
 
 
+@instrumented('payment.terminate_suspended_subscription')
 def terminate_suspended_subscription(subscription):
     """ Terminate the suspended subscription for a user """
     if not subscription.state == Subscription.STATE_99_FAILED_PAYMENTS_SUSPENDED:
@@ -334,10 +673,11 @@ def terminate_suspended_subscription(subscription):
     subscription.state = Subscription.STATE_0_TERMINATED
     subscription.cancelled = now()
     subscription.save()
-    send_payment_event_payment_email(subscription.last_payment, PAYMENT_EVENT_SUBSCRIPTION_TERMINATED)
+    send_payment_event_payment_email(subscription.last_payment, PAYMENT_EVENT_SUBSCRIPTION_TERMINATED, subscription=subscription)
     return True
     
 
+@instrumented('payment.change_subscription_amount')
 def change_subscription_amount(subscription, amount, debit_period):
     """ Changes the amount and/or debit_period of a subscription for a user """
     # check min/max payment amounts
@@ -356,7 +696,7 @@ def change_subscription_amount(subscription, amount, debit_period):
 
     # save subscription and send email
     subscription.save()
-    send_payment_event_payment_email(subscription.last_payment, PAYMENT_EVENT_SUBSCRIPTION_AMOUNT_CHANGED)
+    send_payment_event_payment_email(subscription.last_payment, PAYMENT_EVENT_SUBSCRIPTION_AMOUNT_CHANGED, subscription=subscription)
     return True
     
 
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 
 from django import template
-from wechange_payments.models import Invoice
+from wechange_payments.models import UserPaymentSummary
 
 register = template.Library()
 
 @register.filter
 def has_invoices(user):
     """ Template filter to check if the given user has any invoices """
-    return Invoice.objects.filter(user=user).count() > 0
+    if not user.is_authenticated:
+        return False
+    return UserPaymentSummary.get_for_user(user).invoice_count > 0
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.test.testcases import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls.base import reverse
+from django.utils.timezone import now
+
+from wechange_payments.models import Payment, Subscription, Invoice, AdditionalInvoice
+
+
+class AdminChangelistQueryCountTest(TestCase):
+    """ The admin changelists must run a constant number of queries, no matter how many rows are shown. """
+
+    changelist_urls = (
+        'admin:wechange_payments_payment_changelist',
+        'admin:wechange_payments_subscription_changelist',
+        'admin:wechange_payments_invoice_changelist',
+        'admin:wechange_payments_additionalinvoice_changelist',
+    )
+
+    def setUp(self):
+        self.admin = get_user_model().objects.create(
+            username='payments_admin',
+            email='payments_admin@mail.com',
+            is_active=True,
+            is_staff=True,
+            is_superuser=True,
+        )
+        self.client = Client()
+        self.client.force_login(self.admin)
+        self.user_count = 0
+
+    def _create_subscription_with_invoices(self):
+        self.user_count += 1
+        username = 'payments_user_%d' % self.user_count
+        user = get_user_model().objects.create(username=username, email='%s@mail.com' % username, is_active=True)
+        payment = Payment.objects.create(
+            user=user,
+            vendor_transaction_id=str(uuid.uuid4()),
+            internal_transaction_id=str(uuid.uuid4()),
+            amount=5.0,
+            status=Payment.STATUS_PAID,
+            completed_at=now(),
+            backend='wechange_payments.backends.payment.base.DummyBackend',
+        )
+        subscription = Subscription.objects.create(
+            user=user,
+            reference_payment=payment,
+            last_payment=payment,
+            state=Subscription.STATE_2_ACTIVE,
+            amount=5.0,
+            next_due_date=now().date(),
+        )
+        payment.subscription = subscription
+        payment.save()
+        Invoice.objects.create(payment=payment, user=user, backend='dummy')
+        AdditionalInvoice.objects.create(payment=payment, user=user, backend='dummy')
+
+    def _count_changelist_queries(self, url_name):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(url_name))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelist_query_counts_are_constant(self):
+        self._create_subscription_with_invoices()
+        few_rows_counts = dict([(url_name, self._count_changelist_queries(url_name)) for url_name in self.changelist_urls])
+        for __ in range(10):
+            self._create_subscription_with_invoices()
+        for url_name in self.changelist_urls:
+            self.assertEqual(self._count_changelist_queries(url_name), few_rows_counts[url_name],
+                             'Changelist "%s" runs a constant number of queries' % url_name)
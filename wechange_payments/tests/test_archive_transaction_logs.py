@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+import gzip
+from io import StringIO
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.test.testcases import TestCase
+from django.utils.timezone import now
+
+from wechange_payments.models import TransactionLog
+
+
+class ArchiveTransactionLogsTest(TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+    def test_old_logs_are_archived_and_deleted(self):
+        old_log = TransactionLog.objects.create(url='/rest/payment', data={'order_id': 'old-order', 'user': 1})
+        TransactionLog.objects.filter(id=old_log.id).update(created=now() - timedelta(days=400))
+        recent_log = TransactionLog.objects.create(url='/rest/payment', data={'order_id': 'recent-order', 'user': 1})
+
+        call_command('archive_transaction_logs', older_than_days=365, output_dir=self.output_dir, stdout=StringIO())
+
+        file_names = os.listdir(self.output_dir)
+        self.assertEqual(len(file_names), 1)
+        with gzip.open(os.path.join(self.output_dir, file_names[0]), 'rt', encoding='utf-8') as archive_file:
+            archived = [json.loads(line) for line in archive_file]
+        self.assertEqual([log['id'] for log in archived], [old_log.id])
+        self.assertEqual(archived[0]['order_id'], 'old-order')
+        self.assertEqual(list(TransactionLog.objects.values_list('id', flat=True)), [recent_log.id])
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from unittest import mock
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.test.testcases import TestCase
+from django.utils.timezone import now
+
+from wechange_payments import backends
+from wechange_payments.backends.payment.base import DummyBackend
+from wechange_payments.models import Payment, Subscription, BillingRun, BillingRunItem
+from wechange_payments.payment import _process_active_subscription_chunk_ids
+
+
+class BillingRunLedgerTest(TestCase):
+
+    def setUp(self):
+        user = get_user_model().objects.create(username='billing_user', email='billing_user@mail.com', is_active=True)
+        self.reference_payment = Payment.objects.create(
+            user=user,
+            vendor_transaction_id=str(uuid.uuid4()),
+            internal_transaction_id=str(uuid.uuid4()),
+            amount=5.0,
+            status=Payment.STATUS_PAID,
+            completed_at=now() - timedelta(days=31),
+            backend='wechange_payments.backends.payment.base.DummyBackend',
+        )
+        self.subscription = Subscription.objects.create(
+            user=user,
+            reference_payment=self.reference_payment,
+            last_payment=self.reference_payment,
+            state=Subscription.STATE_2_ACTIVE,
+            amount=5.0,
+            next_due_date=now().date(),
+        )
+
+    def _make_recurring_payment(self):
+        return Payment.objects.create(
+            user=self.subscription.user,
+            subscription=self.subscription,
+            vendor_transaction_id=str(uuid.uuid4()),
+            internal_transaction_id=str(uuid.uuid4()),
+            amount=5.0,
+            status=Payment.STATUS_PAID,
+            is_reference_payment=False,
+            backend='wechange_payments.backends.payment.base.DummyBackend',
+        )
+
+    def test_booked_payment_is_claimed_only_once(self):
+        billing_run = BillingRun.start(now().date())
+        item = BillingRunItem.claim(billing_run, self.subscription)
+        self.assertIsNotNone(item)
+        item.finish(self._make_recurring_payment())
+        # a resumed run on the same date, and any later run, skip the booked payment
+        self.assertIsNone(BillingRunItem.claim(BillingRun.start(now().date()), self.subscription))
+        self.assertIsNone(BillingRunItem.claim(BillingRun.start(now().date() + timedelta(days=1)), self.subscription))
+        self.assertEqual(BillingRun.objects.get(run_date=now().date()).attempts, 2)
+
+    def test_failed_payment_is_retried_on_the_next_run_date(self):
+        billing_run = BillingRun.start(now().date())
+        BillingRunItem.claim(billing_run, self.subscription).finish(None)
+        self.assertIsNone(BillingRunItem.claim(billing_run, self.subscription))
+        item = BillingRunItem.claim(BillingRun.start(now().date() + timedelta(days=1)), self.subscription)
+        self.assertIsNotNone(item)
+        self.assertEqual(item.attempts, 2)
+
+    def test_interrupted_claim_is_not_booked_again(self):
+        billing_run = BillingRun.start(now().date())
+        item = BillingRunItem.claim(billing_run, self.subscription)
+        # the run died while calling the provider, without a saved payment
+        self.assertIsNone(BillingRunItem.claim(BillingRun.start(now().date()), self.subscription))
+        item.refresh_from_db()
+        self.assertEqual(item.state, BillingRunItem.STATE_0_CLAIMED)
+        # the run died after the payment was saved
+        payment = self._make_recurring_payment()
+        self.assertIsNone(BillingRunItem.claim(BillingRun.start(now().date()), self.subscription))
+        item.refresh_from_db()
+        self.assertEqual(item.state, BillingRunItem.STATE_1_BOOKED)
+        self.assertEqual(item.payment, payment)
+
+
+@mock.patch.object(backends, 'BACKEND', DummyBackend())
+class BillingChunkTest(TestCase):
+
+    def _create_due_subscription(self, username):
+        user = get_user_model().objects.create(username=username, email='%s@mail.com' % username, is_active=True)
+        reference_payment = Payment.objects.create(
+            user=user,
+            vendor_transaction_id=str(uuid.uuid4()),
+            internal_transaction_id=str(uuid.uuid4()),
+            amount=5.0,
+            status=Payment.STATUS_PAID,
+            completed_at=now() - timedelta(days=31),
+            backend='wechange_payments.backends.payment.base.DummyBackend',
+        )
+        return Subscription.objects.create(
+            user=user,
+            reference_payment=reference_payment,
+            last_payment=reference_payment,
+            state=Subscription.STATE_2_ACTIVE,
+            amount=5.0,
+            next_due_date=now().date(),
+        )
+
+    def test_chunk_books_due_subscription(self):
+        subscription = self._create_due_subscription('chunk_user')
+        billing_run = BillingRun.start(now().date())
+        self.assertEqual(_process_active_subscription_chunk_ids(billing_run, [subscription.id]), (1, 0, 0))
+        subscription.refresh_from_db()
+        payment = subscription.last_payment
+        self.assertNotEqual(payment, subscription.reference_payment)
+        self.assertEqual(payment.status, Payment.STATUS_COMPLETED_BUT_UNCONFIRMED)
+        self.assertEqual(payment.subscription, subscription)
+        item = BillingRunItem.objects.get(subscription=subscription)
+        self.assertEqual(item.state, BillingRunItem.STATE_1_BOOKED)
+        self.assertEqual(item.payment, payment)
+
+    def test_chunk_skips_claimed_and_unavailable_subscriptions(self):
+        claimed_sub = self._create_due_subscription('claimed_user')
+        unavailable_sub = self._create_due_subscription('unavailable_user')
+        billing_run = BillingRun.start(now().date())
+        # already attempted earlier in this run
+        BillingRunItem.claim(billing_run, claimed_sub).finish(None)
+        # a subscription that is no longer active is skipped like one locked by a different worker
+        Subscription.objects.filter(id=unavailable_sub.id).update(state=Subscription.STATE_1_CANCELLED_BUT_ACTIVE)
+        
+        result = _process_active_subscription_chunk_ids(billing_run, [claimed_sub.id, unavailable_sub.id])
+        self.assertEqual(result, (0, 1, 1))
+        self.assertFalse(Payment.objects.filter(is_reference_payment=False).exists())
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import time
+import unittest
+import urllib
+
+from django.test.testcases import SimpleTestCase
+
+from wechange_payments.utils.checksum import ChecksumSigner
+
+
+def _reference_checksum(params, key):
+    """ The straightforward checksum calculation the signer has to match. """
+    hash_params = dict([(k, v or '') for k,v in params.items() if not k == 'checksum'])
+    query = urllib.parse.urlencode(hash_params) + key
+    return hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+
+def _best_time(func, repeat=3):
+    best = None
+    for __ in range(repeat):
+        started = time.perf_counter()
+        func()
+        duration = time.perf_counter() - started
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+class ChecksumSignerTest(SimpleTestCase):
+
+    key = '4d422da6fb8e3bb2749a'
+
+    def _make_postbacks(self, count):
+        return [{
+            'transaction_id': 'e6b1f1ac-%08d' % i,
+            'order_id': 'order %d' % i,
+            'status_code': 3,
+            'status': 'succeeded',
+            'amount': '17.50',
+            'message': None,
+            'payment_type': 'dd & cc/ü',
+        } for i in range(count)]
+
+    def test_checksums_match_reference(self):
+        signer = ChecksumSigner(self.key)
+        for params in self._make_postbacks(200):
+            self.assertEqual(signer.calculate(params), _reference_checksum(params, self.key))
+            signed = signer.sign(dict(params))
+            self.assertEqual(signer.validate(signed), (True, signed['checksum']))
+            self.assertEqual(signer.validate(dict(signed, checksum=signed['checksum'].upper()))[0], False)
+            self.assertEqual(signer.validate(params)[0], False)
+
+    @unittest.skipUnless(os.environ.get('PAYMENTS_RUN_BENCHMARKS'), 'Set PAYMENTS_RUN_BENCHMARKS=1 to run the timing benchmarks.')
+    def test_batch_throughput(self):
+        """ Micro-benchmark: signing and validating a large postback batch must stay faster than the
+            reference calculation, and above a generous absolute floor. Measures wall-clock time, so it is only
+            run on demand, on an idle machine. """
+        signer = ChecksumSigner(self.key)
+        postbacks = self._make_postbacks(10000)
+        signed = [signer.sign(dict(params)) for params in postbacks]
+
+        reference_time = _best_time(lambda: [
+            _reference_checksum(params, self.key) == params['checksum'] for params in signed])
+        signer_time = _best_time(lambda: [signer.validate(params) for params in signed])
+
+        self.assertLess(signer_time, reference_time)
+        self.assertGreater(len(signed) / signer_time, 5000)
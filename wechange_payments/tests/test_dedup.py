@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from django.test.testcases import SimpleTestCase
+
+from wechange_payments.utils.dedup import LocalTTLCache, PostbackDeduplicator
+
+
+class PostbackDeduplicationTest(SimpleTestCase):
+
+    def test_local_cache_evicts_least_recently_used(self):
+        cache = LocalTTLCache(max_size=2, ttl=60)
+        cache.add('a')
+        cache.add('b')
+        self.assertIn('a', cache)
+        cache.add('c')
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+
+    def test_local_cache_entries_expire(self):
+        cache = LocalTTLCache(max_size=2, ttl=60)
+        with mock.patch('wechange_payments.utils.dedup.time.monotonic', return_value=1000.0):
+            cache.add('a')
+        with mock.patch('wechange_payments.utils.dedup.time.monotonic', return_value=1061.0):
+            self.assertNotIn('a', cache)
+
+    def test_postback_key_includes_status_and_checksum(self):
+        deduplicator = PostbackDeduplicator()
+        params = {'transaction_id': 'abc', 'status_code': '3', 'checksum': '123'}
+        deduplicator.mark_handled(deduplicator.make_key(params))
+        self.assertTrue(deduplicator.is_handled(deduplicator.make_key(dict(params))))
+        self.assertFalse(deduplicator.is_handled(deduplicator.make_key(dict(params, status_code='7'))))
+        self.assertIsNone(deduplicator.make_key({'transaction_id': 'abc'}))
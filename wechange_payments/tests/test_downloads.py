@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from django.test.client import RequestFactory
+from django.test.testcases import SimpleTestCase
+from django.utils.timezone import now
+
+from wechange_payments.utils.downloads import _parse_range_header, RangeNotSatisfiable, \
+    serve_stored_file
+
+
+class StoredFileDownloadTest(SimpleTestCase):
+
+    def test_parse_range_header(self):
+        self.assertEqual(_parse_range_header('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(_parse_range_header('bytes=900-', 1000), (900, 999))
+        self.assertEqual(_parse_range_header('bytes=-100', 1000), (900, 999))
+        self.assertEqual(_parse_range_header('bytes=500-5000', 1000), (500, 999))
+        # multiple ranges are answered with the whole file
+        self.assertIsNone(_parse_range_header('bytes=0-1,5-6', 1000))
+        with self.assertRaises(RangeNotSatisfiable):
+            _parse_range_header('bytes=1000-', 1000)
+
+    def test_matching_etag_is_not_modified_without_opening_the_file(self):
+        field_file = mock.Mock()
+        request = RequestFactory().get('/invoice/', HTTP_IF_NONE_MATCH='"abc"')
+        response = serve_stored_file(request, field_file, 'application/pdf', '"abc"', now())
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], '"abc"')
+        field_file.open.assert_not_called()
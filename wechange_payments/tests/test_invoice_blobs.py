@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+
+from django.test.testcases import TestCase
+from django.test.utils import override_settings
+
+from wechange_payments.models import InvoiceBlob
+
+
+class InvoiceBlobTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_same_content_is_stored_once(self):
+        first_blob = InvoiceBlob.store(b'%PDF-1.4 invoice')
+        second_blob = InvoiceBlob.store(b'%PDF-1.4 invoice')
+        other_blob = InvoiceBlob.store(b'%PDF-1.4 other invoice')
+        self.assertEqual(first_blob.id, second_blob.id)
+        self.assertNotEqual(first_blob.file.name, other_blob.file.name)
+        first_blob.refresh_from_db()
+        self.assertEqual(first_blob.ref_count, 2)
+        self.assertEqual(first_blob.read(), b'%PDF-1.4 invoice')
+        InvoiceBlob.release(first_blob.id)
+        first_blob.refresh_from_db()
+        self.assertEqual(first_blob.ref_count, 1)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from django.core import mail
+from django.test.testcases import SimpleTestCase
+from django.test.utils import override_settings
+from django.utils import translation
+
+from wechange_payments import mails
+from wechange_payments.mails import PaymentEmailBatch, batched_payment_emails, \
+    PAYMENT_EVENT_SUCCESSFUL_PAYMENT
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                   PAYMENTS_SEND_MAIL_FUNCTION='django.core.mail.send_mail')
+class PaymentEmailBatchTest(SimpleTestCase):
+
+    def test_batch_sends_over_one_connection(self):
+        with mock.patch.object(mails, 'get_connection', wraps=mails.get_connection) as get_connection:
+            with batched_payment_emails() as batch:
+                batch._send_mail('Subject 1', 'Message 1', 'one@mail.com')
+                # nested blocks add their mails to the outer batch
+                with batched_payment_emails() as nested_batch:
+                    self.assertIs(nested_batch, batch)
+                    nested_batch._send_mail('Subject 2', 'Message 2', 'two@mail.com')
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual([message.to for message in mail.outbox], [['one@mail.com'], ['two@mail.com']])
+
+    def test_failed_mail_is_counted_and_language_restored(self):
+        payment = mock.Mock(user_id=1, subscription_id=1)
+        payment.user.cosinnus_profile.language = 'de'
+        batch = PaymentEmailBatch()
+        with translation.override('en'):
+            with mock.patch.object(batch, '_get_portal', side_effect=Exception('No portal')):
+                self.assertFalse(batch.send(payment, PAYMENT_EVENT_SUCCESSFUL_PAYMENT))
+            self.assertEqual(translation.get_language(), 'en')
+        self.assertEqual(batch.get_counts(), {'sent': 0, 'failed': 1, 'skipped': 0})
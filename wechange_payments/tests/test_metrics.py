@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from django.test.testcases import SimpleTestCase
+
+from wechange_payments.backends.transport import _get_request_metric_tags
+from wechange_payments.utils import metrics
+from wechange_payments.utils.metrics import PrometheusSink
+
+
+class MetricsUnitTest(SimpleTestCase):
+
+    def test_prometheus_sink_render(self):
+        sink = PrometheusSink()
+        with mock.patch.object(metrics, 'METRICS_SINKS', [sink]):
+            with metrics.timer('provider.request', host='api.example.com'):
+                pass
+            metrics.increment('provider.responses', status=503)
+            metrics.increment('provider.responses', status=503)
+        rendered = sink.render(gauges={('invoice_queue.queued', ()): 4})
+        self.assertIn('# TYPE wechange_payments_provider_request_seconds summary', rendered)
+        self.assertIn('wechange_payments_provider_request_seconds_count{host="api.example.com"} 1', rendered)
+        self.assertIn('wechange_payments_provider_responses_total{status="503"} 2', rendered)
+        self.assertIn('wechange_payments_invoice_queue_queued 4', rendered)
+
+    def test_request_metric_tags_strip_ids(self):
+        tags = _get_request_metric_tags('GET', 'https://api.lexoffice.io/v1/invoices/fdd20e84-06ef-49df-b4b5-71293b6e2bd6/document')
+        self.assertEqual(tags['endpoint'], '/v1/invoices/:id/document')
+        self.assertEqual(tags['host'], 'api.lexoffice.io')
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.test.testcases import TestCase
+from django.utils.timezone import now
+
+from wechange_payments.models import Payment, UserPaymentSummary, _PendingSummaryRefresh
+
+
+class UserPaymentSummaryTest(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='summary_user', email='summary_user@mail.com', is_active=True)
+
+    def _make_paid_payment(self, completed_at, debit_period=Payment.DEBIT_PERIOD_MONTHLY):
+        return Payment.objects.create(
+            user=self.user,
+            vendor_transaction_id=str(uuid.uuid4()),
+            internal_transaction_id=str(uuid.uuid4()),
+            amount=5.0,
+            debit_period=debit_period,
+            status=Payment.STATUS_PAID,
+            completed_at=completed_at,
+            backend='wechange_payments.backends.payment.base.DummyBackend',
+        )
+
+    def test_summary_is_refreshed_once_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self._make_paid_payment(now() - timedelta(days=400))
+            recent_payment = self._make_paid_payment(now() - timedelta(days=10), debit_period=Payment.DEBIT_PERIOD_QUARTER_YEARLY)
+        # the saved payments also register their postback reconciliation
+        self.assertEqual(len([callback for callback in callbacks if isinstance(callback, _PendingSummaryRefresh)]), 1)
+        summary = UserPaymentSummary.objects.get(user=self.user)
+        self.assertEqual(summary.lifetime_paid_sum, 20.0)
+        self.assertEqual(summary.year_paid_sum, 15.0)
+        self.assertEqual(summary.last_paid_at, recent_payment.completed_at)
+        self.assertEqual(summary.invoice_count, 0)
+
+    def test_stale_summary_is_refreshed_on_read(self):
+        self._make_paid_payment(now() - timedelta(days=10))
+        UserPaymentSummary.objects.create(user=self.user, refreshed_at=now() - timedelta(days=1))
+        self.assertEqual(UserPaymentSummary.get_for_user(self.user).year_paid_sum, 5.0)
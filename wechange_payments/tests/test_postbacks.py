@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.test.testcases import TestCase
+
+from wechange_payments import backends
+from wechange_payments.backends.payment.betterpayments import BetterPaymentBackend
+from wechange_payments.models import Payment, PendingPostback
+
+
+class PendingPostbackTest(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='postback_user', email='postback_user@mail.com', is_active=True)
+        self.backend = BetterPaymentBackend()
+        patcher = mock.patch.object(backends, 'BACKEND', self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.order_id = str(uuid.uuid4())
+        self.transaction_id = str(uuid.uuid4())
+
+    def _create_payment(self):
+        return Payment.objects.create(
+            user=self.user,
+            vendor_transaction_id=self.transaction_id,
+            internal_transaction_id=self.order_id,
+            amount=5.0,
+            status=Payment.STATUS_STARTED,
+            backend='wechange_payments.backends.payment.betterpayments.BetterPaymentBackend',
+        )
+
+    def _park_postback(self, status_code, transaction_id=None, reason=PendingPostback.REASON_1_QUEUED):
+        transaction_id = transaction_id or self.transaction_id
+        return PendingPostback.objects.create(
+            order_id=self.order_id,
+            transaction_id=transaction_id,
+            data={'order_id': self.order_id, 'transaction_id': transaction_id, 'status_code': str(status_code)},
+            reason=reason,
+        )
+
+    def test_unmatched_postback_is_applied_when_payment_is_saved(self):
+        pending_postback = self._park_postback(BetterPaymentBackend.BETTERPAYMENT_STATUS_CANCELED,
+                                               reason=PendingPostback.REASON_0_UNMATCHED)
+        with self.captureOnCommitCallbacks(execute=True):
+            payment = self._create_payment()
+            # the postback is only applied once the payment's transaction commits
+            pending_postback.refresh_from_db()
+            self.assertIsNone(pending_postback.processed_at)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.STATUS_CANCELED)
+        pending_postback.refresh_from_db()
+        self.assertIsNotNone(pending_postback.processed_at)
+
+    def test_queued_postbacks_are_applied_in_order(self):
+        payment = self._create_payment()
+        self._park_postback(BetterPaymentBackend.BETTERPAYMENT_STATUS_CANCELED)
+        self._park_postback(BetterPaymentBackend.BETTERPAYMENT_STATUS_ERROR)
+        self.backend.process_queued_postbacks(self.order_id)
+        payment.refresh_from_db()
+        # the later postback wins
+        self.assertEqual(payment.status, Payment.STATUS_FAILED)
+        self.assertFalse(PendingPostback.objects.filter(order_id=self.order_id, processed_at__isnull=True).exists())
+
+    def test_later_postbacks_wait_for_a_rescheduled_one(self):
+        payment = self._create_payment()
+        # cannot be matched to the payment, so it is rescheduled
+        first_postback = self._park_postback(BetterPaymentBackend.BETTERPAYMENT_STATUS_ERROR, transaction_id=str(uuid.uuid4()))
+        later_postback = self._park_postback(BetterPaymentBackend.BETTERPAYMENT_STATUS_CANCELED)
+        self.backend.process_queued_postbacks(self.order_id)
+        first_postback.refresh_from_db()
+        later_postback.refresh_from_db()
+        self.assertEqual(first_postback.attempts, 1)
+        self.assertIsNone(later_postback.processed_at)
+        self.assertEqual(later_postback.attempts, 0)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.STATUS_STARTED)
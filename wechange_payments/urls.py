@@ -32,4 +32,5 @@ urlpatterns = [
     path('payments/api/error_endpoint/', api.error_endpoint, name='api-error-endpoint'),
     path('payments/api/postback_endpoint/', api.postback_endpoint, name='api-postback-endpoint'),
     path('payments/api/snooze-popup/', api.snooze_popup, name='api-snooze-popup'),
+    path('payments/api/metrics/', api.metrics_endpoint, name='api-metrics'),
 ]
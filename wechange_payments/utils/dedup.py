@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+import hashlib
+import logging
+import threading
+import time
+
+from wechange_payments.conf import settings
+
+logger = logging.getLogger('wechange-payments')
+
+
+class LocalTTLCache(object):
+    """ A thread-safe, size-bounded LRU cache whose entries expire after `ttl` seconds. """
+    
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+    
+    def __contains__(self, key):
+        with self._lock:
+            expires_at = self._entries.get(key, None)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return False
+            self._entries.move_to_end(key)
+            return True
+    
+    def add(self, key):
+        with self._lock:
+            self._entries[key] = time.monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def __len__(self):
+        return len(self._entries)
+
+
+class PostbackDeduplicator(object):
+    """ Remembers the postbacks that were handled, so copies the provider re-sends can be answered
+        without touching the DB. A postback is identified by its transaction id, status code and
+        checksum, so it is only ever matched after its checksum was validated.
+        Handled postbacks are remembered in a local LRU cache and, if `PAYMENTS_POSTBACK_DEDUP_CACHE`
+        is set, in that shared Django cache. """
+    
+    CACHE_KEY = 'wechange_payments/handled_postback/%s'
+    
+    def __init__(self):
+        self.ttl = settings.PAYMENTS_POSTBACK_DEDUP_TTL_SECONDS
+        self.local_cache = LocalTTLCache(settings.PAYMENTS_POSTBACK_DEDUP_MAX_SIZE, self.ttl)
+        self.shared_cache = None
+        if settings.PAYMENTS_POSTBACK_DEDUP_CACHE:
+            from django.core.cache import caches
+            self.shared_cache = caches[settings.PAYMENTS_POSTBACK_DEDUP_CACHE]
+    
+    @property
+    def enabled(self):
+        return self.ttl > 0
+    
+    def make_key(self, params):
+        """ @return: The key of a postback, or None if it lacks any of the identifying params """
+        try:
+            key_source = '%s|%s|%s' % (params['transaction_id'], params['status_code'], params['checksum'])
+        except KeyError:
+            return None
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+    
+    def is_handled(self, key):
+        if key is None or not self.enabled:
+            return False
+        if key in self.local_cache:
+            return True
+        if self.shared_cache is not None:
+            try:
+                handled = self.shared_cache.get(self.CACHE_KEY % key)
+            except Exception as e:
+                # an unavailable cache must never keep a postback from being handled
+                logger.warning('Payments: Could not read from the postback deduplication cache.', extra={'exception': e})
+                return False
+            if handled:
+                self.local_cache.add(key)
+                return True
+        return False
+    
+    def mark_handled(self, key):
+        if key is None or not self.enabled:
+            return
+        self.local_cache.add(key)
+        if self.shared_cache is not None:
+            try:
+                self.shared_cache.set(self.CACHE_KEY % key, 1, self.ttl)
+            except Exception as e:
+                logger.warning('Payments: Could not write to the postback deduplication cache.', extra={'exception': e})
+
+
+POSTBACK_DEDUPLICATOR = None
+_postback_deduplicator_lock = threading.Lock()
+
+def get_postback_deduplicator():
+    """ Returns the process-wide `PostbackDeduplicator` """
+    global POSTBACK_DEDUPLICATOR
+    if POSTBACK_DEDUPLICATOR is None:
+        with _postback_deduplicator_lock:
+            if POSTBACK_DEDUPLICATOR is None:
+                POSTBACK_DEDUPLICATOR = PostbackDeduplicator()
+    return POSTBACK_DEDUPLICATOR
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import logging
+import re
+
+from django.http.response import FileResponse, HttpResponse, StreamingHttpResponse, \
+    HttpResponseNotFound
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+from wechange_payments.conf import settings
+
+logger = logging.getLogger('wechange-payments')
+
+OFFLOAD_X_ACCEL_REDIRECT = 'x-accel-redirect'
+OFFLOAD_X_SENDFILE = 'x-sendfile'
+
+RANGE_HEADER_RE = re.compile(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$')
+STREAMING_CHUNK_SIZE = 64 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def serve_stored_file(request, field_file, content_type, etag, last_modified, gzipped=False):
+    """ Serves the file of a FileField for a download view. Works with any storage backend, as the
+        file is only accessed through the storage API.
+        
+        - Conditional requests are answered with a 304 (or 412) using the given validators, without opening the file
+        - Single byte range requests are answered with a 206
+        - If `PAYMENTS_INVOICE_DOWNLOAD_OFFLOAD` is set, only the headers are returned and the front proxy
+            streams the file (and handles ranges)
+        - A gzipped file is sent as is with a gzip Content-Encoding, or decompressed (without range
+            support or offloading) for the rare clients that don't accept gzip
+        
+        Only use this for files that never change under the same name, as the validators are not checked
+        against the file's contents. The caller must set the Content-Disposition header.
+        @param etag: The quoted strong ETag of the file
+        @param last_modified: The datetime of the last change of the file
+        @param gzipped: True if the stored file is gzip-compressed
+        @return: An HttpResponse """
+    decompress = False
+    if gzipped:
+        if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+            # the encoded representation gets its own validator
+            etag = etag[:-1] + '-gzip"'
+        else:
+            decompress = True
+    headers = HttpResponse()
+    headers['ETag'] = etag
+    headers['Last-Modified'] = http_date(last_modified.timestamp())
+    headers['Accept-Ranges'] = 'bytes'
+    patch_cache_control(headers, private=True, max_age=settings.PAYMENTS_INVOICE_DOWNLOAD_MAX_AGE)
+    if gzipped:
+        patch_vary_headers(headers, ('Accept-Encoding',))
+    conditional_response = get_conditional_response(request, etag=etag,
+                                                    last_modified=int(last_modified.timestamp()), response=headers)
+    if conditional_response is not headers:
+        return conditional_response
+    
+    try:
+        if decompress:
+            response = StreamingHttpResponse(_read_gzipped_file(field_file.open('rb')), content_type=content_type)
+            headers['Accept-Ranges'] = 'none'
+        else:
+            # the front proxy would drop our Content-Encoding header, so gzipped files are not offloaded
+            response = (not gzipped and _make_offloaded_response(field_file, content_type)) or \
+                _make_streamed_response(request, field_file, content_type, etag, headers)
+    except (OSError, IOError) as e:
+        logger.error('Payments: A stored file could not be opened for a download.',
+                     extra={'file_name': field_file.name, 'exception': e})
+        return HttpResponseNotFound()
+    for header in ('ETag', 'Last-Modified', 'Accept-Ranges', 'Cache-Control', 'Vary'):
+        if headers.has_header(header):
+            response[header] = headers[header]
+    if gzipped and not decompress:
+        response['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _make_offloaded_response(field_file, content_type):
+    """ @return: A headers-only response telling the front proxy to serve the file, or None if the file
+        should be streamed by us """
+    offload = settings.PAYMENTS_INVOICE_DOWNLOAD_OFFLOAD
+    if offload == OFFLOAD_X_ACCEL_REDIRECT:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.PAYMENTS_INVOICE_DOWNLOAD_X_ACCEL_LOCATION.rstrip('/') + \
+            '/' + field_file.name.lstrip('/')
+        return response
+    if offload == OFFLOAD_X_SENDFILE:
+        try:
+            path = field_file.path
+        except NotImplementedError:
+            # not a filesystem storage, so the front proxy can't read the file
+            return None
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+        return response
+    return None
+
+
+def _make_streamed_response(request, field_file, content_type, etag, headers):
+    size = field_file.size
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE', None)
+    if_range = request.META.get('HTTP_IF_RANGE', None)
+    # a range of an outdated version must not be served, so If-Range is only accepted if it matches
+    if range_header and (not if_range or if_range.strip() in (etag, headers['Last-Modified'])):
+        try:
+            byte_range = _parse_range_header(range_header, size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+    
+    if byte_range is None:
+        return FileResponse(field_file.open('rb'), content_type=content_type)
+    
+    start, end = byte_range
+    file_obj = field_file.open('rb')
+    file_obj.seek(start)
+    response = StreamingHttpResponse(_read_file_range(file_obj, end - start + 1), status=206, content_type=content_type)
+    response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+    response['Content-Length'] = str(end - start + 1)
+    return response
+
+
+def _parse_range_header(range_header, size):
+    """ Parses a Range header with a single byte range. Multiple ranges are not supported and ignored.
+        @return: tuple (first byte, last byte), or None if the whole file should be sent
+        @raise RangeNotSatisfiable: If the range lies outside of the file """
+    match = RANGE_HEADER_RE.match(range_header)
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # a suffix range of the last n bytes
+        suffix_length = int(last)
+        if suffix_length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return (max(0, size - suffix_length), size - 1)
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        raise RangeNotSatisfiable()
+    return (first, last)
+
+
+def _read_file_range(file_obj, length):
+    """ Yields `length` bytes (or all remaining bytes if None) of the file from its current position,
+        and closes it when done """
+    try:
+        while length is None or length > 0:
+            data = file_obj.read(STREAMING_CHUNK_SIZE if length is None else min(STREAMING_CHUNK_SIZE, length))
+            if not data:
+                break
+            if length is not None:
+                length -= len(data)
+            yield data
+    finally:
+        file_obj.close()
+
+
+def _read_gzipped_file(file_obj):
+    """ Yields the decompressed content of a gzipped file, and closes it when done """
+    try:
+        for data in _read_file_range(gzip.GzipFile(fileobj=file_obj), None):
+            yield data
+    finally:
+        file_obj.close()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qsl
+import uuid
+
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+
+FAKE_BETTERPAYMENT_API_DOMAIN = 'https://betterpayment.fake'
+FAKE_LEXOFFICE_API_DOMAIN = 'https://lexoffice.fake'
+
+FAKE_INVOICE_PDF = b'%%PDF-1.4\n%% fake invoice %s\n%%%%EOF\n'
+
+
+class FakeProviderAdapter(BaseAdapter):
+    """ A local stand-in for the BetterPayment and Lexoffice APIs, for benchmarks and tests.
+        It is mounted on a backend's `HttpTransport`, so the backends run unchanged, but no
+        request ever leaves the process:
+
+            adapter = FakeProviderAdapter(latency=0.05, error_rate=0.01)
+            mount_fake_provider_adapter(backend.transport, adapter)
+
+        Implemented endpoints (matched by path, the domain is ignored):
+            BetterPayment: POST /rest/payment, POST /rest/create_mandate_reference
+            Lexoffice: POST /v1/invoices, GET /v1/invoices/<id>/document, GET /v1/files/<id>, POST /v1/contacts
+
+        - Every request sleeps for `latency` seconds, plus up to `latency_jitter` seconds.
+        - A share of `error_rate` requests is answered with a 503.
+        - For every successful payment, a success postback for the `postback_url` of the request is
+            collected. These can be taken with `pop_postbacks()` and sent to our postback endpoint.
+            `postback_signer` must add the checksum to the postback params. """
+
+    ROUTES = (
+        ('POST', re.compile(r'^/rest/payment/?$'), '_payment'),
+        ('POST', re.compile(r'^/rest/create_mandate_reference/?$'), '_create_mandate_reference'),
+        ('POST', re.compile(r'^/v1/invoices/?$'), '_create_invoice'),
+        ('GET', re.compile(r'^/v1/invoices/(?P<id>[^/]+)/document/?$'), '_render_invoice'),
+        ('GET', re.compile(r'^/v1/files/(?P<id>[^/]+)/?$'), '_download_invoice'),
+        ('POST', re.compile(r'^/v1/contacts/?$'), '_create_contact'),
+    )
+
+    def __init__(self, latency=0.0, latency_jitter=0.0, error_rate=0.0, postback_signer=None, seed=None):
+        super().__init__()
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.postback_signer = postback_signer
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._postbacks = []
+        self.request_counts = {}
+        self.error_counts = {}
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        path = request.path_url.split('?')[0]
+        for method, pattern, handler_name in self.ROUTES:
+            match = pattern.match(path)
+            if match and request.method == method:
+                break
+        else:
+            return self._make_response(request, 404, {'message': 'Unknown fake provider endpoint.'})
+
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.latency_jitter)
+            failed = self._random.random() < self.error_rate
+            self.request_counts[handler_name] = self.request_counts.get(handler_name, 0) + 1
+            if failed:
+                self.error_counts[handler_name] = self.error_counts.get(handler_name, 0) + 1
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            return self._make_response(request, 503, {'message': 'Injected fake provider error.'})
+        return getattr(self, handler_name)(request, **match.groupdict())
+
+    def close(self):
+        pass
+
+    def pop_postbacks(self):
+        """ @return: list of (postback_url, params) of all collected postbacks, which are removed """
+        with self._lock:
+            postbacks = self._postbacks
+            self._postbacks = []
+        return postbacks
+
+    def _make_response(self, request, status_code, data=None, content=None, content_type='application/json'):
+        response = Response()
+        response.status_code = status_code
+        response.request = request
+        response.url = request.url
+        response.encoding = 'utf-8'
+        response.headers = CaseInsensitiveDict({'Content-Type': content_type})
+        response._content = content if content is not None else json.dumps(data).encode('utf-8')
+        return response
+
+    def _get_form_data(self, request):
+        body = request.body or ''
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        return dict(parse_qsl(body))
+
+    def _payment(self, request):
+        data = self._get_form_data(request)
+        transaction_id = str(uuid.uuid4())
+        order_id = data.get('order_id')
+        if data.get('postback_url'):
+            postback = {
+                'transaction_id': transaction_id,
+                'order_id': order_id,
+                'status_code': 3,
+                'status': 'succeeded',
+            }
+            if self.postback_signer:
+                postback = self.postback_signer(postback)
+            with self._lock:
+                self._postbacks.append((data['postback_url'], postback))
+        return self._make_response(request, 200, {
+            'transaction_id': transaction_id,
+            'order_id': order_id,
+            'error_code': 0,
+            'status_code': 1,
+            'status': 'started',
+        })
+
+    def _create_mandate_reference(self, request):
+        return self._make_response(request, 200, {
+            'transaction_id': str(uuid.uuid4()),
+            'token': uuid.uuid4().hex,
+            'status_code': 9,
+            'status': 'registered',
+            'error_code': 0,
+            'order_id': None,
+        })
+
+    def _create_invoice(self, request):
+        return self._make_response(request, 201, {'id': str(uuid.uuid4()), 'version': 1})
+
+    def _render_invoice(self, request, id):
+        return self._make_response(request, 200, {'documentFileId': str(uuid.uuid4())})
+
+    def _download_invoice(self, request, id):
+        return self._make_response(request, 200, content=FAKE_INVOICE_PDF % id.encode('utf-8'),
+                                   content_type='application/pdf')
+
+    def _create_contact(self, request):
+        return self._make_response(request, 200, {'id': str(uuid.uuid4()), 'version': 1})
+
+
+def mount_fake_provider_adapter(transport, adapter):
+    """ Routes all requests of an `HttpTransport` to the given `FakeProviderAdapter`.
+        Call `transport.close()` to go back to a real session. """
+    transport.session.mount('https://', adapter)
+    transport.session.mount('http://', adapter)
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+from functools import wraps
+import logging
+import re
+import socket
+import threading
+import time
+
+from django.db import connection
+
+from wechange_payments.conf import settings
+from wechange_payments.utils.utils import resolve_class
+
+logger = logging.getLogger('wechange-payments')
+
+
+class BaseMetricsSink(object):
+    """ Receives all measurements of the payments instrumentation.
+        Configure the sinks to use with `PAYMENTS_METRICS_SINKS`.
+        Sinks are called on the hot paths and from many threads, so they must be fast and thread-safe. """
+
+    def timing(self, name, seconds, tags):
+        """ A duration, e.g. of a provider API call or a cron phase """
+        pass
+
+    def histogram(self, name, value, tags):
+        """ A distribution of values, e.g. the number of queries of an instrumented call """
+        pass
+
+    def increment(self, name, value, tags):
+        """ A counter, e.g. of provider errors """
+        pass
+
+
+class LoggingSink(BaseMetricsSink):
+    """ Writes every measurement as log message with the metric in its `extra`, at level
+        `PAYMENTS_METRICS_LOG_LEVEL`. Meant for log aggregators that can chart extra fields. """
+
+    def _log(self, kind, name, value, tags):
+        extra = {'metric': name, 'metric_type': kind, 'value': value}
+        extra.update(tags)
+        logger.log(settings.PAYMENTS_METRICS_LOG_LEVEL, 'Payments metric: %s' % name, extra=extra)
+
+    def timing(self, name, seconds, tags):
+        self._log('timing', name, seconds, tags)
+
+    def histogram(self, name, value, tags):
+        self._log('histogram', name, value, tags)
+
+    def increment(self, name, value, tags):
+        self._log('counter', name, value, tags)
+
+
+class StatsdSink(BaseMetricsSink):
+    """ Sends every measurement as UDP packet to the statsd daemon at `PAYMENTS_METRICS_STATSD_HOST`.
+        Tags are appended in the DogStatsD format. Sending is fire-and-forget, a missing
+        daemon never slows down or breaks a payment. """
+
+    def __init__(self):
+        self.address = (settings.PAYMENTS_METRICS_STATSD_HOST, settings.PAYMENTS_METRICS_STATSD_PORT)
+        self.prefix = settings.PAYMENTS_METRICS_PREFIX
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _send(self, name, value, metric_type, tags):
+        packet = '%s.%s:%s|%s' % (self.prefix, name, value, metric_type)
+        if tags:
+            packet += '|#' + ','.join(['%s:%s' % (key, tag_value) for key, tag_value in sorted(tags.items())])
+        try:
+            self._socket.sendto(packet.encode('utf-8'), self.address)
+        except OSError:
+            pass
+
+    def timing(self, name, seconds, tags):
+        self._send(name, '%.3f' % (seconds * 1000), 'ms', tags)
+
+    def histogram(self, name, value, tags):
+        self._send(name, value, 'h', tags)
+
+    def increment(self, name, value, tags):
+        self._send(name, value, 'c', tags)
+
+
+class PrometheusSink(BaseMetricsSink):
+    """ Aggregates all measurements of this process in memory, to be scraped as Prometheus text
+        format from the payments metrics endpoint. Timings and histograms are exposed as summaries
+        (count and sum), counters as totals. Note that each server process exposes its own values. """
+
+    def __init__(self):
+        self.prefix = _sanitize_metric_name(settings.PAYMENTS_METRICS_PREFIX)
+        self._lock = threading.Lock()
+        self._summaries = {}
+        self._counters = {}
+
+    def _observe(self, name, value, tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self._lock:
+            count, total = self._summaries.get(key, (0, 0.0))
+            self._summaries[key] = (count + 1, total + value)
+
+    def timing(self, name, seconds, tags):
+        self._observe(name + '.seconds', seconds, tags)
+
+    def histogram(self, name, value, tags):
+        self._observe(name, value, tags)
+
+    def increment(self, name, value, tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self, gauges=None):
+        """ @param gauges: optional dict of {(name, tags-tuple): value} of current values to add
+            @return: All metrics in the Prometheus text exposition format """
+        with self._lock:
+            summaries = dict(self._summaries)
+            counters = dict(self._counters)
+        lines = []
+        for metric_type, suffixes, values in (
+                ('summary', ('_count', '_sum'), summaries),
+                ('counter', ('_total',), dict([(key, (value,)) for key, value in counters.items()])),
+                ('gauge', ('',), dict([(key, (value,)) for key, value in (gauges or {}).items()]))):
+            typed_names = set()
+            for (name, tags), metric_values in sorted(values.items()):
+                metric_name = '%s_%s' % (self.prefix, _sanitize_metric_name(name))
+                if metric_name not in typed_names:
+                    lines.append('# TYPE %s %s' % (metric_name, metric_type))
+                    typed_names.add(metric_name)
+                labels = ','.join(['%s="%s"' % (_sanitize_metric_name(key), str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                   for key, value in tags])
+                for suffix, value in zip(suffixes, metric_values):
+                    lines.append('%s%s%s %s' % (metric_name, suffix, '{%s}' % labels if labels else '', value))
+        return '\n'.join(lines) + '\n'
+
+
+def _sanitize_metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+METRICS_SINKS = None
+_metrics_sinks_lock = threading.Lock()
+
+def get_metrics_sinks():
+    """ Returns the list of configured metrics sinks, which is empty if instrumentation is disabled. """
+    global METRICS_SINKS
+    if METRICS_SINKS is None:
+        with _metrics_sinks_lock:
+            if METRICS_SINKS is None:
+                METRICS_SINKS = [resolve_class(sink_path)() for sink_path in settings.PAYMENTS_METRICS_SINKS]
+    return METRICS_SINKS
+
+
+def get_prometheus_sink():
+    """ @return: The configured `PrometheusSink` or None """
+    for sink in get_metrics_sinks():
+        if isinstance(sink, PrometheusSink):
+            return sink
+    return None
+
+
+def _emit(method_name, name, value, tags):
+    for sink in get_metrics_sinks():
+        try:
+            getattr(sink, method_name)(name, value, tags)
+        except Exception as e:
+            logger.warning('Payments: A metrics sink failed to record a measurement.',
+                           extra={'sink': sink.__class__.__name__, 'metric': name, 'exception': e})
+
+
+def increment(name, value=1, **tags):
+    """ Counts an event, e.g. `increment('provider.errors', host=host)` """
+    if get_metrics_sinks():
+        _emit('increment', name, value, tags)
+
+
+@contextmanager
+def timer(name, count_queries=False, **tags):
+    """ Measures the duration of a block, and optionally the number of DB queries it ran on this
+        thread's connection. If the block raises, the measurement is tagged with `error=1`.
+        Does nothing if no sinks are configured. """
+    if not get_metrics_sinks():
+        yield
+        return
+    query_counter = [0]
+    def count_query(execute, sql, params, many, context):
+        query_counter[0] += 1
+        return execute(sql, params, many, context)
+
+    started = time.monotonic()
+    failed = False
+    try:
+        if count_queries:
+            with connection.execute_wrapper(count_query):
+                yield
+        else:
+            yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        if failed:
+            tags = dict(tags, error=1)
+        _emit('timing', name, time.monotonic() - started, tags)
+        if count_queries:
+            _emit('histogram', name + '.queries', query_counter[0], tags)
+
+
+def instrumented(name, count_queries=True):
+    """ Decorator that measures every call of a function with `timer()` """
+    def decorator(func):
+        @wraps(func)
+        def instrumented_func(*args, **kwargs):
+            with timer(name, count_queries=count_queries):
+                return func(*args, **kwargs)
+        return instrumented_func
+    return decorator
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+import json
+import logging
+import threading
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.timezone import now
+
+from wechange_payments.conf import settings
+
+logger = logging.getLogger('wechange-payments')
+
+_local = threading.local()
+_fallback_file_lock = threading.Lock()
+
+
+def log_transaction(log_type, data, url=None):
+    """ Saves a `TransactionLog`. While buffering is enabled for the current thread (during a request,
+        or in a `buffered_transaction_logs()` block), the log is only collected and written together
+        with all others in a single `bulk_create` on the next flush. Otherwise it is written immediately.
+        Logs are never written inside a DB transaction, where they would be rolled back with it. They are
+        written once the transaction is over instead (see `_defer_transaction_logs()`).
+        @param log_type: `TransactionLog.TYPE_REQUEST` or `TransactionLog.TYPE_POSTBACK` """
+    from wechange_payments.models import TransactionLog
+    log = TransactionLog(type=log_type, url=url, data=data)
+    log.extract_indexed_fields()
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is None:
+        if transaction.get_connection().in_atomic_block:
+            _defer_transaction_logs([log])
+            return
+        _write_transaction_logs(_pop_deferred_transaction_logs() + [log])
+        return
+    buffer.append(log)
+    if len(buffer) >= settings.PAYMENTS_TRANSACTION_LOG_BUFFER_SIZE and \
+            not transaction.get_connection().in_atomic_block:
+        flush_transaction_logs()
+
+
+def start_buffering_transaction_logs():
+    """ Enables buffering of transaction logs for the current thread """
+    if not settings.PAYMENTS_TRANSACTION_LOG_BUFFERED:
+        return
+    if getattr(_local, 'buffer', None) is None:
+        _local.buffer = []
+
+
+def flush_transaction_logs(stop_buffering=False):
+    """ Writes all buffered transaction logs of the current thread. Inside a transaction, they are
+        only written after it (see `_defer_transaction_logs()`).
+        @param stop_buffering: If True, logs are written immediately again afterwards """
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is not None:
+        _local.buffer = None if stop_buffering else []
+    logs = buffer or []
+    if transaction.get_connection().in_atomic_block:
+        if logs:
+            _defer_transaction_logs(logs)
+        return
+    logs = _pop_deferred_transaction_logs() + logs
+    if logs:
+        _write_transaction_logs(logs)
+
+
+@contextmanager
+def buffered_transaction_logs():
+    """ Buffers all transaction logs written in this block and flushes them at its end.
+        Nested blocks (or a block inside a request) leave the flushing to the outermost one. """
+    if getattr(_local, 'buffer', None) is not None:
+        yield
+        return
+    start_buffering_transaction_logs()
+    try:
+        yield
+    finally:
+        flush_transaction_logs(stop_buffering=True)
+
+
+def _defer_transaction_logs(logs):
+    """ Keeps logs made inside a transaction until it is over. If it is committed, they are written
+        right after. If it is rolled back, they are kept and written with the next flush or log of this
+        thread outside of a transaction (at the latest at the end of the request or `buffered_transaction_logs()` block).
+        So the logs of provider calls survive the rollback of the payment transaction they were made in. """
+    deferred = getattr(_local, 'deferred', None)
+    if deferred is None:
+        deferred = _local.deferred = []
+    deferred.extend(logs)
+    transaction.on_commit(_write_deferred_transaction_logs)
+
+
+def _pop_deferred_transaction_logs():
+    deferred = getattr(_local, 'deferred', None) or []
+    _local.deferred = None
+    return deferred
+
+
+def _write_deferred_transaction_logs():
+    if transaction.get_connection().in_atomic_block:
+        return
+    logs = _pop_deferred_transaction_logs()
+    if logs:
+        _write_transaction_logs(logs)
+
+
+def _write_transaction_logs(logs):
+    from wechange_payments.models import TransactionLog
+    try:
+        # in its own savepoint, so a failing write never breaks a surrounding transaction
+        with transaction.atomic():
+            TransactionLog.objects.bulk_create(logs)
+    except Exception as e:
+        logger.error('Payments: Could not save transaction logs to the database! Writing them to the fallback file.',
+                     extra={'exception': e, 'count': len(logs)})
+        _write_transaction_logs_to_fallback_file(logs)
+
+
+def _write_transaction_logs_to_fallback_file(logs):
+    """ Appends the logs as JSON lines to `PAYMENTS_TRANSACTION_LOG_FALLBACK_FILE`, so that
+        no audit data is lost if the database is unavailable """
+    lines = [json.dumps({
+        'created': log.created or now(),
+        'url': log.url,
+        'type': log.type,
+        'data': log.data,
+    }, cls=DjangoJSONEncoder) for log in logs]
+    file_path = settings.PAYMENTS_TRANSACTION_LOG_FALLBACK_FILE
+    try:
+        if not file_path:
+            raise Exception('`PAYMENTS_TRANSACTION_LOG_FALLBACK_FILE` is not set.')
+        with _fallback_file_lock:
+            with open(file_path, 'a', encoding='utf-8') as fallback_file:
+                fallback_file.write(''.join([line + '\n' for line in lines]))
+    except Exception as e:
+        logger.critical('Payments: Transaction logs could not be saved to the database or the fallback file! Their data is attached.',
+                        extra={'exception': e, 'transaction_logs': lines})
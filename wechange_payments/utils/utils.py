@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
+from concurrent.futures.thread import ThreadPoolExecutor
 import hashlib
 from importlib import import_module
+from itertools import islice
 from os import path
 from uuid import uuid4
 
+from django.db import connections
 from django.utils.encoding import force_str
 
 from cosinnus.utils.files import get_cosinnus_media_file_folder
@@ -22,6 +25,37 @@ def resolve_class(path_to_class):
     return cls
 
 
+def chunked(iterable, chunk_size):
+    """ Splits an iterable into lists of at most `chunk_size` items. """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run_in_worker_threads(func, jobs, max_workers):
+    """ Runs `func(job)` for each of the given jobs on a bounded pool of worker threads
+        and returns the results in the order of the jobs.
+        Django opens a separate DB connection for each thread, so every worker closes its
+        connections after finishing a job.
+        If `max_workers` is 1 or less, or while testing (worker threads could not see the data
+        of the test transaction), all jobs are run one after another in the calling thread. """
+    jobs = list(jobs)
+    if max_workers <= 1 or len(jobs) <= 1 or getattr(settings, 'TESTING', False):
+        return [func(job) for job in jobs]
+    
+    def _run_job(job):
+        try:
+            return func(job)
+        finally:
+            connections.close_all()
+    
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        return list(executor.map(_run_job, jobs))
+
+
 def _get_invoice_filename(instance, filename, folder_type='invoices', base_folder='payments'):
     _, ext = path.splitext(filename)
     filedir = path.join(get_cosinnus_media_file_folder(), base_folder, folder_type)
@@ -41,3 +75,13 @@ def send_admin_mail_notification(subject, content):
                         filter(id__in=CosinnusPortal.get_current().admins)
     for user in admins:
         send_mail_or_fail(user.email, subject, template, {'content': content})
+
+
+def _get_invoice_blob_filename(instance, filename, base_folder='payments'):
+    """ Invoice blob files are named after their content hash, keyed with the secret key
+        so their names can't be guessed. The extensions of `filename` are kept (e.g. ".pdf.gz") """
+    ext = filename[filename.index('.'):] if '.' in filename else ''
+    name = '%s%s' % (settings.SECRET_KEY, instance.sha256)
+    keyed_hash = hashlib.sha1(name.encode('utf-8')).hexdigest()
+    filedir = path.join(get_cosinnus_media_file_folder(), base_folder, 'invoice_blobs', keyed_hash[:2])
+    return path.join(filedir, 'invoice_blob_' + keyed_hash + ext)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from django.db import connections
+
+logger = logging.getLogger('wechange-payments')
+
+
+class WorkQueue(object):
+    """ A process-wide background work queue with a fixed number of worker threads.
+        Replaces starting a new thread per job, so that a burst of jobs can neither create an
+        unbounded number of threads nor DB connections (each worker holds at most one).
+
+        - Jobs are deduplicated by a key: while a job with the same key is queued or running,
+            submitting another one is a no-op.
+        - At most `max_queued` jobs may wait. Further jobs are rejected and logged, they must be
+            picked up by a cronjob later.
+        - On interpreter exit, the queue stops accepting jobs and waits for running jobs to finish.
+        - `stats()` returns the queue depth and counters for monitoring. """
+
+    def __init__(self, name, max_workers, max_queued):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending_keys = set()
+        self._running = 0
+        self._counters = {
+            'submitted': 0,
+            'deduplicated': 0,
+            'rejected': 0,
+            'completed': 0,
+            'failed': 0,
+        }
+        self._is_shut_down = False
+
+    def submit(self, key, func, *args, **kwargs):
+        """ Queues `func(*args, **kwargs)` to be run by a worker thread.
+            @param key: A hashable job identity used for deduplication
+            @return: True if the job was queued, False if it was a duplicate or rejected """
+        with self._lock:
+            if self._is_shut_down:
+                logger.warning('Payments: Work queue "%s" is shut down, rejected a job.' % self.name, extra={'key': str(key)})
+                self._counters['rejected'] += 1
+                return False
+            if key in self._pending_keys:
+                self._counters['deduplicated'] += 1
+                return False
+            if len(self._pending_keys) - self._running >= self.max_queued:
+                logger.warning('Payments: Work queue "%s" is full, rejected a job.' % self.name,
+                               extra={'key': str(key), 'max_queued': self.max_queued})
+                self._counters['rejected'] += 1
+                return False
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='payments-%s' % self.name)
+            self._pending_keys.add(key)
+            self._counters['submitted'] += 1
+            self._executor.submit(self._run_job, key, func, args, kwargs)
+            return True
+
+    def _run_job(self, key, func, args, kwargs):
+        with self._lock:
+            self._running += 1
+        failed = False
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            failed = True
+            logger.error('Payments: Unhandled exception in a job of work queue "%s".' % self.name,
+                         extra={'key': str(key), 'exception': e})
+        finally:
+            connections.close_all()
+            with self._lock:
+                self._running -= 1
+                self._pending_keys.discard(key)
+                self._counters['failed' if failed else 'completed'] += 1
+
+    def stats(self):
+        """ @return: dict with the current number of `queued` and `running` jobs and the job counters """
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({
+                'queued': len(self._pending_keys) - self._running,
+                'running': self._running,
+                'max_workers': self.max_workers,
+                'max_queued': self.max_queued,
+            })
+        return stats
+
+    def shutdown(self, wait=True):
+        """ Stops accepting jobs, drops all queued jobs and (if `wait`) waits for running jobs to finish. """
+        with self._lock:
+            self._is_shut_down = True
+            executor = self._executor
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+            stats = self.stats()
+            if stats['queued']:
+                logger.warning('Payments: Work queue "%s" was shut down with queued jobs, these were dropped.' % self.name,
+                               extra=stats)
+
+
+INVOICE_WORK_QUEUE = None
+_work_queue_lock = threading.Lock()
+
+def get_invoice_work_queue():
+    """ Returns the process-wide work queue for threaded invoice generation. """
+    global INVOICE_WORK_QUEUE
+    if INVOICE_WORK_QUEUE is None:
+        with _work_queue_lock:
+            if INVOICE_WORK_QUEUE is None:
+                from wechange_payments.conf import settings
+                INVOICE_WORK_QUEUE = WorkQueue('invoices',
+                        max_workers=settings.PAYMENTS_INVOICE_QUEUE_MAX_WORKERS,
+                        max_queued=settings.PAYMENTS_INVOICE_QUEUE_MAX_QUEUED)
+                atexit.register(INVOICE_WORK_QUEUE.shutdown)
+    return INVOICE_WORK_QUEUE
+
+
+POSTBACK_WORK_QUEUE = None
+
+def get_postback_work_queue():
+    """ Returns the process-wide work queue for applying parked postbacks, see `PAYMENTS_POSTBACK_ASYNC`.
+        @return: The queue, or None if no postback workers are configured """
+    global POSTBACK_WORK_QUEUE
+    from wechange_payments.conf import settings
+    if not settings.PAYMENTS_POSTBACK_QUEUE_MAX_WORKERS:
+        return None
+    if POSTBACK_WORK_QUEUE is None:
+        with _work_queue_lock:
+            if POSTBACK_WORK_QUEUE is None:
+                POSTBACK_WORK_QUEUE = WorkQueue('postbacks',
+                        max_workers=settings.PAYMENTS_POSTBACK_QUEUE_MAX_WORKERS,
+                        max_queued=settings.PAYMENTS_POSTBACK_QUEUE_MAX_QUEUED)
+                atexit.register(POSTBACK_WORK_QUEUE.shutdown)
+    return POSTBACK_WORK_QUEUE
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from django.http.response import JsonResponse, HttpResponseNotAllowed,\
-    HttpResponseForbidden, HttpResponseNotFound
+    HttpResponseForbidden, HttpResponseNotFound, HttpResponse
+from django.utils.crypto import constant_time_compare
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
 
@@ -22,6 +23,8 @@ from django.utils.timezone import now
 from django.views.decorators.cache import never_cache
 from django.views.decorators.debug import sensitive_post_parameters
 from wechange_payments.forms import PaymentsForm
+from wechange_payments.utils.metrics import instrumented, get_prometheus_sink
+from wechange_payments.utils.work_queue import get_invoice_work_queue
 
 logger = logging.getLogger('wechange-payments')
 
@@ -29,6 +32,7 @@ logger = logging.getLogger('wechange-payments')
 @csrf_exempt
 @never_cache
 @sensitive_post_parameters('iban', 'bic', 'account_holder')
+@instrumented('view.make_payment')
 def make_payment(request, on_success_func=None, make_postponed=False):
     """ A non-user-based payment API function, that can be used for anonymous (or user-based),
         one-time donations.
@@ -317,6 +321,7 @@ def error_endpoint(request):
 
 @csrf_exempt
 @never_cache
+@instrumented('view.postback_endpoint')
 def postback_endpoint(request):
     """ For providers that offer a postback URL as logging/validation """
     backend = get_backend()
@@ -340,3 +345,20 @@ def snooze_popup(request):
     except Exception as e:
         logger.error('Error in `api.snooze_popup`: %s' % e, extra={'exception': e})
     return JsonResponse({'status': 'ok'})
+
+
+@never_cache
+def metrics_endpoint(request):
+    """ Exposes the metrics collected by the `PrometheusSink` of this process in the Prometheus text format,
+        along with the current state of the invoice work queue. Accessible for superusers, or with an
+        "Authorization: Bearer <token>" header if `PAYMENTS_METRICS_ENDPOINT_TOKEN` is set. """
+    token = settings.PAYMENTS_METRICS_ENDPOINT_TOKEN
+    has_valid_token = bool(token) and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer %s' % token)
+    if not has_valid_token and not request.user.is_superuser:
+        return HttpResponseForbidden('Not authenticated')
+    sink = get_prometheus_sink()
+    if sink is None:
+        return HttpResponseNotFound('The Prometheus metrics sink is not enabled.')
+    queue_stats = get_invoice_work_queue().stats()
+    gauges = dict([(('invoice_queue.%s' % key, ()), value) for key, value in queue_stats.items()])
+    return HttpResponse(sink.render(gauges=gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import csv
 from datetime import timedelta
+import hashlib
 import logging
 
 from annoying.functions import get_object_or_None
 from django.contrib import messages
 from django.core.exceptions import PermissionDenied
 from django.dispatch.dispatcher import receiver
-from django.http.response import HttpResponseForbidden, HttpResponseNotFound, FileResponse
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDay, TruncMonth
+from django.http.response import HttpResponseForbidden, HttpResponseNotFound, \
+    HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import redirect
 from django.urls.base import reverse
+from django.utils.dateparse import parse_date
 from django.utils.encoding import force_str
 from django.utils.formats import date_format
 from django.utils.timezone import now
@@ -19,17 +25,18 @@ from django.views.generic.detail import DetailView
 
 from cosinnus.core.signals import userprofile_created
 from cosinnus.models.group import CosinnusPortal
-from cosinnus.utils.http import make_csv_response
 from cosinnus.utils.permissions import check_user_superuser
 from cosinnus.utils.urls import get_non_cms_root_url, redirect_next_or
 from cosinnus.views.mixins.group import RequireLoggedInMixin
 from wechange_payments.backends import get_invoice_backend
 from wechange_payments.conf import settings
 from wechange_payments.forms import PaymentsForm
-from wechange_payments.models import Subscription, Payment, \
-    USERPROFILE_SETTING_POPUP_CLOSED, Invoice, USERPROFILE_SETTING_POPUP_USER_IS_NEW, AdditionalInvoice
+from wechange_payments.models import Subscription, Payment, UserSubscriptionState, \
+    USERPROFILE_SETTING_POPUP_CLOSED, Invoice, USERPROFILE_SETTING_POPUP_USER_IS_NEW, AdditionalInvoice, \
+    UserPaymentSummary
 from wechange_payments.payment import cancel_subscription as do_cancel_subscription
 from wechange_payments.tests.example_data import TEST_DATA_SEPA_PAYMENT_FORM
+from wechange_payments.utils.downloads import serve_stored_file
 
 logger = logging.getLogger('wechange-payments')
 
@@ -83,7 +90,7 @@ class PaymentView(BlockViewIfSoftDisabledMixin, CheckAdminOnlyPhaseMixin, Requir
         
         allow_active_subscription = kwargs.get('allow_active_subscription', False)
         if not allow_active_subscription:
-            active_subscription = Subscription.get_active_for_user(self.request.user)
+            active_subscription = UserSubscriptionState.for_request(self.request).active
             if active_subscription:
                 return redirect('wechange-payments:my-subscription')
         else:
@@ -107,8 +114,9 @@ class PaymentView(BlockViewIfSoftDisabledMixin, CheckAdminOnlyPhaseMixin, Requir
         initial['email'] = self.request.user.email
         form = PaymentsForm(initial=initial)
         
-        current_sub = Subscription.get_current_for_user(self.request.user)
-        waiting_sub = Subscription.get_waiting_for_user(self.request.user)
+        subscription_state = UserSubscriptionState.for_request(self.request)
+        current_sub = subscription_state.current
+        waiting_sub = subscription_state.waiting
         
         context.update({
             'form': form,
@@ -129,8 +137,9 @@ class PaymentUpdateView(PaymentView):
             return super(PaymentView, self).dispatch(request, *args, **kwargs)
         
         # user needs an active or waiting subscription to access this view
-        active_subscription = Subscription.get_active_for_user(self.request.user)
-        waiting_subscription = Subscription.get_waiting_for_user(self.request.user)
+        subscription_state = UserSubscriptionState.for_request(self.request)
+        active_subscription = subscription_state.active
+        waiting_subscription = subscription_state.waiting
         if not active_subscription and not waiting_subscription:
             return redirect('wechange-payments:overview')
         
@@ -203,7 +212,7 @@ class PaymentProcessView(BlockViewIfSoftDisabledMixin, CheckAdminOnlyPhaseMixin,
         elif self.object.status not in [Payment.STATUS_STARTED, Payment.STATUS_COMPLETED_BUT_UNCONFIRMED]:
             messages.error(self.request, str(_('This payment session has expired.')) + ' ' + str(_('Please try again or contact our support for assistance!')))
             # redirect user to the payment form they were coming from
-            if Subscription.get_active_for_user(self.request.user):
+            if UserSubscriptionState.for_request(self.request).active:
                 return redirect('wechange-payments:payment-update')
             else:
                 return redirect('wechange-payments:payment')
@@ -226,8 +235,8 @@ class OverviewView(CheckAdminOnlyPhaseMixin, RequireLoggedInMixin, RedirectView)
         and to the my subscription view if there is an active subscription. """
     
     def get_redirect_url(self, *args, **kwargs):
-        suspended = Subscription.get_suspended_for_user(self.request.user)
-        if suspended:
+        subscription_state = UserSubscriptionState.for_request(self.request)
+        if subscription_state.suspended:
             return reverse('wechange-payments:suspended-subscription')
         
         non_terminated_states = [
@@ -238,7 +247,8 @@ class OverviewView(CheckAdminOnlyPhaseMixin, RequireLoggedInMixin, RedirectView)
             non_terminated_states += [
                 Subscription.STATE_3_WAITING_TO_BECOME_ACTIVE,
             ]
-        subscription = get_object_or_None(Subscription, user=self.request.user, state__in=non_terminated_states)
+        subscriptions = [subscription_state.subscriptions_by_state.get(state) for state in non_terminated_states]
+        subscription = ([sub for sub in subscriptions if sub] or [None])[0]
         if not subscription or subscription.state in Subscription.ALLOWED_TO_MAKE_NEW_SUBSCRIPTION_STATES:
             return reverse('wechange-payments:payment')
         else:
@@ -257,8 +267,9 @@ class MySubscriptionView(BlockViewIfSoftDisabledMixin, CheckAdminOnlyPhaseMixin,
         if not self.request.user.is_authenticated:
             return super(MySubscriptionView, self).dispatch(request, *args, **kwargs)
         
-        current_subscription = Subscription.get_current_for_user(self.request.user)
-        waiting_subscription = Subscription.get_waiting_for_user(self.request.user)
+        subscription_state = UserSubscriptionState.for_request(self.request)
+        current_subscription = subscription_state.current
+        waiting_subscription = subscription_state.waiting
         
         if current_subscription and current_subscription.state == Subscription.STATE_1_CANCELLED_BUT_ACTIVE and waiting_subscription:
             self.cancelled_subscription = current_subscription
@@ -281,6 +292,7 @@ class MySubscriptionView(BlockViewIfSoftDisabledMixin, CheckAdminOnlyPhaseMixin,
         context.update({
             'subscription': self.subscription,
             'cancelled_subscription': self.cancelled_subscription,
+            'payment_summary': UserPaymentSummary.get_for_user(self.request.user),
         })
         return context
         
@@ -295,7 +307,7 @@ class SuspendedSubscriptionView(BlockViewIfSoftDisabledMixin, CheckAdminOnlyPhas
     def dispatch(self, request, *args, **kwargs):
         if not self.request.user.is_authenticated:
             return super(SuspendedSubscriptionView, self).dispatch(request, *args, **kwargs)
-        self.suspended_subscription = Subscription.get_suspended_for_user(self.request.user)
+        self.suspended_subscription = UserSubscriptionState.for_request(self.request).suspended
         if not self.suspended_subscription:
             return redirect('wechange-payments:overview')
         return super(SuspendedSubscriptionView, self).dispatch(request, *args, **kwargs)
@@ -331,11 +343,12 @@ class PaymentInfosView(CheckAdminOnlyPhaseMixin, RequireLoggedInMixin, TemplateV
         if not self.request.user.is_authenticated:
             return super(PaymentInfosView, self).dispatch(request, *args, **kwargs)
         
-        self.current_subscription = Subscription.get_current_for_user(self.request.user)
+        subscription_state = UserSubscriptionState.for_request(self.request)
+        self.current_subscription = subscription_state.current
         self.last_payment = None
         if self.current_subscription:
             self.last_payment = self.current_subscription.last_payment
-        self.waiting_subscription = Subscription.get_waiting_for_user(self.request.user)
+        self.waiting_subscription = subscription_state.waiting
         self.subscription = self.waiting_subscription or self.current_subscription
         if not self.subscription:
             return redirect('wechange-payments:payment')
@@ -346,6 +359,7 @@ class PaymentInfosView(CheckAdminOnlyPhaseMixin, RequireLoggedInMixin, TemplateV
         context.update({
             'subscription': self.subscription,
             'last_payment': self.last_payment,
+            'payment_summary': UserPaymentSummary.get_for_user(self.request.user),
         })
         return context
         
@@ -385,9 +399,9 @@ class InvoicesView(CheckAdminOnlyPhaseMixin, RequireLoggedInMixin, TemplateView)
         if not self.request.user.is_authenticated:
             return super(InvoicesView, self).dispatch(request, *args, **kwargs)
         
-        self.invoices = Invoice.objects.filter(user=request.user)
-        if self.invoices.count() == 0:
+        if UserPaymentSummary.get_for_user(request.user).invoice_count == 0:
             return redirect('wechange-payments:overview')
+        self.invoices = Invoice.objects.filter(user=request.user)
         return super(InvoicesView, self).dispatch(request, *args, **kwargs)
     
     def get_context_data(self, *args, **kwargs):
@@ -443,7 +457,8 @@ invoice_detail = InvoiceDetailView.as_view()
 class InvoiceDownloadView(CheckAdminOnlyPhaseMixin, RequireLoggedInMixin, DetailView):
     """ Lets the user download the FileField file of an Invoice
         while the user never gets to see the server file path.
-        Mime type is always pdf. """
+        Mime type is always pdf. Supports conditional and range requests, and can hand
+        the file over to the front proxy (see `PAYMENTS_INVOICE_DOWNLOAD_OFFLOAD`). """
         
     model = Invoice
     
@@ -459,13 +474,22 @@ class InvoiceDownloadView(CheckAdminOnlyPhaseMixin, RequireLoggedInMixin, Detail
             return HttpResponseNotFound()
         return super(InvoiceDownloadView, self).dispatch(request, *args, **kwargs)
     
+    def get(self, request, *args, **kwargs):
+        # the invoice was already loaded in `dispatch()`, and no template is rendered
+        return self.render_to_response({})
+    
     def render_to_response(self, context, **response_kwargs):
         invoice = self.object
-        path = invoice.file and invoice.file.path
-        if not path:
+        if not invoice.file:
             return HttpResponseNotFound()
-    
-        response = FileResponse(open(path, 'rb'), content_type='application/pdf')
+        
+        # a ready invoice's file never changes, and a re-downloaded file always gets a new name
+        etag = '"%s"' % hashlib.sha1(invoice.file.name.encode('utf-8')).hexdigest()
+        response = serve_stored_file(self.request, invoice.file, 'application/pdf', etag, invoice.last_action_at,
+                                     gzipped=invoice.is_file_compressed)
+        if response.status_code not in (200, 206):
+            return response
+        
         short_date = date_format(invoice.created, format='SHORT_DATE_FORMAT', use_l10n=True)
         filename = '%s-%s-%s.pdf' % (CosinnusPortal.get_current().name, force_str(_('Invoice')), short_date)
         # To inspect details for the below code, see http://greenbytes.de/tech/tc2231/
@@ -521,18 +545,65 @@ class CancelSubscriptionView(CheckAdminOnlyPhaseMixin, RequireLoggedInMixin, Tem
 cancel_subscription = CancelSubscriptionView.as_view()
 
 
+class _EchoBuffer(object):
+    """ A file-like object for `csv.writer` that returns the written row instead of buffering it """
+    def write(self, value):
+        return value
+
+
+def _make_streaming_csv_response(rows, row_names, file_name):
+    """ Returns a CSV download that is generated row by row while being sent """
+    writer = csv.writer(_EchoBuffer())
+    def _generate_lines():
+        yield writer.writerow(row_names)
+        for row in rows:
+            yield writer.writerow(row)
+    response = StreamingHttpResponse(_generate_lines(), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % file_name
+    return response
+
+
 def admin_stats(request):
-    """ Prints out a simple csv of successful payments with format
-        "payment-date,payment-amount" for admins only as stats """
+    """ Streams out a simple csv of successful payments with format
+        "payment-date,payment-amount" for admins only as stats.
+        GET params:
+            - `from` / `to`: optional dates (YYYY-MM-DD) to limit the payments' completion dates (inclusive)
+            - `aggregate`: if "day" or "month", instead outputs the sum and count of payments per
+                day or month, payment type and debit period, computed by the DB """
     if request and not request.user.is_superuser:
         return HttpResponseForbidden('Not authenticated')
     
-    header = ['payment-date', 'payment-amount']
-    payments = []
-    for payment in Payment.objects.filter(status=Payment.STATUS_PAID, revoked=False, completed_at__isnull=False).order_by('-completed_at'):
-        payments.append([payment.completed_at.date(), payment.amount])
+    payments = Payment.objects.filter(status=Payment.STATUS_PAID, revoked=False, completed_at__isnull=False)
+    for param, lookup in (('from', 'completed_at__date__gte'), ('to', 'completed_at__date__lte')):
+        if not request.GET.get(param):
+            continue
+        try:
+            date = parse_date(request.GET[param])
+        except ValueError:
+            date = None
+        if date is None:
+            return HttpResponseBadRequest('Invalid date for "%s" (expected YYYY-MM-DD).' % param)
+        payments = payments.filter(**{lookup: date})
+    
+    aggregate = request.GET.get('aggregate', None)
+    if aggregate:
+        trunc_functions = {'day': TruncDay, 'month': TruncMonth}
+        if aggregate not in trunc_functions:
+            return HttpResponseBadRequest('Invalid value for "aggregate" (expected "day" or "month").')
+        header = ['period', 'payment-type', 'debit-period', 'amount-sum', 'payment-count']
+        aggregated = payments.annotate(period=trunc_functions[aggregate]('completed_at'))\
+                .values('period', 'type', 'debit_period')\
+                .annotate(amount_sum=Sum('amount'), payment_count=Count('id'))\
+                .order_by('-period', 'type', 'debit_period')\
+                .values_list('period', 'type', 'debit_period', 'amount_sum', 'payment_count')
+        rows = ([period.date(), payment_type, debit_period, amount_sum, payment_count] 
+                for period, payment_type, debit_period, amount_sum, payment_count in aggregated.iterator())
+        return _make_streaming_csv_response(rows, header, 'payl-stats-%s.csv' % aggregate)
     
-    return make_csv_response(payments, row_names=header, file_name='payl-stats.csv')
+    header = ['payment-date', 'payment-amount']
+    rows = ([completed_at.date(), amount] for completed_at, amount in 
+            payments.order_by('-completed_at').values_list('completed_at', 'amount').iterator(chunk_size=2000))
+    return _make_streaming_csv_response(rows, header, 'payl-stats.csv')
 
 
 def debug_delete_subscription(request):